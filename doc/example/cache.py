@@ -0,0 +1,222 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from soa_bridge_match.connector import CACHE_DIR
+
+# seconds a response is used without checking with the server, by resource type;
+# the protocol design rarely changes, the subject data might
+DEFAULT_TTLS = {
+    "metadata": 24 * 3600,
+    "ResearchStudy": 24 * 3600,
+    "PlanDefinition": 24 * 3600,
+    "ActivityDefinition": 24 * 3600,
+    "ResearchSubject": 3600,
+}
+DEFAULT_TTL = 300
+
+# parameters that don't change the response
+VOLATILE_PARAMETERS = ("_format",)
+
+RESOURCE_TYPE = re.compile(r'^[A-Z][A-Za-z]+$')
+
+
+def normalise_url(url: str) -> str:
+    """
+    The cache key for a URL; the host is lowercased and the search parameters sorted
+    """
+    scheme, netloc, path, query, _ = urlsplit(url)
+    params = sorted((x, y) for x, y in parse_qsl(query, keep_blank_values=True) if x not in VOLATILE_PARAMETERS)
+    return urlunsplit((scheme.lower(), netloc.lower(), path.rstrip('/'), urlencode(params, safe=':/|,'), ''))
+
+
+def url_resource_type(url: str) -> str:
+    """
+    The resource type read or searched by a URL (metadata for the CapabilityStatement)
+    """
+    for segment in urlsplit(url).path.strip('/').split('/'):
+        # the base path is lowercase, the type comes before the id
+        if segment == "metadata" or RESOURCE_TYPE.match(segment):
+            return segment
+    return ""
+
+
+class CacheEntry(NamedTuple):
+    url: str
+    body: bytes
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # when the response was last fetched or revalidated
+    stored: float = 0.0
+
+    def validators(self) -> Dict[str, str]:
+        """
+        The headers for a conditional request
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class MemoryStore:
+    """
+    Least recently used responses in memory
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteStore:
+    """
+    Responses on disk in a SQLite database, so they survive between runs
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(CACHE_DIR, "fhir-responses.sqlite")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        # shared by the query threads, guarded by the lock
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS responses ("
+                                     "key TEXT PRIMARY KEY, url TEXT, body BLOB, "
+                                     "etag TEXT, last_modified TEXT, stored REAL)")
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            row = self._connection.execute("SELECT url, body, etag, last_modified, stored "
+                                           "FROM responses WHERE key = ?", (key,)).fetchone()
+        return CacheEntry(*row) if row else None
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                                     (key, entry.url, entry.body, entry.etag, entry.last_modified, entry.stored))
+
+    def clear(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM responses")
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class ResponseCache:
+    """
+    Two level response cache (memory, then disk) for the query engine; fresh responses are
+    used as they are, stale ones are revalidated with a conditional request
+    """
+
+    def __init__(self, path: Optional[str] = None,
+                 max_entries: int = 1024,
+                 ttls: Optional[Dict[str, float]] = None,
+                 default_ttl: float = DEFAULT_TTL,
+                 persistent: bool = True):
+        """
+        @param path: the SQLite database (defaults to one in the CDISCPILOT_CACHE_DIR)
+        @param ttls: seconds a response is fresh for, by resource type (overrides the defaults)
+        @param persistent: keep the responses on disk
+        """
+        self.memory = MemoryStore(max_entries)
+        self.disk = SQLiteStore(path) if persistent else None
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self._stats = dict(hits=0, memory_hits=0, disk_hits=0, misses=0, stale=0,
+                           revalidated=0, stored=0)
+
+    def _count(self, *names: str) -> None:
+        with self._lock:
+            for name in names:
+                self._stats[name] += 1
+
+    def ttl(self, url: str) -> float:
+        return self.ttls.get(url_resource_type(url), self.default_ttl)
+
+    def lookup(self, url: str) -> Optional[CacheEntry]:
+        """
+        Get the cached response for a URL, checking memory before the disk
+        """
+        key = normalise_url(url)
+        entry = self.memory.get(key)
+        if entry is not None:
+            self._count("memory_hits")
+            return entry
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self._count("disk_hits")
+                self.memory.put(key, entry)
+                return entry
+        self._count("misses")
+        return None
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        fresh = time.time() - entry.stored < self.ttl(entry.url)
+        self._count("hits" if fresh else "stale")
+        return fresh
+
+    def store(self, url: str, body: bytes, etag: Optional[str] = None,
+              last_modified: Optional[str] = None) -> CacheEntry:
+        entry = CacheEntry(url, body, etag, last_modified, time.time())
+        self._put(entry)
+        self._count("stored")
+        return entry
+
+    def revalidated(self, entry: CacheEntry) -> CacheEntry:
+        """
+        The server confirmed the response is unchanged (304), it is fresh again
+        """
+        entry = entry._replace(stored=time.time())
+        self._put(entry)
+        self._count("revalidated")
+        return entry
+
+    def _put(self, entry: CacheEntry) -> None:
+        key = normalise_url(entry.url)
+        self.memory.put(key, entry)
+        if self.disk is not None:
+            self.disk.put(key, entry)
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
@@ -1,12 +1,24 @@
+import os
 import sys
 
+# the example uses the soa_bridge_match package from the source tree
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src'))
+
+from soa_bridge_match.search import BundleSearch
+
+from cache import ResponseCache
 from windows import StudyWindow
 
 BASEURL = "https://api.logicahealth.org/soaconnectathon30/open"
 
 
-def run(subject_id, study_id="H2Q-MC-LZZT"):
-    window = StudyWindow(BASEURL, study_id)
+def run(subject_id, study_id="H2Q-MC-LZZT", bundle_dir=None):
+    if bundle_dir:
+        # search the subject bundles in process, rather than a server
+        window = StudyWindow(None, study_id, engine=BundleSearch.from_directory(bundle_dir))
+    else:
+        # the responses are kept between runs, only the changed data is fetched again
+        window = StudyWindow(BASEURL, study_id, cache=ResponseCache())
     protocol = window.get_protocol()
     processed = window.process_protocol(protocol)
     window.get_subject_scheme(subject_id, processed)
@@ -18,4 +30,6 @@ if __name__ == '__main__':
         SUBJECT_ID = sys.argv[1]
     else:
         SUBJECT_ID = "01-701-1047"
-    run(SUBJECT_ID, STUDY_ID)
+    # optionally, a directory of subject bundles to search instead of the server
+    BUNDLE_DIR = sys.argv[2] if len(sys.argv) > 2 else None
+    run(SUBJECT_ID, STUDY_ID, BUNDLE_DIR)
@@ -0,0 +1,167 @@
+import json
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import logging
+
+logger = logging.getLogger("soa-bridge-match.query")
+
+# responses worth trying again
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class QueryEngine:
+    """
+    Runs the FHIR queries against a server on a pool of threads sharing a pooled
+    session; concurrent requests for the same URL are coalesced into one, and
+    transient failures are retried with an exponential backoff
+    """
+
+    def __init__(self, baseurl: str,
+                 max_workers: int = 8,
+                 retries: int = 3,
+                 backoff: float = 0.5,
+                 timeout: float = 30.0,
+                 cache=None):
+        """
+        @param cache: keeps the responses between queries (and runs), eg a ResponseCache
+        """
+        self._baseurl = baseurl if baseurl.endswith('/') else baseurl + '/'
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self._session = None
+        self._executor = None
+        self._lock = threading.Lock()
+        # url -> Future for the requests in flight
+        self._inflight = {}
+        self._stats = dict(requests=0, coalesced=0, retries=0, errors=0, not_modified=0)
+
+    @property
+    def baseurl(self) -> str:
+        return self._baseurl
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            session = requests.Session()
+            session.headers.update({'Accept': 'application/json'})
+            session.headers.update({'Content-Type': 'application/json'})
+            # one pooled connection per worker
+            adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix="fhir-query")
+        return self._executor
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def _retry_delay(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        delay = self.backoff * (2 ** attempt)
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            delay = max(delay, float(response.headers['Retry-After']))
+        return delay
+
+    def _fetch(self, url: str) -> Optional[dict]:
+        """
+        Get the JSON for a URL (relative to the base URL, or absolute), None unless the response is a 200
+        """
+        # paging links are absolute
+        all_url = url if "://" in url else self._baseurl + url
+        entry = self.cache.lookup(all_url) if self.cache is not None else None
+        if entry is not None and self.cache.is_fresh(entry):
+            return json.loads(entry.body)
+        # a stale response is checked with the server rather than fetched again
+        headers = entry.validators() if entry is not None else {}
+        for attempt in range(self.retries + 1):
+            print(f'Fetching {all_url}')
+            self._count("requests")
+            try:
+                response = self.session.get(all_url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                if attempt == self.retries:
+                    self._count("errors")
+                    raise
+                logger.warning(f"Request for {all_url} failed ({exc}), retrying")
+                self._count("retries")
+                time.sleep(self._retry_delay(attempt))
+                continue
+            if response.status_code in RETRY_STATUS and attempt < self.retries:
+                logger.warning(f"Request for {all_url} returned {response.status_code}, retrying")
+                self._count("retries")
+                time.sleep(self._retry_delay(attempt, response))
+                continue
+            if response.status_code == 304 and entry is not None:
+                self._count("not_modified")
+                return json.loads(self.cache.revalidated(entry).body)
+            if response.status_code == 200:
+                if self.cache is not None:
+                    self.cache.store(all_url, response.content,
+                                     etag=response.headers.get('ETag'),
+                                     last_modified=response.headers.get('Last-Modified'))
+                return response.json()
+            self._count("errors")
+            return None
+        return None
+
+    def _done(self, url: str, future: Future) -> None:
+        with self._lock:
+            if self._inflight.get(url) is future:
+                del self._inflight[url]
+
+    def submit(self, url: str) -> Future:
+        """
+        Queue a query, sharing the request with any identical query in flight
+        """
+        with self._lock:
+            future = self._inflight.get(url)
+            if future is not None:
+                self._stats["coalesced"] += 1
+                return future
+            future = self.executor.submit(self._fetch, url)
+            self._inflight[url] = future
+        future.add_done_callback(lambda x: self._done(url, x))
+        return future
+
+    def get(self, url: str) -> Optional[dict]:
+        return self.submit(url).result()
+
+    def get_many(self, urls: Iterable[str]) -> Dict[str, Optional[dict]]:
+        """
+        Run a batch of queries concurrently, returning the JSON by URL
+        """
+        futures = {url: self.submit(url) for url in urls}
+        return {url: future.result() for url, future in futures.items()}
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        if self.cache is not None:
+            stats.update({f"cache_{x}": y for x, y in self.cache.stats().items()})
+        return stats
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        if self.cache is not None:
+            self.cache.close()
@@ -1,8 +1,7 @@
+import copy
 import re
-import datetime
-from typing import Optional, List
-
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, List
 from fhir.resources.bundle import Bundle
 from fhir.resources.patient import Patient
 from fhir.resources.observation import Observation
@@ -17,11 +16,19 @@ from fhir.resources.careplan import CarePlan
 from fhir.resources.resource import Resource
 from fhir.resources.servicerequest import ServiceRequest
 
+from soa_bridge_match.intervals import SubjectTimeline, VisitMatch, VisitWindow
+from soa_bridge_match.schedule import ProtocolSchedule
+
+from query import QueryEngine
+
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("soa-bridge-match.example")
 
+# the resources counted for each visit
+CLINICAL_RESOURCES = ("Observation", "Procedure", "AdverseEvent", "MedicationStatement")
+
 
 """
 1. Identify the ResearchStudy (`ResearchStudy?_id=PROTOCOL_ID`)
@@ -55,55 +62,89 @@ logger = logging.getLogger("soa-bridge-match.example")
 
 class StudyWindow:
 
-    def __init__(self, baseurl: str, study_id: str):
-        self._baseurl = baseurl if baseurl.endswith('/') else baseurl + '/'
+    def __init__(self, baseurl: Optional[str], study_id: str,
+                 engine=None,
+                 max_workers: int = 8,
+                 cache=None):
+        """
+        @param engine: runs the queries (anything with get/get_many, eg a BundleSearch
+                       over the subject bundles), defaults to a QueryEngine for the baseurl
+        @param cache: the response cache for the default QueryEngine (eg a ResponseCache)
+        """
+        self._baseurl = baseurl if not baseurl or baseurl.endswith('/') else baseurl + '/'
         self.study_id = study_id
         self._visits = []
-        self._session = None
+        self._engine = engine
+        self._max_workers = max_workers
+        self._cache = cache
+        self._study = None
         self._encounter_cache = {}
         self._subject_cache = {}
+        # subject -> visit map, from the single search for the CarePlan cascade
+        self._visit_maps = {}
+        # whether the server supports the _revinclude searches (None until known)
+        self._revinclude = None
+        # the compiled visit schedule, from process_protocol
+        self._schedule = None
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._engine = QueryEngine(self._baseurl, max_workers=self._max_workers, cache=self._cache)
+        return self._engine
 
     @property
     def client(self):
-        if self._session is None:
-            self._session = requests.Session()
-            self._session.headers.update({'Accept': 'application/json'})
-            self._session.headers.update({'Content-Type': 'application/json'})
-        return self._session
+        return self.engine.session
 
-    def _get(self, url) -> Optional[Resource]:
-        all_url = self._baseurl + url
-        print(f'Fetching {all_url}')
-        response = self.client.get(all_url)
-        if response.status_code == 200:
-            if '?' in all_url:
-                return Bundle.parse_obj(response.json())
+    @property
+    def schedule(self) -> ProtocolSchedule:
+        if self._schedule is None:
+            self.process_protocol(self.get_protocol())
+        return self._schedule
+
+    def _parse(self, url: str, data: Optional[dict]) -> Optional[Resource]:
+        if data is None:
+            return None
+        if '?' in url:
+            return Bundle.parse_obj(data)
+        else:
+            pattern = re.compile(r'([A-z]+)/(.*)')
+            rtype, _ = pattern.match(url).groups()
+
+            if rtype == 'Encounter':
+                return Encounter.parse_obj(data)
+            elif rtype == 'ServiceRequest':
+                return ServiceRequest.parse_obj(data)
+            elif rtype == 'CarePlan':
+                return CarePlan.parse_obj(data)
+            elif rtype == 'ResearchSubject':
+                return ResearchSubject.parse_obj(data)
+            elif rtype == 'Patient':
+                return Patient.parse_obj(data)
+            elif rtype == 'PlanDefinition':
+                return PlanDefinition.parse_obj(data)
             else:
-                pattern = re.compile(r'([A-z]+)/(.*)')
-                rtype, _ = pattern.match(url).groups()
-
-                if rtype == 'Encounter':
-                    return Encounter.parse_obj(response.json())
-                elif rtype == 'ServiceRequest':
-                    return ServiceRequest.parse_obj(response.json())
-                elif rtype == 'CarePlan':
-                    return CarePlan.parse_obj(response.json())
-                elif rtype == 'ResearchSubject':
-                    return ResearchSubject.parse_obj(response.json())
-                elif rtype == 'Patient':
-                    return Patient.parse_obj(response.json())
-                elif rtype == 'PlanDefinition':
-                    return PlanDefinition.parse_obj(response.json())
-                else:
-                    print(f"No idea how to work with this type: {rtype}")
+                print(f"No idea how to work with this type: {rtype}")
         return None
 
+    def _get(self, url) -> Optional[Resource]:
+        return self._parse(url, self.engine.get(url))
+
+    def _get_many(self, urls: Iterable[str]) -> Dict[str, Optional[Resource]]:
+        """
+        Run the queries concurrently
+        """
+        return {url: self._parse(url, data) for url, data in self.engine.get_many(urls).items()}
+
     def _get_research_study(self) -> Optional[ResearchStudy]:
-        url = f'ResearchStudy?identifier={self.study_id}'
-        bundle = self._get(url)
-        if bundle.total != 1:
-            raise Exception(f'No ResearchStudy found for {self.study_id}')
-        return bundle.entry[0].resource
+        if self._study is None:
+            url = f'ResearchStudy?identifier={self.study_id}'
+            bundle = self._get(url)
+            if bundle.total != 1:
+                raise Exception(f'No ResearchStudy found for {self.study_id}')
+            self._study = bundle.entry[0].resource
+        return self._study
 
     def _get_research_subjects(self) -> Optional[List[ResearchSubject]]:
         url = f'ResearchSubject?study={self.study_id}'
@@ -139,6 +180,8 @@ class StudyWindow:
         Extracts the protocol information and returns a dictionary with the planned encounters
         """
         logger.info(f'Processing protocol PlanDefinition {protocol.id}')
+        # compiled once per PlanDefinition version
+        self._schedule = ProtocolSchedule.compile(protocol)
         ids = {}
         encounters = {}
         for idx, action in enumerate(protocol.action):  # type: int, PlanDefinitionAction
@@ -171,58 +214,161 @@ class StudyWindow:
 
         return encounters
 
-    def get_encounter_for_subject(self, subject_id: str, plan_definition_id: str) -> Optional[Encounter]:
-        _idx = f"{subject_id}_{plan_definition_id}"
-        if plan_definition_id.startswith("PlanDefinition"):
-            plan_definition_id = plan_definition_id.split("/")[1]
-        if _idx not in self._encounter_cache:
-            research_subject = self._get_research_subject(subject_id)
-            if research_subject is None:
-                # can't find subject
+    def _search_all(self, url: str) -> List[dict]:
+        """
+        Get the resources for a search, following the paging links
+        """
+        resources = []
+        while url:
+            data = self.engine.get(url)
+            if data is None:
+                break
+            resources.extend(x["resource"] for x in data.get("entry", []) if "resource" in x)
+            url = next((x["url"] for x in data.get("link", []) if x.get("relation") == "next"), None)
+        return resources
+
+    def _supports_revinclude(self) -> Optional[bool]:
+        """
+        Check the server CapabilityStatement for the _revinclude searches used for the cascade
+        """
+        if self._revinclude is None:
+            metadata = self.engine.get("metadata")
+            if metadata is None:
                 return None
-            # get the careplan
-            cp_bnd = self._get(
-                "CarePlan?patient={}&"
-                "instantiates-canonical=PlanDefinition/{}".format(research_subject.individual.reference,
-                                                                  plan_definition_id))
-            if cp_bnd.total != 1:
-                raise Exception(f'No CarePlan found for {plan_definition_id}')
+            revincludes = {}
+            for rest in metadata.get("rest", []):
+                for resource in rest.get("resource", []):
+                    revincludes[resource.get("type")] = set(resource.get("searchRevInclude", []))
+            self._revinclude = ("ServiceRequest:based-on" in revincludes.get("CarePlan", set()) and
+                                "Encounter:based-on" in revincludes.get("ServiceRequest", set()))
+        return self._revinclude
+
+    def get_visit_map(self, subject_id: str) -> Optional[Dict[str, Optional[Encounter]]]:
+        """
+        Get the Encounter for each of the subject's CarePlans (by PlanDefinition id) with one search,
+        returning the CarePlans with the ServiceRequests based on them and the Encounters based on those;
+        None if the server can't run the search
+        """
+        if subject_id in self._visit_maps:
+            return self._visit_maps[subject_id]
+        if self._supports_revinclude() is False:
+            return None
+        research_subject = self._get_research_subject(subject_id)
+        if research_subject is None:
+            return None
+        resources = self._search_all(f"CarePlan?patient={research_subject.individual.reference}"
+                                     "&_revinclude=ServiceRequest:based-on"
+                                     "&_revinclude:iterate=Encounter:based-on")
+        care_plans = [x for x in resources if x["resourceType"] == "CarePlan"]
+        based_on = {}
+        for resource in resources:
+            if resource["resourceType"] in ("ServiceRequest", "Encounter"):
+                for reference in resource.get("basedOn", []):
+                    based_on.setdefault(reference.get("reference"), []).append(resource)
+        if care_plans and not any(x["resourceType"] == "ServiceRequest" for x in resources):
+            # the server ignored the _revinclude
+            print("Server does not support _revinclude, using the stepwise queries")
+            self._revinclude = False
+            return None
+        visit_map = {}
+        for care_plan in care_plans:
+            service_requests = [x for x in based_on.get(f"CarePlan/{care_plan['id']}", [])
+                                if x["resourceType"] == "ServiceRequest"]
+            encounters = [x for x in based_on.get(f"ServiceRequest/{service_requests[0]['id']}", [])
+                          if x["resourceType"] == "Encounter"] if service_requests else []
+            for canonical in care_plan.get("instantiatesCanonical", []):
+                visit_map[canonical.split("/")[-1]] = Encounter.parse_obj(encounters[0]) if encounters else None
+        self._visit_maps[subject_id] = visit_map
+        return visit_map
+
+    def get_encounters_for_subject(self, subject_id: str,
+                                   plan_definition_ids: List[str]) -> Dict[str, Optional[Encounter]]:
+        """
+        Walk the CarePlan -> ServiceRequest -> Encounter cascade for the visits; uses the visit
+        map where the server supports it, otherwise runs each step for all the visits at once;
+        visits without an Encounter map to None
+        """
+        visit_map = self.get_visit_map(subject_id)
+        if visit_map is not None:
+            return {x: visit_map.get(x.split("/")[-1]) for x in plan_definition_ids}
+        research_subject = self._get_research_subject(subject_id)
+        if research_subject is None:
+            # can't find subject
+            return {}
+        patient = research_subject.individual.reference
+        pending = {}
+        for plan_definition_id in plan_definition_ids:
+            _id = plan_definition_id.split("/")[1] if plan_definition_id.startswith("PlanDefinition") else plan_definition_id
+            if f"{subject_id}_{_id}" not in self._encounter_cache:
+                pending[_id] = f"CarePlan?patient={patient}&instantiates-canonical=PlanDefinition/{_id}"
+        # get the careplans
+        care_plans = self._get_many(pending.values())
+        service_requests = {}
+        for _id, url in pending.items():
+            cp_bnd = care_plans[url]
+            if cp_bnd is None or cp_bnd.total != 1:
+                print(f'No CarePlan found for {_id}')
+                self._encounter_cache[f"{subject_id}_{_id}"] = None
+                continue
             cp = cp_bnd.entry[0].resource  # type: CarePlan
-            # get the service request
-            sr_bnd = self._get("ServiceRequest?patient={}&"
-                               "based-on=CarePlan/{}".format(research_subject.individual.reference,
-                                                             cp.id))
-            if sr_bnd.total == 0:
-                raise Exception(f'No ServiceRequest found for {cp.id}')
+            service_requests[_id] = f"ServiceRequest?patient={patient}&based-on=CarePlan/{cp.id}"
+        # get the service requests
+        sr_bnds = self._get_many(service_requests.values())
+        encounters = {}
+        for _id, url in service_requests.items():
+            sr_bnd = sr_bnds[url]
+            if sr_bnd is None or not sr_bnd.total:
+                print(f'No ServiceRequest found for {_id}')
+                self._encounter_cache[f"{subject_id}_{_id}"] = None
+                continue
             sd = sr_bnd.entry[0].resource  # type: ServiceRequest
-            # get the encounter
-            enc_bnd = self._get("Encounter?patient={}&based-on=ServiceRequest/{}".format(
-                research_subject.individual.reference, sd.id))
-            self._encounter_cache[_idx] = enc_bnd.entry[0].resource  # type: Encounter
-        return self._encounter_cache.get(_idx)
+            encounters[_id] = f"Encounter?patient={patient}&based-on=ServiceRequest/{sd.id}"
+        # get the encounters
+        enc_bnds = self._get_many(encounters.values())
+        for _id, url in encounters.items():
+            enc_bnd = enc_bnds[url]
+            self._encounter_cache[f"{subject_id}_{_id}"] = enc_bnd.entry[0].resource if enc_bnd and enc_bnd.entry else None
+        return {x: self._encounter_cache.get(
+            f"{subject_id}_{x.split('/')[1] if x.startswith('PlanDefinition') else x}") for x in plan_definition_ids}
+
+    def get_encounter_for_subject(self, subject_id: str, plan_definition_id: str) -> Optional[Encounter]:
+        encounters = self.get_encounters_for_subject(subject_id, [plan_definition_id])
+        if not encounters:
+            return None
+        encounter = encounters[plan_definition_id]
+        if encounter is None:
+            raise Exception(f'No Encounter found for {plan_definition_id}')
+        return encounter
 
-    def get_subject_scheme(self, subject_id: str, protocol: dict):
+    def get_subject_windows(self, subject_id: str, protocol: dict) -> Optional[dict]:
         """
-        Returns the index date for a subject
+        Works out the visit windows for a subject from the index date, returning the protocol
+        with the encounter dates, the window and the date queries for each visit
         """
         research_subject = self._get_research_subject(subject_id)
         if research_subject is None:
             print(f"Subject {subject_id} not found")
             return
-        trigger_events = [x for x in protocol.values() if x['is_index']]
-        print("Trigger events:", trigger_events)
-        assert len(trigger_events) == 1, "Unable to id index event"
-        idx_pd = self._get(trigger_events[0]['definition'])
-        if idx_pd is None:
-            raise Exception(f'No PlanDefinition found for {trigger_events[0]["definition"]}')
-        enc = self.get_encounter_for_subject(subject_id, idx_pd.id)
-        # Identify the visit date for the epoch
-        index_date = enc.period.start   # type: datetime.date
+        schedule = self.schedule
+        # fetch the encounters for all the visits together
+        visit_encounters = self.get_encounters_for_subject(subject_id, list(protocol))
+        # the windows for the visits scheduled from each index visit
+        windows = {}
+        for root in schedule.roots:
+            enc = visit_encounters.get(root)
+            if enc is None or not enc.period or not enc.period.start:
+                print(f'No Encounter found for index visit {root}')
+                continue
+            windows.update(schedule.windows(enc.period.start.date(), root))
         for visit, offsets in protocol.items():
             qtext = []
             try:
-                _enc = self.get_encounter_for_subject(subject_id, visit)
+                _enc = visit_encounters[visit]
+                if _enc is None:
+                    raise Exception(f'No Encounter found for {visit}')
                 if _enc.period:
+                    offsets["encounter_period"] = tuple(x.date().isoformat() if x else None
+                                                        for x in (_enc.period.start, _enc.period.end))
                     if _enc.period.start == _enc.period.end:
                         offsets["encounter_date"] = _enc.period.start.date()
                         offsets["datematch"] = f"eq{_enc.period.start.date().isoformat()}"
@@ -238,49 +384,127 @@ class StudyWindow:
                 print(f"Unable to find visit {visit}")
                 offsets["skip"] = True
 
-            if offsets["is_index"] is True:
-                qtext = [f"eq{index_date.date().isoformat()}"]
-            else:
-                if offsets.get("offset_high"):
-                    _offset = offsets.get("offset_high")
-                    if _offset.get('unit', 'd') == 'd':
-                        delta = datetime.timedelta(days=_offset.get('value'))
-                    else:
-                        # TODO: units, dummy
-                        delta = datetime.timedelta(days=_offset.get('value'))
-                    if offsets.get("relationship") == "after":
-                        _tgt = (index_date + delta).date().isoformat()
-                        qtext.append(f"le{_tgt}")
-                    else:
-                        _tgt = (index_date - delta).date().isoformat()
-                        qtext.append(f"ge{_tgt}")
-                if offsets.get("offset_low"):
-                    _offset = offsets.get("offset_low")
-                    if _offset.get('unit', 'd') == 'd':
-                        delta = datetime.timedelta(days=_offset.get('value'))
-                    else:
-                        # TODO: units, dummy
-                        delta = datetime.timedelta(days=_offset.get('value'))
-                    if offsets.get("relationship") == "after":
-                        _tgt = (index_date + delta).date().isoformat()
-                        qtext.append(f"ge{_tgt}")
-                    else:
-                        _tgt = (index_date - delta).date().isoformat()
-                        qtext.append(f"le{_tgt}")
+            window = offsets["window"] = dict(low=None, high=None, expected=None)
+            if visit in windows:
+                window.update(windows[visit])
+                if offsets["is_index"] is True:
+                    qtext = [f"eq{window['expected']}"]
+                else:
+                    if window["low"]:
+                        qtext.append(f"ge{window['low']}")
+                    if window["high"]:
+                        qtext.append(f"le{window['high']}")
             offsets["datequery"] = "&date=".join(qtext) if qtext else ""
             print(f"{visit} Query: {offsets['datequery']}",)
+        return protocol
+
+    def get_subject_scheme(self, subject_id: str, protocol: dict) -> Optional[dict]:
+        """
+        Works out the visit windows for a subject from the index date, returning the protocol
+        with the dates and the resource counts for each visit
+        """
+        if self.get_subject_windows(subject_id, protocol) is None:
+            return None
+        research_subject = self._get_research_subject(subject_id)
+        # run the resource queries for all the visits at once
+        queries = {}
         for visit, offset in protocol.items():
             if offset.get('skip', False):
-                print(f"Skipping {visit}")
                 continue
-            state = {}
-            for resource in ("Observation", "Procedure", "AdverseEvent", "MedicationStatement"):
+            for resource in CLINICAL_RESOURCES:
                 if offset["datequery"]:
                     _dq = offset["datequery"]
                 else:
                     _dq = offset["datematch"]
-                res = self._get(f"{resource}?patient={research_subject.individual.reference}&date={_dq}")  # type: Bundle
+                # only the totals are used
+                queries[(visit, resource)] = (f"{resource}?patient={research_subject.individual.reference}"
+                                              f"&date={_dq}&_summary=count")
+        results = self._get_many(queries.values())
+        for visit, offset in protocol.items():
+            if offset.get('skip', False):
+                print(f"Skipping {visit}")
+                continue
+            state = {}
+            for resource in CLINICAL_RESOURCES:
+                res = results[queries[(visit, resource)]]  # type: Bundle
                 if res:
                     state[resource] = res.total
+            offset["counts"] = state
             print(f"Visit: {visit} ({offset['encounter_date']})")
             print("\t".join(f"{x}: {y}" for x, y in state.items()))
+        return protocol
+
+    def get_study_scheme(self, protocol: dict,
+                         subject_ids: Optional[List[str]] = None,
+                         max_subjects: int = 4) -> Dict[str, dict]:
+        """
+        Run the subject scheme for each of the subjects in the study (defaults to all), several
+        subjects at a time; the queries share the engine
+        """
+        if subject_ids is None:
+            subject_ids = [x.id for x in self._get_research_subjects()]
+        with ThreadPoolExecutor(max_workers=max_subjects, thread_name_prefix="study-window") as executor:
+            futures = {x: executor.submit(self.get_subject_scheme, x, copy.deepcopy(protocol)) for x in subject_ids}
+            return {x: future.result() for x, future in futures.items()}
+
+    def get_study_windows(self, subject_ids: Optional[List[str]] = None,
+                          max_subjects: int = 4) -> Dict[str, Dict[str, dict]]:
+        """
+        Work out the visit windows for all the subjects (defaults to all) at once; only the
+        index visit Encounters are fetched, the schedule is applied to all the index dates together
+        """
+        schedule = self.schedule
+        if subject_ids is None:
+            subject_ids = [x.id for x in self._get_research_subjects()]
+        with ThreadPoolExecutor(max_workers=max_subjects, thread_name_prefix="study-window") as executor:
+            futures = {x: executor.submit(self.get_encounters_for_subject, x, schedule.roots) for x in subject_ids}
+            encounters = {x: future.result() for x, future in futures.items()}
+        windows = {x: {} for x in subject_ids}
+        for root in schedule.roots:
+            dated = [(x, y[root].period.start.date()) for x, y in encounters.items()
+                     if y.get(root) and y[root].period and y[root].period.start]
+            if not dated:
+                continue
+            for (subject_id, _), _windows in zip(dated, schedule.windows_many([x for _, x in dated], root)):
+                windows[subject_id].update(_windows)
+        return windows
+
+    def classify_subject(self, subject_id: str, protocol: dict) -> Optional[Dict[str, VisitMatch]]:
+        """
+        Assign the subject's clinical resources to the visits and classify the visits (green, orange
+        or red); the resources are fetched with one search per resource type, rather than per visit
+        """
+        if self.get_subject_windows(subject_id, protocol) is None:
+            return None
+        patient = self._get_research_subject(subject_id).individual.reference
+        resources = []
+        for resource in CLINICAL_RESOURCES:
+            resources.extend(self._search_all(f"{resource}?patient={patient}"))
+        timeline = SubjectTimeline(resources)
+        windows = []
+        for visit, offsets in protocol.items():
+            window = offsets.get("window", {})
+            encounter_start, encounter_end = offsets.get("encounter_period", (None, None))
+            windows.append(VisitWindow(visit,
+                                       low=window.get("low"),
+                                       high=window.get("high"),
+                                       expected=window.get("expected"),
+                                       encounter_start=encounter_start,
+                                       encounter_end=encounter_end))
+        matches = timeline.assign(windows)
+        for visit, match in matches.items():
+            print(f"Visit: {visit} [{match.status}]")
+            print("\t".join(f"{x}: {match.counts.get(x, 0)}" for x in CLINICAL_RESOURCES))
+        return matches
+
+    def classify_study(self, protocol: dict,
+                       subject_ids: Optional[List[str]] = None,
+                       max_subjects: int = 4) -> Dict[str, Dict[str, VisitMatch]]:
+        """
+        Classify the visits for each of the subjects in the study (defaults to all)
+        """
+        if subject_ids is None:
+            subject_ids = [x.id for x in self._get_research_subjects()]
+        with ThreadPoolExecutor(max_workers=max_subjects, thread_name_prefix="study-window") as executor:
+            futures = {x: executor.submit(self.classify_subject, x, copy.deepcopy(protocol)) for x in subject_ids}
+            return {x: future.result() for x, future in futures.items()}
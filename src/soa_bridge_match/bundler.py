@@ -1,46 +1,105 @@
 from __future__ import annotations
-import hashlib
 import os
 import random
-import datetime
-from typing import Optional, List
-from fhir.resources.bundle import Bundle, BundleEntry, BundleEntryRequest
+import json
+from typing import Iterable, Iterator, NamedTuple, Optional, List, Union
+from fhir.resources.bundle import Bundle, BundleEntry
 
 import uuid
 
-from fhir.resources.patient import Patient, PatientLink
-from fhir.resources.plandefinition import PlanDefinition
-from fhir.resources.reference import Reference
+from fhir.resources.patient import Patient
 from fhir.resources.researchstudy import ResearchStudy
 from fhir.resources.researchsubject import ResearchSubject
 from fhir.resources.resource import Resource
 
+from .cloner import ClonePlan, clone_many, hh
+from .models import construct_resource, resource_dict, upsert_entry, upsert_request, validate_resource
+from .references import ReferenceGraph, is_common_resource, resource_key
+from .serialise import FORMATS, TemporalStrings, loads, dumps, open_output, output_filename, write_json, write_ndjson
 from .synthea import SyntheaPicker
 
 
-def randomise_date(date: datetime.date) -> datetime.date:
-    _date = None
-    if random.random() > 0.5:
-        _date = date + datetime.timedelta(random.randint(10, 2000))
-    else:
-        _date = date - datetime.timedelta(random.randint(10, 2000))
-    return _date
+class AddedResources(NamedTuple):
+    # resources added to the bundle
+    added: int = 0
+    # resources skipped as they were already in the bundle
+    skipped: int = 0
+
+    def __add__(self, other: AddedResources) -> AddedResources:
+        return AddedResources(self.added + other.added, self.skipped + other.skipped)
+
+
+def _entry_resource(entry: Union[BundleEntry, dict]):
+    return entry["resource"] if isinstance(entry, dict) else entry.resource
 
 
 class SourcedBundle:
     """
     Wraps the bundle and generation thereof.
+
+    The bundle can be held as a Bundle model, or in raw mode as the parsed JSON; in
+    raw mode the resources are only turned into models when accessed through the
+    typed accessors (changes to those models are written back on dump).
     """
 
-    def __init__(self, bundle: Optional[Bundle],
+    def __init__(self, bundle: Optional[Union[Bundle, dict]],
                  identifier: Optional[str],
                  filename: Optional[str]) -> None:
         self._resources = []
         self._identifier = identifier if identifier else uuid.uuid4().hex
         self._filename = filename if filename else None
         self._bundle = bundle if bundle else None
+        # resource type -> list of ids
         self._entities = {}
+        # (resource type, id) -> BundleEntry
+        self._index = {}
+        # reference edges between the resources
+        self._graph = ReferenceGraph()
+        # (resource type, id) -> materialised model (raw mode)
+        self._models = {}
+        # the source strings for the parsed dates and times
+        self._temporal = TemporalStrings()
         self._synthea = None
+        self._build_index()
+
+    @property
+    def raw(self) -> bool:
+        """
+        Is the bundle held as the parsed JSON
+        """
+        return isinstance(self._bundle, dict)
+
+    def _entries(self) -> list:
+        if self.raw:
+            return self._bundle.setdefault("entry", [])
+        if self.bundle.entry is None:
+            self._bundle.entry = []
+        return self._bundle.entry
+
+    def _index_entry(self, entry: Union[BundleEntry, dict]) -> bool:
+        """
+        Register an entry in the index, returns False if the resource is already known
+        """
+        resource = _entry_resource(entry)
+        _key = resource_key(resource)
+        if _key in self._index:
+            return False
+        self._index[_key] = entry
+        self._entities.setdefault(_key[0], []).append(_key[1])
+        self._graph.add(resource)
+        return True
+
+    def _build_index(self) -> None:
+        """
+        Build the resource index for the bundle in a single pass
+        """
+        self._index = {}
+        self._entities = {}
+        self._graph = ReferenceGraph()
+        if self._bundle is None:
+            return
+        for entry in self._entries():
+            self._index_entry(entry)
 
     @property
     def synthea_bridge(self):
@@ -58,10 +117,6 @@ class SourcedBundle:
 
     @property
     def plan_definitions(self) -> List[str]:
-        if 'PlanDefinition' not in self._entities:
-            for entry in self._bundle.entry:
-                if entry.resource.resource_type == 'PlanDefinition':
-                    self._entities.setdefault('PlanDefinition', []).append(entry.resource.id)
         return self._entities.get('PlanDefinition', [])
 
     @property
@@ -69,10 +124,6 @@ class SourcedBundle:
         """
         Extracts the list of subjects from the bundle
         """
-        if 'ResearchSubject' not in self._entities:
-            for entry in self._bundle.entry:
-                if entry.resource.resource_type == 'ResearchSubject':
-                    self._entities.setdefault('ResearchSubject', []).append(entry.resource.id)
         return self._entities.get('ResearchSubject', [])
 
     @property
@@ -80,227 +131,394 @@ class SourcedBundle:
         """
         Extracts the list of studies from the bundle
         """
-        if 'ResearchStudy' not in self._entities:
-            for entry in self._bundle.entry:
-                if entry.resource.resource_type == 'ResearchStudy':
-                    self._entities.setdefault('ResearchStudy', []).append(entry.resource.id)
         return self._entities.get('ResearchStudy', [])
 
     @property
-    def patients(self) -> List[Patient]:
+    def patients(self) -> List[str]:
         """
         Extracts the list of patients from the bundle
         """
-        if 'Patient' not in self._entities:
-            for entry in self._bundle.entry:
-                if entry.resource.resource_type == 'Patient':
-                    self._entities.setdefault('Patient', []).append(entry.resource.id)
         return self._entities.get('Patient', [])
 
+    def resource_ids(self, resource_type: str) -> List[str]:
+        """
+        Get the ids for all resources of a type
+        """
+        return self._entities.get(resource_type, [])
+
+    def resource_dicts(self) -> Iterator[dict]:
+        """
+        Iterate over the JSON representations of the resources in the bundle
+        """
+        for resource_type, resource_id in list(self._index):
+            yield self.get_resource_dict(resource_type, resource_id)
+
+    def get_resource(self, resource_type: str, resource_id: str) -> Optional[Resource]:
+        """
+        Get a Resource by type and id
+        """
+        _key = (resource_type, resource_id)
+        entry = self._index.get(_key)
+        if entry is None:
+            return None
+        if isinstance(entry, dict):
+            if _key not in self._models:
+                self._temporal.collect(entry["resource"])
+                self._models[_key] = validate_resource(entry["resource"])
+            return self._models[_key]
+        return entry.resource
+
+    def get_resource_dict(self, resource_type: str, resource_id: str) -> Optional[dict]:
+        """
+        Get the JSON representation of a Resource
+        """
+        _key = (resource_type, resource_id)
+        entry = self._index.get(_key)
+        if entry is None:
+            return None
+        if _key in self._models:
+            return resource_dict(self._models[_key])
+        if isinstance(entry, dict):
+            return entry["resource"]
+        return resource_dict(entry.resource)
+
+    def get_entry_dict(self, resource_type: str, resource_id: str) -> Optional[dict]:
+        """
+        Get the JSON representation of a bundle entry
+        """
+        entry = self._index.get((resource_type, resource_id))
+        if entry is None:
+            return None
+        _entry = dict(resource=self.get_resource_dict(resource_type, resource_id))
+        if isinstance(entry, dict):
+            request = entry.get("request")
+        else:
+            request = resource_dict(entry.request) if entry.request else None
+        if request:
+            _entry["request"] = request
+        return _entry
+
+    def common_resource_keys(self) -> List[tuple]:
+        """
+        The (resource type, id) keys of the design (shared) resources
+        """
+        return [key for key in self._index if is_common_resource(key[0])]
+
+    def has_resource(self, resource_type: str, resource_id: str) -> bool:
+        """
+        Check whether a Resource is already in the bundle
+        """
+        return (resource_type, resource_id) in self._index
+
+    def references(self, resource_type: str, resource_id: str,
+                   element: Optional[str] = None) -> List[str]:
+        """
+        Get the references (ResourceType/id) made by a resource
+        """
+        return self._graph.references(resource_type, resource_id, element)
+
+    def referencing_keys(self, target: str,
+                         element: Optional[str] = None,
+                         resource_type: Optional[str] = None) -> List[tuple]:
+        """
+        Get the (resource type, id) keys for the resources referencing the target
+        """
+        return self._graph.referencing(target, element, resource_type)
+
+    def referencing(self, target: str,
+                    element: Optional[str] = None,
+                    resource_type: Optional[str] = None) -> List[Resource]:
+        """
+        Get all the resources referencing the target (ResourceType/id)
+        """
+        return [self.get_resource(*key) for key in self._graph.referencing(target, element, resource_type)]
+
+    def subject_resources(self, patient_id: str) -> List[Resource]:
+        """
+        Get all the resources where the Patient is the subject
+        """
+        return self.referencing(f"Patient/{patient_id}", element='subject')
+
+    def visit_resources(self, care_plan_id: str) -> List[Resource]:
+        """
+        Get the ServiceRequest and Encounter resources based on a CarePlan
+        """
+        return [self.get_resource(*key) for key in self._graph.cascade(f"CarePlan/{care_plan_id}")]
+
     def subject(self, subject_id: str) -> Optional[ResearchSubject]:
         """
-        Get a Patient Resource
+        Get a ResearchSubject Resource
         """
-        for entry in self._bundle.entry:
-            if entry.resource.resource_type == 'ResearchSubject' and entry.resource.id == subject_id:
-                return entry.resource
-        return None
+        return self.get_resource('ResearchSubject', subject_id)
 
     def patient(self, patient_id: str) -> Optional[Patient]:
         """
         Get a Patient Resource
         """
-        for entry in self._bundle.entry:
-            if entry.resource.resource_type == 'Patient' and entry.resource.id == patient_id:
-                return entry.resource
-        return None
+        return self.get_resource('Patient', patient_id)
 
     def study(self, study_id: str) -> Optional[ResearchStudy]:
         """
         Get a Study Resource
         """
-        for entry in self._bundle.entry:
-            if entry.resource.resource_type == 'ResearchStudy' and entry.resource.id == study_id:
-                return entry.resource
-        return None
+        return self.get_resource('ResearchStudy', study_id)
+
+    def _sync(self) -> None:
+        """
+        Write the materialised models back to the raw entries
+        """
+        for _key, model in self._models.items():
+            entry = self._index.get(_key)
+            if entry is not None:
+                entry["resource"] = loads(dumps(model.dict(), default=self._encoder))
 
     @property
     def bundle(self) -> Bundle:
-        if not isinstance(self._bundle, Bundle):
+        if self.raw:
+            # typed access to the whole bundle, so leave the raw mode
+            self._sync()
+            self._temporal.collect(self._bundle)
+            self._bundle = Bundle.parse_obj(self._bundle)
+            self._models = {}
+            self._build_index()
+        elif not isinstance(self._bundle, Bundle):
             # create a new bundle
-            self._bundle = Bundle(id=self._identifier, type="transaction")
+            self._bundle = Bundle(id=self._identifier, type="transaction", entry=[])
+            self._build_index()
         return self._bundle
 
+    @property
+    def _encoder(self):
+        # write the dates and times as they were read
+        return self._temporal.default if self._temporal else None
+
+    def _header(self, bundle: Optional[Bundle] = None) -> dict:
+        """
+        The top level elements of the bundle (other than the entries)
+        """
+        if bundle is None and self.raw:
+            return {k: v for k, v in self._bundle.items() if k != "entry"}
+        bundle = bundle if bundle else self.bundle
+        return bundle.copy(update={"entry": None}).dict()
+
+    def _entry_dicts(self, bundle: Optional[Bundle] = None) -> Iterator[dict]:
+        if bundle is None and self.raw:
+            self._sync()
+            yield from self._bundle.get("entry", [])
+        else:
+            bundle = bundle if bundle else self.bundle
+            for entry in bundle.entry or []:
+                yield entry.dict()
+
     def dump(self, target_dir: Optional[str] = None,
              name: Optional[str] = None,
-             bundle: Optional[Bundle] = None) -> None:
+             bundle: Optional[Bundle] = None,
+             validate: bool = False,
+             fmt: str = "json",
+             compact: bool = False,
+             compress: bool = False) -> str:
         """
-        Dumps a bundle to a directory
+        Dumps a bundle to a directory, returning the file name
+        @param validate: validate the content before it is written
+        @param fmt: json (a Bundle) or ndjson (one resource per line)
+        @param compact: no indentation
+        @param compress: gzip the output
         """
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown format {fmt}")
         if name:
-            _fname = name + ".json"
+            _fname = output_filename(name, fmt, compress)
         else:
-            _fname = self.filename
+            _fname = output_filename(os.path.splitext(self.filename)[0], fmt, compress)
         if target_dir:
             if not os.path.exists(target_dir):
                 os.makedirs(target_dir)
             fname = os.path.join(target_dir, _fname)
         else:
             fname = os.path.join(self.dirname, _fname)
-        with open(fname, 'w') as f:
-            if bundle:
-                f.write(bundle.json(indent=2))
+        if validate:
+            Bundle.parse_obj(dict(self._header(bundle), entry=list(self._entry_dicts(bundle))))
+        with open_output(fname, compress) as f:
+            if fmt == "ndjson":
+                write_ndjson(f, (entry["resource"] for entry in self._entry_dicts(bundle)), default=self._encoder)
             else:
-                f.write(self._bundle.json(indent=True))
+                write_json(f, self._header(bundle), self._entry_dicts(bundle), indent=not compact,
+                           default=self._encoder)
+        return fname
 
     def add_lab_value(self, subject_id: Optional[str] = None):
         subject_id = subject_id or random.choice(self.subjects)
-        if subject_id not in self.subjects:
-            raise ValueError(f"Subject {subject_id} does not exist")
-        # get the patient ID
-        patient_id = self.subject(subject_id).individual.reference.split('/')[-1]
-        lab_obs = self.synthea_bridge.get_lab_observation()
-        lab_obs.subject.reference = f"Patient/{patient_id}"
-        lab_obs.fhir_comments = ["This is a synthetic observation"]
-        # remove the encounter reference
-        del lab_obs.encounter
-        # sanitise the lab observation
-        self.add_resource(lab_obs)
+        self.add_observations([subject_id], 1, 'laboratory')
 
     def add_vitals_value(self, subject_id: Optional[str] = None):
         subject_id = subject_id or random.choice(self.subjects)
-        if subject_id not in self.subjects:
-            raise ValueError(f"Subject {subject_id} does not exist")
-        # get the patient ID
-        patient_id = self.subject(subject_id).individual.reference.split('/')[-1]
-        vital_obs = self.synthea_bridge.get_vital_observation()
-        vital_obs.subject.reference = f"Patient/{patient_id}"
-        vital_obs.fhir_comments = ["This is a synthetic observation"]
-        # remove the encounter reference
-        del vital_obs.encounter
-        # sanitise the lab observation
-        self.add_resource(vital_obs)
+        self.add_observations([subject_id], 1, 'vital-signs')
+
+    def _subject_encounters(self, patient_id: str) -> List[tuple]:
+        """
+        The (start, Encounter id) for the subject's Encounters with a start date
+        """
+        encounters = []
+        for resource_type, resource_id in self.referencing_keys(f"Patient/{patient_id}", 'subject', 'Encounter'):
+            start = (self.get_resource_dict(resource_type, resource_id).get("period") or {}).get("start")
+            if start:
+                encounters.append((start, resource_id))
+        return sorted(encounters)
+
+    def add_observations(self, subject_ids: Optional[List[str]] = None,
+                         n: int = 1,
+                         category: str = 'laboratory',
+                         distribution: Union[str, dict] = "uniform",
+                         bind_encounter: bool = False,
+                         seed=None,
+                         validate: bool = False) -> AddedResources:
+        """
+        Adds n synthetic (Synthea) observations for each subject in one batch, returning the counts
+        @param subject_ids: the subjects (defaults to all the subjects in the bundle)
+        @param category: the Observation category (laboratory or vital-signs)
+        @param distribution: how the observations are sampled (see ObservationCatalogue.sample)
+        @param bind_encounter: attach each observation to one of the subject's Encounters (and its date)
+        @param seed: makes the sampling reproducible
+        """
+        rng = random.Random(seed)
+        subject_ids = subject_ids if subject_ids else self.subjects
+        patients = []
+        for subject_id in subject_ids:
+            subject = self.get_resource_dict('ResearchSubject', subject_id)
+            if subject is None:
+                raise ValueError(f"Subject {subject_id} does not exist")
+            patients.append(subject["individual"]["reference"].split('/')[-1])
+        catalogue = self.synthea_bridge.catalogue
+        # one sample (and one read per file) for the whole batch
+        observations = catalogue.read_many(catalogue.sample(category, n * len(patients), distribution, rng))
+        resources = []
+        for offset, patient_id in enumerate(patients):
+            encounters = self._subject_encounters(patient_id) if bind_encounter else []
+            for idx in range(n):
+                resource = observations[offset * n + idx]
+                resource["id"] = hh(f"{patient_id}-{category}-{resource['id']}-{idx}")
+                resource["subject"] = dict(reference=f"Patient/{patient_id}")
+                resource["fhir_comments"] = ["This is a synthetic observation"]
+                # remove the Synthea encounter reference
+                resource.pop("encounter", None)
+                if encounters:
+                    start, encounter_id = rng.choice(encounters)
+                    resource["encounter"] = dict(reference=f"Encounter/{encounter_id}")
+                    resource.pop("effectivePeriod", None)
+                    resource["effectiveDateTime"] = start
+                    # the Synthea issue time no longer applies
+                    resource.pop("issued", None)
+                resources.append(resource)
+        return self.add_resources(resources, validate=validate)
 
     def add_resource(self, resource: Resource):
         """
         Adds a resource to the bundle
         """
-        for entry in self._bundle.entry:
-            if entry.resource.resource_type == resource.resource_type and entry.resource.id == resource.id:
-                print(f"Resource {resource.resource_type}/{resource.id} already exists in bundle")
-                return
+        if self.has_resource(resource.resource_type, resource.id):
+            print(f"Resource {resource.resource_type}/{resource.id} already exists in bundle")
+            return
+        print("Adding resource to bundle: {}".format(resource.resource_type))
+        self._append(resource)
+
+    def _append(self, resource: Union[dict, Resource], validate: bool = True) -> None:
+        if self.raw:
+            if isinstance(resource, dict):
+                entry = dict(resource=resource,
+                             request=upsert_request(resource["resourceType"], resource["id"]))
+            else:
+                entry = dict(resource=resource_dict(resource),
+                             request=upsert_request(resource.resource_type, resource.id))
+                # keep the model, so later changes are written back
+                self._models[(resource.resource_type, resource.id)] = resource
         else:
-            print("Adding resource to bundle: {}".format(resource.resource_type))
-            entry = BundleEntry(resource=resource,
-                                request=BundleEntryRequest(method="PUT",
-                                                           url=f"{resource.resource_type}/{resource.id}",
-                                                           ifNoneExist=f"identifier={resource.id}"))
-            self._bundle.entry.append(entry)
+            if isinstance(resource, dict):
+                resource = validate_resource(resource) if validate else construct_resource(resource)
+            entry = upsert_entry(resource, validate)
+        self._entries().append(entry)
+        self._index_entry(entry)
+
+    def add_resources(self, resources: Iterable[Union[dict, Resource]], validate: bool = True) -> AddedResources:
+        """
+        Adds a batch of resources (models or resource dicts) to the bundle, skipping
+        those already present; returns the numbers added and skipped
+        @param validate: validate the resource dicts, otherwise they are used as is
+        """
+        added = skipped = 0
+        for resource in resources:
+            if self.has_resource(*resource_key(resource)):
+                skipped += 1
+                continue
+            if self.raw and validate and isinstance(resource, dict):
+                validate_resource(resource)
+            self._append(resource, validate)
+            added += 1
+        return AddedResources(added, skipped)
+
+    def remove_resource(self, resource_type: str, resource_id: str) -> Optional[Resource]:
+        """
+        Removes a resource from the bundle, returning the removed resource
+        """
+        _key = (resource_type, resource_id)
+        if _key not in self._index:
+            return None
+        resource = self.get_resource(resource_type, resource_id)
+        entry = self._index.pop(_key)
+        self._models.pop(_key, None)
+        self._entities[resource_type].remove(resource_id)
+        self._graph.remove(resource_type, resource_id)
+        # identity match, avoids comparing the models field by field
+        entries = self._entries()
+        for idx, _entry in enumerate(entries):
+            if _entry is entry:
+                del entries[idx]
+                break
+        return resource
 
     def clone_subject(self, new_subject_id: str) -> SourcedBundle:
         """
         Clones a patient by taking a random subject in the bundle and creating a new patient with the new_patient_id
         """
-        # get a random subject
-        _subject_id = random.choice(self.subjects)
-        _subject = self.subject(_subject_id)
-        # Get the old subject ID
-        _old_subject_id = _subject.id
-        # get the patient identifer
-        _patient_id = _subject.individual.reference.split('/')[-1]
-        # hashed id
-        _new_patient_id = hashlib.md5(new_subject_id.encode('utf-8')).hexdigest()
-        # create a new bundle
-        _bundle = Bundle(id=str(uuid.uuid4()), type="transaction", entry=[])
-        id_cache = {}
-        for entry in self._bundle.entry:  # type: BundleEntry
-            if entry.resource.resource_type == 'Patient' and entry.resource.id == _patient_id:
-                # remap the patient
-                patient = entry.resource.copy()  # type: Patient
-                # clone the patient
-                patient.id = _new_patient_id
-                # randomise
-                # Randomise the date of birth
-                patient.birthDate = randomise_date(patient.birthDate)
-                # randonise gender
-                _gender = random.choice(["male", "female"])
-                patient.gender = _gender
-                link = PatientLink(type='refer', other=Reference(reference=f"Patient/{_old_subject_id}"))
-                if not getattr(resource, 'link'):
-                    resource.link = []
-                patient.link.append(link)
-                patient.fhir_comments = ["Cloned from Subject {}".format(_old_subject_id)]
-                _entry = BundleEntry(resource=patient,
-                                     request=BundleEntryRequest(method="PUT",
-                                                                url=f"{resource.resource_type}/{resource.id}",
-                                                                ifNoneExist=f"identifier={resource.id}"))
-
-                # add the patient to the bundle
-                _bundle.entry.append(_entry)
-            elif entry.resource.resource_type == 'ResearchSubject' \
-                    and entry.resource.id == _subject.id:
-                resource = entry.resource.copy()
-                # clone the subject
-                resource.id = new_subject_id
-                resource.individual.reference = f"Patient/{_new_patient_id}"
-
-                _entry = BundleEntry(resource=resource,
-                                     request=BundleEntryRequest(method="PUT",
-                                                                url=f"{resource.resource_type}/{resource.id}",
-                                                                ifNoneExist=f"identifier={resource.id}"))
-
-                # add the subject to the bundle
-                _bundle.entry.append(_entry)
-            elif entry.resource.resource_type in ("ResearchStudy", "Group", "Organization",
-                                                  "Practitioner", "Medication") \
-                    or entry.resource.resource_type.endswith('Definition'):
-                # add the common entities to the bundle
-                _bundle.entry.append(entry)
-            elif entry.resource.subject.reference == f"Patient/{_patient_id}":
-                # id resources where the subject is the patient
-                resource = entry.resource.copy()
-                resource.subject.reference = f"Patient/{_new_patient_id}"
-                if getattr(resource.subject, 'display', None):
-                    resource.subject.display = new_subject_id
-                if resource.resource_type == "CarePlan":
-                    # clear this up
-                    resource.title = resource.title.replace(_subject_id, new_subject_id)
-
-                # need a deterministic id
-                hashed_id = hashlib.md5(
-                    f"{_patient_id}-{resource.resource_type}-{resource.id}".encode('utf-8')).hexdigest()
-                # need to map the IDs
-                resource.id = hashed_id
-                if getattr(resource, 'contained', None):
-                    for contained in resource.contained:
-                        # Look for contained references
-                        if hasattr(contained, 'subject'):
-                            # map to the new ID
-                            contained.subject.reference = f"Patient/{_new_patient_id}"
-                _entry = BundleEntry(resource=resource,
-                                     request=BundleEntryRequest(method="PUT",
-                                                                url=f"{resource.resource_type}/{resource.id}",
-                                                                ifNoneExist=f"identifier={resource.id}"))
-                # add the cloned entity
-                _bundle.entry.append(_entry)
-            instance = SourcedBundle(bundle=_bundle,
-                                     identifier=str(_bundle.identifier),
-                                     filename=self.filename.replace(_old_subject_id, _new_patient_id))
-        return instance
+        plan = ClonePlan(self, random.choice(self.subjects))
+        bundle = plan.clone(new_subject_id)
+        return SourcedBundle(bundle=bundle,
+                             identifier=bundle["id"],
+                             filename=plan.output_name(new_subject_id) + ".json")
+
+    def clone_many(self, new_subject_ids: List[str],
+                   target_dir: Optional[str] = None,
+                   subject_id: Optional[str] = None,
+                   seed=None,
+                   jobs: int = 1,
+                   **dump_options):
+        """
+        Clones a subject for each of the new subject ids, the clones are written to the target_dir as
+        they are generated; see cloner.clone_many
+        """
+        return clone_many(self, new_subject_ids, target_dir, subject_id, seed, jobs, **dump_options)
 
     @classmethod
-    def from_bundle_file(cls, filename: str):
+    def from_bundle_file(cls, filename: str, raw: bool = False):
         """
         Convert a FHIR Bundle to a SourcedBundle
+        @param raw: keep the resources as parsed JSON (no validation)
         """
         if not os.path.exists(filename):
             raise ValueError("File does not exist")
-        bundle = Bundle.parse_file(filename)
-        return cls(bundle, bundle.id, filename)
+        with open(filename, 'r', encoding='utf-8') as f:
+            content = json.load(f)
+        if raw:
+            return cls(content, content.get("id"), filename)
+        sourced = cls(Bundle.parse_obj(content), content.get("id"), filename)
+        # so the dump writes the dates and times as they were read
+        sourced._temporal.collect(content)
+        return sourced
 
     @classmethod
-    def from_bundle(cls, bundle: Bundle):
+    def from_bundle(cls, bundle: Union[Bundle, dict]):
         """
-        Convert a FHIR Bundle to a SourcedBundle
+        Convert a FHIR Bundle (or the parsed JSON for one) to a SourcedBundle
         """
-        return cls(bundle, bundle.id)
+        if isinstance(bundle, dict):
+            return cls(bundle, bundle.get("id"), None)
+        return cls(bundle, bundle.id, None)
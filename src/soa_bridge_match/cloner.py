@@ -0,0 +1,278 @@
+from __future__ import annotations
+
+import copy
+import datetime
+import hashlib
+import os
+import random
+import re
+import uuid
+from typing import TYPE_CHECKING, Iterator, List, Optional
+
+from .models import upsert_request
+from .runner import run_parallel
+from .serialise import FORMATS, dumps, loads, open_output, output_filename, write_json, write_ndjson
+
+if TYPE_CHECKING:
+    from .bundler import SourcedBundle
+
+
+def hh(s: str) -> str:
+    return hashlib.md5(s.encode('utf-8')).hexdigest()
+
+
+def randomise_date(date: datetime.date, rng: random.Random = random) -> datetime.date:
+    _date = None
+    if rng.random() > 0.5:
+        _date = date + datetime.timedelta(rng.randint(10, 2000))
+    else:
+        _date = date - datetime.timedelta(rng.randint(10, 2000))
+    return _date
+
+
+def clone_rng(seed, new_subject_id: str) -> random.Random:
+    """
+    A generator per clone, so the clone only depends on the seed and the subject id
+    """
+    if seed is None:
+        return random.Random()
+    return random.Random(f"{seed}-{new_subject_id}")
+
+
+# marks the values that are filled in for each clone
+SLOT = "@@clone:{}@@"
+_SLOT = re.compile(rb"@@clone:(\d+)@@")
+
+# the slots shared by every template
+PATIENT_SLOT = 0
+SUBJECT_SLOT = 1
+
+
+class EntryTemplate:
+    """
+    A bundle entry rendered to JSON once, with slots for the values that change
+    for each clone; a clone is serialised by splicing the values into the segments
+    """
+
+    def __init__(self, entry: dict) -> None:
+        self._entry = entry
+        self._segments = {}
+
+    def segments(self, part: str = "entry", indent: bool = False) -> list:
+        """
+        The rendered literal segments, with the slot numbers between them
+        """
+        key = (part, indent)
+        if key not in self._segments:
+            data = self._entry if part == "entry" else self._entry["resource"]
+            segments = _SLOT.split(dumps(data, indent))
+            segments[1::2] = [int(x) for x in segments[1::2]]
+            self._segments[key] = segments
+        return self._segments[key]
+
+    def render(self, values: List[bytes], part: str = "entry", indent: bool = False) -> bytes:
+        """
+        Serialise the entry (or the resource for part='resource') for a clone
+        @param values: the JSON encoded values for the slots
+        """
+        segments = self.segments(part, indent)
+        if len(segments) == 1:
+            return segments[0]
+        return b"".join(values[x] if isinstance(x, int) else x for x in segments)
+
+
+def _slot_value(value: str) -> bytes:
+    # the slots sit inside JSON strings
+    return dumps(value)[1:-1]
+
+
+class ClonePlan:
+    """
+    The resources of a template subject, collected once, and the plan to remap
+    them for each clone
+    """
+
+    def __init__(self, bundle: SourcedBundle, subject_id: Optional[str] = None) -> None:
+        self.subject_id = subject_id if subject_id else bundle.subjects[0]
+        self._subject = bundle.get_resource_dict('ResearchSubject', self.subject_id)
+        if self._subject is None:
+            raise ValueError(f"Subject {self.subject_id} does not exist")
+        self.patient_id = self._subject["individual"]["reference"].split('/')[-1]
+        self._patient = bundle.get_resource_dict('Patient', self.patient_id)
+        self.filename = bundle.filename
+        # the design entities are shared by the clones
+        self._common = [EntryTemplate(bundle.get_entry_dict(*key)) for key in bundle.common_resource_keys()]
+        # resources where the subject is the patient, the new ids are derived from the keys
+        owned = [bundle.get_resource_dict(*key)
+                 for key in bundle.referencing_keys(f"Patient/{self.patient_id}", element='subject')]
+        self._owned_keys = [f"{x['resourceType']}-{x['id']}" for x in owned]
+        slots = {f"{x['resourceType']}/{x['id']}": f"{x['resourceType']}/{SLOT.format(idx + 2)}"
+                 for idx, x in enumerate(owned)}
+        self._owned = [EntryTemplate(self.template_entry(x, slots)) for x in owned]
+
+    def __len__(self) -> int:
+        return len(self._owned) + len(self._common) + 2
+
+    def output_name(self, new_subject_id: str) -> str:
+        """
+        The file name for a clone (without the extension)
+        """
+        name = os.path.splitext(self.filename)[0]
+        if self.subject_id in name:
+            return name.replace(self.subject_id, new_subject_id)
+        return f"{name}_{new_subject_id}"
+
+    def template_entry(self, resource: dict, slots: dict) -> dict:
+        """
+        Replace the values that change for each clone with slots (the resource is copied once)
+        """
+        resource = copy.deepcopy(resource)
+        if "subject" in resource:
+            resource["subject"]["reference"] = f"Patient/{SLOT.format(PATIENT_SLOT)}"
+            if resource["subject"].get("display"):
+                resource["subject"]["display"] = SLOT.format(SUBJECT_SLOT)
+        if resource["resourceType"] == "CarePlan" and resource.get("title"):
+            # clear this up
+            resource["title"] = resource["title"].replace(self.subject_id, SLOT.format(SUBJECT_SLOT))
+        resource["id"] = slots[f"{resource['resourceType']}/{resource['id']}"].split('/')[-1]
+        # rebind the visit cascade to the cloned resources
+        for element in ('basedOn', 'encounter'):
+            value = resource.get(element)
+            for reference in (value if isinstance(value, list) else [value]):
+                if reference and reference.get("reference") in slots:
+                    reference["reference"] = slots[reference["reference"]]
+        for contained in resource.get("contained", []):
+            # Look for contained references
+            if "subject" in contained:
+                # map to the new ID
+                contained["subject"]["reference"] = f"Patient/{SLOT.format(PATIENT_SLOT)}"
+        return dict(resource=resource, request=upsert_request(resource["resourceType"], resource["id"]))
+
+    def slot_values(self, new_subject_id: str, new_patient_id: str) -> List[bytes]:
+        """
+        The values for the template slots; the new ids hash the new patient id with the
+        template key (the original clone hashed the template patient id, so every clone of
+        a template got the same ids)
+        """
+        values = [_slot_value(new_patient_id), _slot_value(new_subject_id)]
+        values.extend(_slot_value(hh(f"{new_patient_id}-{key}")) for key in self._owned_keys)
+        return values
+
+    def prepare(self, fmt: str = "json", compact: bool = False) -> None:
+        """
+        Render the templates up front (eg before the worker processes are forked)
+        """
+        part, indent = ("resource", False) if fmt == "ndjson" else ("entry", not compact)
+        for template in self._owned + self._common:
+            template.segments(part, indent)
+
+    def clone_patient(self, new_subject_id: str, new_patient_id: str, rng: random.Random) -> dict:
+        patient = copy.deepcopy(self._patient)
+        patient["id"] = new_patient_id
+        # Randomise the date of birth (partial dates are left alone)
+        birth_date = patient.get("birthDate")
+        if birth_date and len(birth_date) == 10:
+            patient["birthDate"] = randomise_date(datetime.date.fromisoformat(birth_date), rng).isoformat()
+        # randonise gender
+        patient["gender"] = rng.choice(["male", "female"])
+        patient.setdefault("link", []).append(dict(type='refer', other=dict(reference=f"Patient/{self.patient_id}")))
+        patient["fhir_comments"] = ["Cloned from Subject {}".format(self.subject_id)]
+        return patient
+
+    def clone_subject(self, new_subject_id: str, new_patient_id: str) -> dict:
+        subject = copy.deepcopy(self._subject)
+        subject["id"] = new_subject_id
+        subject["individual"]["reference"] = f"Patient/{new_patient_id}"
+        return subject
+
+    def rendered(self, new_subject_id: str,
+                 rng: Optional[random.Random] = None,
+                 part: str = "entry",
+                 indent: bool = False) -> Iterator[bytes]:
+        """
+        The serialised entries (or resources) for a clone
+        """
+        rng = rng if rng else random.Random()
+        new_patient_id = hh(new_subject_id)
+        for resource in (self.clone_patient(new_subject_id, new_patient_id, rng),
+                         self.clone_subject(new_subject_id, new_patient_id)):
+            if part == "entry":
+                resource = dict(resource=resource, request=upsert_request(resource["resourceType"], resource["id"]))
+            yield dumps(resource, indent)
+        values = self.slot_values(new_subject_id, new_patient_id)
+        for template in self._owned:
+            yield template.render(values, part, indent)
+        for template in self._common:
+            yield template.render(values, part, indent)
+
+    def clone(self, new_subject_id: str, rng: Optional[random.Random] = None) -> dict:
+        """
+        Generate the bundle (as dict) for a clone
+        """
+        rng = rng if rng else random.Random()
+        bundle_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        return dict(resourceType="Bundle",
+                    id=bundle_id,
+                    type="transaction",
+                    entry=[loads(x) for x in self.rendered(new_subject_id, rng)])
+
+    def dump(self, new_subject_id: str, target_dir: str,
+             seed=None,
+             fmt: str = "json",
+             compact: bool = False,
+             compress: bool = False) -> str:
+        """
+        Write a clone straight to a file, returning the file name
+        """
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown format {fmt}")
+        rng = clone_rng(seed, new_subject_id)
+        header = dict(resourceType="Bundle",
+                      id=str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                      type="transaction")
+        fname = os.path.join(target_dir, output_filename(self.output_name(new_subject_id), fmt, compress))
+        with open_output(fname, compress) as f:
+            if fmt == "ndjson":
+                write_ndjson(f, self.rendered(new_subject_id, rng, part="resource"))
+            else:
+                write_json(f, header, self.rendered(new_subject_id, rng, indent=not compact), indent=not compact)
+        return fname
+
+
+# the plan for the worker processes
+_plan = None
+
+
+def _set_plan(plan: ClonePlan) -> None:
+    global _plan
+    _plan = plan
+
+
+def _dump_clone(new_subject_id: str, target_dir: str, seed, fmt: str, compact: bool, compress: bool) -> str:
+    return _plan.dump(new_subject_id, target_dir, seed, fmt, compact, compress)
+
+
+def clone_many(bundle: SourcedBundle, new_subject_ids: List[str],
+               target_dir: Optional[str] = None,
+               subject_id: Optional[str] = None,
+               seed=None,
+               jobs: int = 1,
+               fmt: str = "json",
+               compact: bool = False,
+               compress: bool = False):
+    """
+    Clone a template subject once for each of the new subject ids, writing each
+    clone as it is generated
+    @param bundle: the template bundle
+    @param subject_id: the template subject (defaults to the first subject)
+    @param seed: makes the generated clones reproducible
+    @param jobs: the number of worker processes
+    """
+    plan = ClonePlan(bundle, subject_id)
+    target_dir = target_dir if target_dir else bundle.dirname
+    os.makedirs(target_dir, exist_ok=True)
+    plan.prepare(fmt, compact)
+    _set_plan(plan)
+    return run_parallel(_dump_clone, new_subject_ids, jobs=jobs,
+                        args=(target_dir, seed, fmt, compact, compress),
+                        initializer=_set_plan, initargs=(plan,))
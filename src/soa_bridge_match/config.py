@@ -1,9 +1,14 @@
 
+import os
+
+import numpy as np
 import pandas as pd
-from typing import List
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 import yaml
 
+from .connector import ARTIFACT_DIR, ArtifactCache, file_digest
+
 
 class Configuration:
 
@@ -17,38 +22,178 @@ class Configuration:
         """
         with open(filename, "r") as f:
             config = yaml.safe_load(f)
-        return cls(**config)
+        return cls(config)
     
     def columns(self):
         for column in self._config["columns"]:
             yield column
+
+    def mappings(self) -> Dict[str, Optional[dict]]:
+        """
+        The FHIR mappings (resource type -> element path) by column
+        """
+        return self._config["columns"]
     
     def keys(self) -> List[str]:
-        return self._config["keys"]
+        keys = self._config["key"]
+        return [keys] if isinstance(keys, str) else keys
+
+    def id_columns(self) -> Optional[List[str]]:
+        """
+        The columns identifying a record, if the key and sequence don't
+        """
+        return self._config.get("id")
+
+
+# the LOINC to LB mapping from the LOINC/CDISC working group
+LOINC_MAPPING = os.getenv("CDISCPILOT_LOINC_MAPPING",
+                          os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "doc", "resources",
+                                       "LOINC_to_LB_Mapping Document_FINAL.csv"))
 
+# bump when the layout of the index changes
+LOINC_INDEX_VERSION = 3
+
+# the index key
+INDEX_KEY = ["LBTESTCD", "SYSTEM", "UNIT"]
+
+# the LOINC systems for each LBCAT, in order of preference
+CATEGORY_SYSTEMS = {"HEMATOLOGY": ('Ser/Plas', 'Plas', 'Bld'),
+                    "URINALYSIS": ('Urine',),
+                    "CHEMISTRY": ('Ser/Plas', 'Serum', 'Ser', 'Ser/Plas/Bld')}
+
+
+def normalise_unit(unit) -> str:
+    """
+    Units compared without case; the mapping marks the units for qualitative tests as (Must be null)
+    """
+    if not isinstance(unit, str) or unit.upper() == "(MUST BE NULL)":
+        return ""
+    unit = unit.strip().upper()
+    return unit[len("ENZYME "):] if unit.startswith("ENZYME ") else unit
+
+
+class LoincIndex:
+    """
+    The LOINC mapping compiled into a hash index keyed by (LBTESTCD, system, unit); the
+    index is kept on disk, keyed by the content of the mapping file
+    """
+
+    def __init__(self, entries: pd.DataFrame, specimens: Dict[str, str]) -> None:
+        # LBTESTCD, SYSTEM, UNIT -> LOINC, DISPLAY
+        self.entries = entries
+        # LBSPEC -> system
+        self.specimens = specimens
+        self._lookup = {tuple(x[:3]): (x[3], x[4]) for x in entries[INDEX_KEY + ["LOINC", "DISPLAY"]].itertuples(index=False)}
+
+    def __len__(self) -> int:
+        return len(self._lookup)
+
+    def get(self, lbtestcd: str, system: str, unit: Optional[str] = None) -> Optional[Tuple[str, str]]:
+        """
+        The LOINC code and display for a test
+        """
+        return self._lookup.get((lbtestcd.upper(), system, normalise_unit(unit)))
+
+    @classmethod
+    def from_mapping(cls, path: str = LOINC_MAPPING) -> "LoincIndex":
+        """
+        Compile the mapping file; where several codes share a key the general test is used, the
+        one for a point in time (spot) sample without a fasting flag, time point or method
+        """
+        mapping = pd.read_csv(path, dtype=str)
+        entries = pd.DataFrame({"LBTESTCD": mapping["CDISC LBTESTCD"].str.strip().str.upper(),
+                                "SYSTEM": mapping["System"].str.strip(),
+                                "UNIT": mapping["EXAMPLE CDISC LBORRESU"].map(normalise_unit),
+                                "LOINC": mapping["LOINC Code"].str.strip(),
+                                "DISPLAY": mapping["LOINC Short Name"].str.strip()})
+        specific = (mapping["CDISC LBFAST"].notna().astype(int) + mapping["CDISC LBTPT"].notna().astype(int) +
+                    mapping["Method"].notna().astype(int) +
+                    (mapping["Time Aspect"].str.strip() != "Pt").astype(int))
+        entries = entries[entries.LBTESTCD.notna() & entries.LOINC.notna()].assign(_specific=specific)
+        entries = entries.sort_values("_specific", kind="stable").drop_duplicates(INDEX_KEY)
+        specimens = (pd.DataFrame({"LBSPEC": mapping["CDISC LBSPEC"].str.strip().str.upper(),
+                                   "SYSTEM": mapping["System"].str.strip()})
+                     .dropna().groupby("LBSPEC").SYSTEM.agg(lambda x: x.value_counts().index[0]).to_dict())
+        return cls(entries.drop(columns="_specific").reset_index(drop=True), specimens)
+
+    @classmethod
+    def load(cls, path: str = LOINC_MAPPING, cache_dir: Optional[str] = ARTIFACT_DIR) -> "LoincIndex":
+        """
+        Get the index for the mapping file, compiling it only if the file has changed
+        @param cache_dir: where the compiled index is kept (None to skip the cache)
+        """
+        cache = ArtifactCache(cache_dir)
+        name = f"loinc-index-{file_digest(path)}"
+        data = cache.get(name, LOINC_INDEX_VERSION)
+        if data is not None:
+            return cls(data["entries"], data["specimens"])
+        index = cls.from_mapping(path)
+        cache.put(name, LOINC_INDEX_VERSION, dict(entries=index.entries, specimens=index.specimens))
+        return index
+
+
+class LoincMatch(NamedTuple):
+    # LOINC and DISPLAY for each row of the domain (None where unmapped)
+    codes: pd.DataFrame
+    # the combinations without a code, with the number of rows
+    unmapped: pd.DataFrame
 
-LBCAT = {'HEMATOLOGY'}
 
 class TestCodeMapper:
     
-    def __init__(self, config: Configuration):
+    def __init__(self, config: Optional[Configuration] = None, index: Optional[LoincIndex] = None):
         self._config = config
-        self._dataset = None
+        self._index = index
     
     @property
-    def dataset(self):
-        if not self._dataset:
-            self._dataset = pd.load_csv("resources/LOINC_to_LB_Mapping Document_FINAL.csv")
-        return self._dataset
-
-    def map(self, lbtestcd: str, lbcat: str) -> str:
-        """
-        Map a code to a test
-        """
-        if lbcat == "HEMATOLOGY":
-            system = ('Ser/Plas', 'Plas', 'Bld')
-        elif lbcat == "UNRINALYSIS":
-            system = ('Urine')
-        elif lbcat == "CHEMISTRY":
-            system = ('Ser/Plas', 'Serum', 'Ser', 'Ser/Plas/Bld')
-    
\ No newline at end of file
+    def index(self) -> LoincIndex:
+        if self._index is None:
+            self._index = LoincIndex.load()
+        return self._index
+
+    def map(self, lbtestcd: str, lbcat: str, unit: Optional[str] = None,
+            lbspec: Optional[str] = None) -> Optional[str]:
+        """
+        Map a test code to a LOINC code
+        """
+        frame = pd.DataFrame(dict(LBTESTCD=[lbtestcd], LBCAT=[lbcat], LBORRESU=[unit], LBSPEC=[lbspec]))
+        return self.map_many(frame).codes.LOINC.iloc[0]
+
+    def map_many(self, frame: pd.DataFrame, prefix: str = "LB") -> LoincMatch:
+        """
+        Map the tests of a whole domain to LOINC codes; the distinct (test, category, specimen, unit)
+        combinations are matched against the index, preferring the specimen's system, then the
+        category's systems (in order) and the same unit, and the rows are joined to the result
+        """
+        columns = dict(LBTESTCD=f"{prefix}TESTCD", LBCAT=f"{prefix}CAT", LBSPEC=f"{prefix}SPEC", UNIT=f"{prefix}ORRESU")
+        raw = pd.DataFrame({name: frame[column] if column in frame.columns else "" for name, column in columns.items()},
+                           index=frame.index).astype(object)
+        raw = raw.where(raw.notna(), "")
+        # the rows are matched through their combination, numbered in order of appearance
+        rows = raw.groupby(list(columns), sort=False).ngroup().to_numpy()
+        combinations = raw.drop_duplicates().reset_index(drop=True)
+        for name in ("LBTESTCD", "LBCAT", "LBSPEC"):
+            combinations[name] = combinations[name].astype(str).str.strip().str.upper()
+        combinations["UNIT"] = combinations.UNIT.map(normalise_unit)
+        combinations["_combination"] = range(len(combinations))
+        # every index entry for the test is a candidate
+        candidates = combinations.merge(self.index.entries.rename(columns=dict(UNIT="_UNIT")), on="LBTESTCD")
+        preferences = pd.DataFrame([(x, y, rank) for x, systems in CATEGORY_SYSTEMS.items()
+                                    for rank, y in enumerate(systems)], columns=["LBCAT", "SYSTEM", "_rank"])
+        candidates = candidates.merge(preferences, on=["LBCAT", "SYSTEM"], how="left")
+        rank = candidates._rank.fillna(len(max(CATEGORY_SYSTEMS.values(), key=len))) + 1
+        rank = rank.where(candidates.LBSPEC.map(self.index.specimens) != candidates.SYSTEM, 0)
+        # the system counts for more than the unit
+        candidates["_score"] = rank * 2 + (candidates._UNIT != candidates.UNIT)
+        best = candidates.sort_values("_score", kind="stable").drop_duplicates("_combination")
+        found = combinations[["_combination"]].merge(best[["_combination", "LOINC", "DISPLAY"]],
+                                                      on="_combination", how="left")
+        found = found.astype(object).where(found.notna(), None)
+        codes = pd.DataFrame({"LOINC": found.LOINC.to_numpy()[rows],
+                              "DISPLAY": found.DISPLAY.to_numpy()[rows]}, index=frame.index)
+        missing = found.LOINC.isna().to_numpy()
+        unmapped = combinations[missing].drop(columns="_combination").assign(
+            rows=np.bincount(rows, minlength=len(combinations))[missing]).reset_index(drop=True)
+        if len(unmapped):
+            print(f"No LOINC code for {len(unmapped)} test combinations ({unmapped.rows.sum()} rows)")
+        return LoincMatch(codes, unmapped)
@@ -1,10 +1,51 @@
-from urllib.request import urlopen
+import hashlib
+import io
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+import numpy as np
 import pandas as pd
-from typing import Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
 from pandas import DataFrame
+from dotenv import load_dotenv
 
-# define a prefix for the CDISC Pilot Datasets
-PREFIX = "https://github.com/phuse-org/phuse-scripts/raw/master/data/sdtm/cdiscpilot01/"
+load_dotenv()
+
+# define a prefix for the CDISC Pilot Datasets (can be a local directory)
+PREFIX = os.getenv("CDISCPILOT_PREFIX",
+                   "https://github.com/phuse-org/phuse-scripts/raw/master/data/sdtm/cdiscpilot01/")
+
+# where the decoded datasets are cached
+CACHE_DIR = os.getenv("CDISCPILOT_CACHE_DIR",
+                      os.path.join(os.path.expanduser("~"), ".cache", "soa-bridge-match"))
+
+# where the artifacts compiled from the reference files are kept (set empty to not keep them)
+ARTIFACT_DIR = os.getenv("CDISCPILOT_ARTIFACT_DIR", CACHE_DIR) or None
+
+# only use the cached (or local) datasets
+OFFLINE = os.getenv("CDISCPILOT_OFFLINE", "").lower() in ("1", "true", "yes")
+
+# rows read at a time when streaming a domain
+CHUNKSIZE = int(os.getenv("CDISCPILOT_CHUNKSIZE", "100000"))
+
+# the domains loaded for the transforms keep only the columns their configuration (doc/config) reads
+PROJECT = os.getenv("CDISCPILOT_PROJECT", "1").lower() in ("1", "true", "yes")
+
+# the domains loaded for the transforms hold the repeated strings as categoricals and the
+# numbers in the narrowest dtype
+COMPACT = os.getenv("CDISCPILOT_COMPACT", "1").lower() in ("1", "true", "yes")
+
+# the share of distinct values under which a string column is made categorical
+CATEGORY_RATIO = 0.5
+
+# memory budget for the loaded datasets (bytes)
+REGISTRY_MAX_BYTES = int(os.getenv("CDISCPILOT_REGISTRY_MAX_BYTES", str(2 * 1024 ** 3)))
 
 
 def check_link(url: str) -> bool:
@@ -14,22 +55,403 @@ def check_link(url: str) -> bool:
     # this will attempt to open the URL, and extract the response status code
     # - status codes are a HTTP convention for responding to requests
     # 200 - OK
-    # 403 - Not authorized   
-    # 404 - Not found   
-    status_code = urlopen(url).getcode()
+    # 403 - Not authorized
+    # 404 - Not found
+    try:
+        status_code = urlopen(Request(url, method="HEAD")).getcode()
+    except (HTTPError, URLError):
+        return False
     return status_code == 200
 
 
-# List of datasets
-DATASETS = ["AE", "CM", "DM", "DS", "EX", "LB", "MH", "QS", "RELREC", "SC", "SE",
-            "SUPPAE", "SUPPDM", "SUPPDS",
-            "SUPPLB", "SV", "TA", "TV", "TI", "TS", "TV", "VS"]
+def is_local(target: str) -> bool:
+    return "://" not in target or target.startswith("file://")
+
+
+def parse_dates(dataset: DataFrame) -> DataFrame:
+    """
+    Parse the date (--DTC) columns
+    """
+    # need to infer datatypes
+    for datecol in [x for x in dataset.columns if x.endswith("DTC")]:
+        dataset[datecol] = pd.to_datetime(dataset[datecol])
+    return dataset
+
+
+def read_xpt(content: bytes) -> DataFrame:
+    """
+    Decode an XPT dataset, parsing the date columns
+    """
+    return parse_dates(pd.read_sas(io.BytesIO(content), encoding="utf-8", format="xport"))
+
+
+def _project(dataset: DataFrame, columns: Optional[List[str]]) -> DataFrame:
+    if columns is None:
+        return dataset
+    return dataset[[x for x in dataset.columns if x in columns]]
+
+
+def iter_xpt(source, chunksize: int, columns: Optional[List[str]] = None) -> Iterator[DataFrame]:
+    """
+    Decode an XPT dataset a chunk of rows at a time, parsing the date columns; the chunks
+    are indexed by the row positions in the dataset
+    @param source: the path (or binary file)
+    @param columns: the columns to keep (defaults to all)
+    """
+    with pd.read_sas(source, encoding="utf-8", format="xport", chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield parse_dates(_project(chunk, columns))
+
+
+def subject_chunks(chunks: Iterable[DataFrame], key: str = "USUBJID") -> Iterator[DataFrame]:
+    """
+    Regroup the chunks of a dataset so the rows for a subject are all in one chunk; the rows
+    for the last subject of a chunk are held back for the next one, so the dataset has to be
+    grouped by subject (as the SDTM datasets are sorted)
+    """
+    done = set()
+    held = None
+
+    def _ready(chunk):
+        subjects = chunk[key].unique()
+        repeated = done.intersection(subjects)
+        if repeated:
+            raise ValueError(f"The dataset is not grouped by {key}, {sorted(repeated)[0]} is in several chunks")
+        done.update(subjects)
+        return chunk
+
+    for chunk in chunks:
+        if held is not None:
+            chunk = pd.concat([held, chunk])
+        if not len(chunk):
+            continue
+        subjects = chunk[key].to_numpy()
+        others = np.flatnonzero(subjects != subjects[-1])
+        split = others[-1] + 1 if len(others) else 0
+        held = chunk.iloc[split:]
+        if split:
+            yield _ready(chunk.iloc[:split])
+    if held is not None and len(held):
+        yield _ready(held)
+
+
+def compact_frame(dataset: DataFrame, category_ratio: float = CATEGORY_RATIO) -> DataFrame:
+    """
+    Hold the repeated strings (subjects, visits, test codes, units) as categoricals and the numbers
+    in the narrowest dtype that holds them exactly; the integers SAS stores as floats stay floats,
+    so they format the same (eg VISITNUM 1.0)
+    """
+    columns = {}
+    for name, column in dataset.items():
+        if column.dtype == object:
+            if pd.api.types.infer_dtype(column, skipna=True) == "string" and \
+                    column.nunique() <= category_ratio * len(column):
+                column = column.astype("category")
+        elif column.dtype == np.float64:
+            narrow = column.astype(np.float32)
+            if ((narrow == column) | column.isna()).all():
+                column = narrow
+        elif pd.api.types.is_integer_dtype(column.dtype):
+            column = pd.to_numeric(column, downcast="integer")
+        columns[name] = column
+    return pd.DataFrame(columns, index=dataset.index)
+
+
+def _write_atomic(path: str, writer) -> None:
+    """
+    Write through a temporary file so concurrent readers never see a partial file
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        writer(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class DatasetCache:
+    """
+    On-disk cache of decoded datasets; the frames are stored by the digest of the
+    source content and the metadata (validators) by the source location
+    """
+
+    def __init__(self, dirname: str) -> None:
+        self._dirname = dirname
+        os.makedirs(dirname, exist_ok=True)
+
+    def _meta_path(self, source: str) -> str:
+        return os.path.join(self._dirname, hashlib.md5(source.encode('utf-8')).hexdigest() + ".json")
+
+    def _frame_path(self, digest: str) -> str:
+        return os.path.join(self._dirname, digest + ".pkl")
+
+    def metadata(self, source: str) -> Optional[dict]:
+        path = self._meta_path(source)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            meta = json.load(f)
+        if not os.path.exists(self._frame_path(meta["digest"])):
+            return None
+        return meta
+
+    def frame(self, meta: dict) -> DataFrame:
+        return pd.read_pickle(self._frame_path(meta["digest"]))
+
+    def store(self, source: str, content: bytes, dataset: DataFrame, **validators) -> dict:
+        digest = hashlib.sha256(content).hexdigest()
+        frame_path = self._frame_path(digest)
+        if not os.path.exists(frame_path):
+            _write_atomic(frame_path, dataset.to_pickle)
+        meta = dict(source=source, digest=digest, **validators)
+
+        def _dump(path):
+            with open(path, "w") as f:
+                json.dump(meta, f)
+
+        _write_atomic(self._meta_path(source), _dump)
+        return meta
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+class ArtifactCache:
+    """
+    On-disk store of the artifacts compiled from the reference files (eg the LOINC index);
+    an artifact is stored with the version of its layout and ignored once the version is
+    bumped.  Without a directory nothing is stored.
+    """
+
+    def __init__(self, dirname: Optional[str] = ARTIFACT_DIR, fmt: str = "pickle") -> None:
+        if fmt not in ("pickle", "json"):
+            raise ValueError(f"Unknown format {fmt}")
+        self._dirname = dirname
+        self._fmt = fmt
+
+    def path(self, name: str) -> Optional[str]:
+        if self._dirname is None:
+            return None
+        return os.path.join(self._dirname, f"{name}.{'pkl' if self._fmt == 'pickle' else 'json'}")
+
+    def get(self, name: str, version: int) -> Optional[Any]:
+        path = self.path(name)
+        if path is None or not os.path.exists(path):
+            return None
+        if self._fmt == "pickle":
+            with open(path, "rb") as f:
+                stored = pickle.load(f)
+        else:
+            with open(path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        if stored.get("version") != version:
+            return None
+        return stored["data"]
+
+    def put(self, name: str, version: int, data: Any) -> None:
+        path = self.path(name)
+        if path is None:
+            return
+        os.makedirs(self._dirname, exist_ok=True)
+
+        def _dump(_path):
+            if self._fmt == "pickle":
+                with open(_path, "wb") as f:
+                    pickle.dump(dict(version=version, data=data), f)
+            else:
+                with open(_path, "w", encoding="utf-8") as f:
+                    json.dump(dict(version=version, data=data), f)
+
+        _write_atomic(path, _dump)
+
+
+def frame_size(dataset) -> int:
+    if dataset is None:
+        return 0
+    if isinstance(dataset, dict):
+        # index of row positions
+        return sum(getattr(x, "nbytes", 0) for x in dataset.values())
+    return int(dataset.memory_usage(deep=True).sum())
+
+
+class DatasetRegistry:
+    """
+    Process wide store of the loaded datasets, evicting the least recently used
+    datasets when the memory budget is exceeded
+    """
+
+    def __init__(self, max_bytes: int = REGISTRY_MAX_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        # key -> per key lock, so a dataset is only loaded once
+        self._loading = {}
+        self._datasets = OrderedDict()
+        self._sizes = {}
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __getstate__(self):
+        # locks can't be pickled (eg when handed to spawned workers)
+        state = self.__dict__.copy()
+        del state["_lock"]
+        del state["_loading"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+        self._loading = {}
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._datasets
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def get(self, key: str, loader: Callable[[], Optional[DataFrame]]) -> Optional[DataFrame]:
+        """
+        Get a dataset, calling the loader on a miss
+        """
+        with self._lock:
+            if key in self._datasets:
+                self._hits += 1
+                self._datasets.move_to_end(key)
+                return self._datasets[key]
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                # loaded by another thread while we waited
+                if key in self._datasets:
+                    self._hits += 1
+                    self._datasets.move_to_end(key)
+                    return self._datasets[key]
+                self._misses += 1
+            dataset = loader()
+            self.put(key, dataset)
+        with self._lock:
+            self._loading.pop(key, None)
+        return dataset
+
+    def put(self, key: str, dataset: Optional[DataFrame]) -> None:
+        with self._lock:
+            self._datasets[key] = dataset
+            self._datasets.move_to_end(key)
+            self._sizes[key] = frame_size(dataset)
+            self._evict()
+
+    def _evict(self) -> None:
+        # always keep the most recent dataset
+        while len(self._datasets) > 1 and sum(self._sizes.values()) > self.max_bytes:
+            key, _ = self._datasets.popitem(last=False)
+            self._sizes.pop(key)
+            self._evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._datasets.clear()
+            self._sizes.clear()
+
+    def stats(self) -> dict:
+        """
+        Hit/miss statistics for the registry
+        """
+        with self._lock:
+            return dict(hits=self._hits,
+                        misses=self._misses,
+                        evictions=self._evictions,
+                        datasets=len(self._datasets),
+                        bytes=sum(self._sizes.values()),
+                        max_bytes=self.max_bytes)
+
+
+_registry = DatasetRegistry()
+
+
+def get_registry() -> DatasetRegistry:
+    """
+    The registry shared by all the Connectors in the process
+    """
+    return _registry
+
+
+def set_registry(registry: DatasetRegistry) -> None:
+    """
+    Replace the process registry (eg with the copy handed to a spawned worker)
+    """
+    global _registry
+    _registry = registry
 
 
 class Connector:
-    def __init__(self) -> None:
-        self.__cache = {}
+    def __init__(self, prefix: Optional[str] = None,
+                 cache_dir: Optional[str] = None,
+                 offline: Optional[bool] = None,
+                 use_cache: bool = True,
+                 registry: Optional[DatasetRegistry] = None,
+                 columns: Optional[Dict[str, Optional[List[str]]]] = None,
+                 project: Optional[bool] = None,
+                 compact: Optional[bool] = None) -> None:
+        """
+        @param columns: the columns the transforms keep by domain (None for all), overriding the configurations
+        @param project: the transforms keep only the columns the domain configurations read (CDISCPILOT_PROJECT)
+        @param compact: use categoricals and narrow dtypes for the domains the transforms load (CDISCPILOT_COMPACT)
+        """
         self.__exists = {}
+        self._columns = {x.upper(): y for x, y in (columns or {}).items()}
+        self._project = PROJECT if project is None else project
+        self._compact = COMPACT if compact is None else compact
+        # the memory held by the domains this connector loaded
+        self._reports = {}
+        self._registry = registry if registry else get_registry()
+        self._prefix = prefix if prefix else PREFIX
+        self._offline = OFFLINE if offline is None else offline
+        self._disk = DatasetCache(cache_dir if cache_dir else CACHE_DIR) if use_cache else None
+
+    def target(self, domain_prefix: str) -> str:
+        """
+        The location of the dataset for a domain
+        """
+        prefix = self._prefix
+        if is_local(prefix):
+            prefix = prefix[len("file://"):] if prefix.startswith("file://") else prefix
+            return os.path.join(prefix, f"{domain_prefix.lower()}.xpt")
+        return f"{prefix}{domain_prefix.lower()}.xpt"
+
+    def columns(self, domain_prefix: str) -> Optional[List[str]]:
+        """
+        The columns kept for a domain; those given, or those the domain configuration reads (None for all)
+        """
+        domain = domain_prefix.upper()
+        if domain in self._columns:
+            return self._columns[domain]
+        if not self._project:
+            return None
+        # the transforms use the connector (for the cache), so they are imported when needed
+        from .transform import config_columns
+        return config_columns(domain)
+
+    def _key(self, domain_prefix: str, project: bool = False) -> str:
+        """
+        The registry key for a domain, the target for the whole dataset or the target with the
+        projection and compaction of this connector
+        """
+        parts = [self.target(domain_prefix)]
+        if not project:
+            return parts[0]
+        columns = self.columns(domain_prefix)
+        if columns is not None:
+            parts.append("columns=" + ",".join(columns))
+        if self._compact:
+            parts.append("compact")
+        return "|".join(parts)
 
     def exists(self, domain_prefix: str):
         """
@@ -38,28 +460,187 @@ class Connector:
         """
         if domain_prefix not in self.__exists:
             # define the target for our read_sas directive
-            target = f"{PREFIX}{domain_prefix.lower()}.xpt"
-            # make sure that the URL exists first
-            self.__exists[domain_prefix] = check_link(target)
+            target = self.target(domain_prefix)
+            keys = [x for x in (target, self._key(domain_prefix, project=True)) if x in self._registry]
+            if keys:
+                self.__exists[domain_prefix] = self._registry.get(keys[0], lambda: None) is not None
+            elif self._disk and self._disk.metadata(target):
+                self.__exists[domain_prefix] = True
+            elif is_local(target):
+                self.__exists[domain_prefix] = os.path.exists(target)
+            elif self._offline:
+                self.__exists[domain_prefix] = False
+            else:
+                # make sure that the URL exists first
+                self.__exists[domain_prefix] = check_link(target)
 
         return self.__exists[domain_prefix]
 
-    def load_cdiscpilot_dataset(self, domain_prefix: str) -> Optional[DataFrame]:
+    def _fetch(self, target: str) -> Optional[DataFrame]:
+        """
+        Load a dataset, using the disk cache while the source is unchanged
+        """
+        meta = self._disk.metadata(target) if self._disk else None
+        if is_local(target):
+            if not os.path.exists(target):
+                return self._disk.frame(meta) if meta else None
+            stat = os.stat(target)
+            if meta and meta.get("mtime") == stat.st_mtime and meta.get("size") == stat.st_size:
+                return self._disk.frame(meta)
+            with open(target, "rb") as f:
+                content = f.read()
+            validators = dict(mtime=stat.st_mtime, size=stat.st_size)
+        else:
+            if self._offline:
+                if meta is None:
+                    print(f"Dataset {target} is not cached (offline)")
+                    return None
+                return self._disk.frame(meta)
+            request = Request(target)
+            if meta and meta.get("etag"):
+                request.add_header("If-None-Match", meta["etag"])
+            if meta and meta.get("last_modified"):
+                request.add_header("If-Modified-Since", meta["last_modified"])
+            try:
+                response = urlopen(request)
+            except HTTPError as exc:
+                if exc.code == 304:
+                    return self._disk.frame(meta)
+                if exc.code == 404:
+                    return None
+                raise
+            except URLError:
+                if meta is None:
+                    raise
+                print(f"Unable to reach {target}, using the cached copy")
+                return self._disk.frame(meta)
+            content = response.read()
+            validators = dict(etag=response.headers.get("ETag"),
+                              last_modified=response.headers.get("Last-Modified"))
+        dataset = read_xpt(content)
+        if self._disk:
+            self._disk.store(target, content, dataset, **validators)
+        return dataset
+
+    def load_cdiscpilot_dataset(self, domain_prefix: str, project: bool = False) -> Optional[DataFrame]:
         """
-        load a CDISC Pilot Dataset from the GitHub site
+        load a CDISC Pilot Dataset from the GitHub site (or the local prefix)
         @param domain_prefix: the Domain Prefix for the Domain (eg DM, VS)
+        @param project: keep only the columns the domain configuration reads, compacted (for the
+                        transforms); the whole dataset, as decoded, by default
         """
-        if domain_prefix not in self.__cache:
-            # define the target for our read_sas directive
-            target = f"{PREFIX}{domain_prefix.lower()}.xpt"
-            # make sure that the URL exists first
-            if check_link(target):
-                # let pandas work it out
-                dataset = pd.read_sas(target, encoding="utf-8", format="xport")
-                # need to infer datatypes
-                for datecol in [x for x in dataset.columns if x.endswith("DTC")]:
-                    dataset[datecol] = pd.to_datetime(dataset[datecol])
-                self.__cache[domain_prefix] = dataset
-            else:
-                self.__cache[domain_prefix] = None
-        return self.__cache[domain_prefix]
+        target = self.target(domain_prefix)
+        if not project:
+            return self._registry.get(target, lambda: self._fetch(target))
+
+        def _load():
+            # projected from the whole dataset if it is already loaded
+            dataset = self._registry.get(target, lambda: None) if target in self._registry else self._fetch(target)
+            return self._prepare(domain_prefix, dataset)
+
+        return self._registry.get(self._key(domain_prefix, project=True), _load)
+
+    def _prepare(self, domain_prefix: str, dataset: Optional[DataFrame]) -> Optional[DataFrame]:
+        """
+        Project and compact a loaded domain, recording the memory saved
+        """
+        if dataset is None:
+            return None
+        report = dict(rows=len(dataset), source_columns=len(dataset.columns), source_bytes=frame_size(dataset))
+        dataset = _project(dataset, self.columns(domain_prefix))
+        if self._compact:
+            dataset = compact_frame(dataset)
+        report.update(columns=len(dataset.columns), bytes=frame_size(dataset))
+        self._reports[domain_prefix.upper()] = report
+        return dataset
+
+    def memory_report(self) -> DataFrame:
+        """
+        Report the memory held by the domains this connector loaded, against the decoded datasets
+        """
+        report = pd.DataFrame.from_dict(self._reports, orient="index",
+                                        columns=["rows", "source_columns", "source_bytes", "columns", "bytes"])
+        report["ratio"] = report.source_bytes / report.bytes.clip(lower=1)
+        for domain, row in report.iterrows():
+            print(f"{domain}: {int(row['rows'])} rows, {int(row['columns'])} of {int(row['source_columns'])} columns, "
+                  f"{row['bytes'] / 1024 ** 2:.1f}MB (decoded {row['source_bytes'] / 1024 ** 2:.1f}MB, "
+                  f"{row['ratio']:.1f}x smaller)")
+        return report
+
+    def iter_domain(self, domain_prefix: str, chunksize: int = CHUNKSIZE,
+                    columns: Optional[List[str]] = None,
+                    key: str = "USUBJID") -> Iterator[DataFrame]:
+        """
+        Stream a CDISC Pilot Dataset in chunks of about chunksize rows, without loading the whole
+        dataset; the rows for a subject are never split between chunks
+        @param domain_prefix: the Domain Prefix for the Domain (eg LB, QS)
+        @param columns: the columns to keep (defaults to all, the key is always kept)
+        @param key: the subject column
+        """
+        target = self.target(domain_prefix)
+        if columns is not None and key not in columns:
+            columns = [key] + list(columns)
+        projection = self.columns(domain_prefix)
+        if target in self._registry:
+            # already loaded
+            yield from subject_chunks(self._slices(self.load_cdiscpilot_dataset(domain_prefix), chunksize, columns),
+                                      key)
+        elif self._key(domain_prefix, project=True) in self._registry and columns is not None and \
+                (projection is None or set(columns) <= set(projection)):
+            yield from subject_chunks(self._slices(self.load_cdiscpilot_dataset(domain_prefix, project=True),
+                                                   chunksize, columns), key)
+        elif is_local(target):
+            path = target[len("file://"):] if target.startswith("file://") else target
+            if os.path.exists(path):
+                yield from subject_chunks(iter_xpt(path, chunksize, columns), key)
+        elif self._offline:
+            meta = self._disk.metadata(target) if self._disk else None
+            if meta is None:
+                print(f"Dataset {target} is not cached (offline)")
+                return
+            yield from subject_chunks(self._slices(self._disk.frame(meta), chunksize, columns), key)
+        else:
+            # the download is spooled to disk and decoded from there
+            with tempfile.TemporaryFile() as f:
+                try:
+                    with urlopen(Request(target)) as response:
+                        shutil.copyfileobj(response, f)
+                except HTTPError as exc:
+                    if exc.code == 404:
+                        return
+                    raise
+                f.seek(0)
+                yield from subject_chunks(iter_xpt(f, chunksize, columns), key)
+
+    @staticmethod
+    def _slices(dataset: Optional[DataFrame], chunksize: int, columns: Optional[List[str]]) -> Iterator[DataFrame]:
+        if dataset is None:
+            return
+        dataset = _project(dataset, columns)
+        for start in range(0, len(dataset), chunksize):
+            yield dataset.iloc[start:start + chunksize]
+
+    def subject_index(self, domain_prefix: str, column: str = "USUBJID", project: bool = False) -> dict:
+        """
+        Get the row positions for each subject in a domain, built once per dataset
+        @param domain_prefix: the Domain Prefix for the Domain (eg DM, VS)
+        @param column: the subject column
+        @param project: the positions in the projected dataset (see load_cdiscpilot_dataset)
+        """
+        def _build():
+            dataset = self.load_cdiscpilot_dataset(domain_prefix, project)
+            if dataset is None:
+                return {}
+            return dataset.groupby(column, sort=False, observed=True).indices
+
+        return self._registry.get(f"{self._key(domain_prefix, project)}#{column}", _build)
+
+    @property
+    def registry(self) -> DatasetRegistry:
+        return self._registry
+
+    def stats(self) -> dict:
+        """
+        Statistics for the shared dataset registry
+        """
+        return self._registry.stats()
@@ -2,31 +2,54 @@ from __future__ import annotations
 
 import hashlib
 import os
-from typing import Optional
+import random
+from typing import Dict, Iterator, List, Optional
 
+import numpy as np
 from fhir.resources.bundle import Bundle
-from fhir.resources.careplan import CarePlan
-from fhir.resources.coding import Coding
-from fhir.resources.encounter import Encounter
-from fhir.resources.identifier import Identifier
 from fhir.resources.patient import Patient
-from fhir.resources.period import Period
-from fhir.resources.reference import Reference
-from fhir.resources.servicerequest import ServiceRequest
 
-from .bundler import SourcedBundle
-from .connector import Connector
+from .bundler import AddedResources, SourcedBundle
+from .connector import CHUNKSIZE, Connector
+from .models import validate_resource
+from .transform import SUBJECT_RESOURCES, get_transform
 
 
 def hh(s: str) -> str:
     return hashlib.md5(s.encode('utf-8')).hexdigest()
 
 
+# VISITNUM -> PlanDefinition for the visit (None for unplanned visits)
+VISIT_PLAN_DEFINITIONS = {"1.0": "H2Q-MC-LZZT-Study-Visit-1",
+                          "2.0": "H2Q-MC-LZZT-Study-Visit-2",
+                          "3.0": "H2Q-MC-LZZT-Study-Visit-3",
+                          "3.5": None,
+                          "4.0": "H2Q-MC-LZZT-Study-Visit-4",
+                          "5.0": "H2Q-MC-LZZT-Study-Visit-5",
+                          "6.0": "H2Q-MC-LZZT-Study-Visit-6",
+                          "7.0": "H2Q-MC-LZZT-Study-Visit-7",
+                          "8.0": "H2Q-MC-LZZT-Study-Visit-8",
+                          "8.1": None,
+                          "9.0": "H2Q-MC-LZZT-Study-Visit-9",
+                          "9.1": None,
+                          "10.0": "H2Q-MC-LZZT-Study-Visit-10",
+                          "10.1": None,
+                          "11.0": "H2Q-MC-LZZT-Study-Visit-11",
+                          "11.1": None,
+                          "12.0": "H2Q-MC-LZZT-Study-Visit-12",
+                          "13.0": "H2Q-MC-LZZT-Study-Visit-13",
+                          "101.0": "H2Q-MC-LZZT-Study-ET-14",
+                          "201.0": "H2Q-MC-LZZT-Study-RT-15",
+                          "501.0": None}
+
+
 class Naptha:
 
     def __init__(self, templatefile: Optional[str],
-                 templatecontent: Optional[Bundle] = None) -> None:
-        self._connector = Connector()
+                 templatecontent: Optional[Bundle] = None,
+                 connector: Optional[Connector] = None,
+                 raw: bool = False) -> None:
+        self._connector = connector if connector else Connector()
         self._subjects = {}
         self._patients = {}
         self._subjects = {}
@@ -35,7 +58,7 @@ class Naptha:
         if templatecontent:
             self._content = templatecontent
         else:
-            self._content = SourcedBundle.from_bundle_file(templatefile)
+            self._content = SourcedBundle.from_bundle_file(templatefile, raw=raw)
 
     @property
     def content(self):
@@ -52,15 +75,23 @@ class Naptha:
         dataset = self._connector.load_cdiscpilot_dataset("DM")
         return dataset.USUBJID.unique()
 
+    def has_subject(self, subject_id: str) -> bool:
+        """
+        Check the subject is in the CDISC Pilot Dataset
+        """
+        return subject_id in self._connector.subject_index("DM", project=True)
+
     def get_subject_data(self, subject_id: str, domain: str):
         """
         Get the data for a subject for a given domain
         """
-        if subject_id not in self.get_subjects():
+        if not self.has_subject(subject_id):
             raise ValueError(f"Subject {subject_id} does not exist")
         dataset = self._connector.load_cdiscpilot_dataset(domain)
-        dataset = dataset[dataset.USUBJID == subject_id]
-        return dataset
+        positions = self._connector.subject_index(domain).get(subject_id)
+        if positions is None:
+            return dataset.iloc[0:0]
+        return dataset.iloc[positions]
 
     def get_subject_cm(self, subject_id: str):
         """
@@ -80,24 +111,58 @@ class Naptha:
         """
         return self.get_subject_data(subject_id, "SV")
 
-    # def parse_dataset(self, dataset_name: str):
-    #     """
-    #     Parse a CDISC Pilot Dataset
-    #     """
-    #     if not os.path.exists(os.path.join("../../doc/config", f"{dataset_name}.yml")):
-    #         print("Unable to process configuration file")
-    #     config = Configuration.from_file(os.path.join("../../doc/config", f"{dataset_name}.yml"))
-    #     _columns = [x for x in config.columns()]
-    #     dataset = self._connector.load_cdiscpilot_dataset(dataset_name)
-    #     for offset, record in enumerate(dataset.iterrows()):
-    #         # generate a patient resource
-    #         patient = self._generate_patient(record.USUBJID)
-    #         # generate a bundle
-    #         bundle = Bundle()
-    #         # add the patient to the bundle
-    #         bundle.add_entry(patient)
-    #         # add the bundle to the content
-    #         self.content.add_entry(bundle)
+    def domain_resources(self, domain: str,
+                         subject_ids: Optional[List[str]] = None,
+                         resource_types: Optional[List[str]] = None) -> Dict[str, List[dict]]:
+        """
+        Convert the records of a domain to resource dicts with the domain configuration (doc/config)
+        @param subject_ids: the subjects (defaults to the subjects in the bundle)
+        @param resource_types: the resources to generate (defaults to all those in the configuration)
+        @return: the resources by subject
+        """
+        if subject_ids is None:
+            subject_ids = self.content.subjects
+        frame = self._subjects_frame(domain, [x for x in subject_ids if self.has_subject(x)])
+        return get_transform(domain).apply(frame, resource_types)
+
+    def iter_domain_resources(self, domain: str,
+                              chunksize: int = CHUNKSIZE,
+                              subject_ids: Optional[List[str]] = None,
+                              resource_types: Optional[List[str]] = None) -> Iterator[Dict[str, List[dict]]]:
+        """
+        Convert the records of a domain a chunk at a time, streaming the dataset (only the columns
+        the configuration reads) so a large domain is never loaded whole
+        @param chunksize: the rows to read at a time
+        @param subject_ids: the subjects (defaults to the subjects in the bundle)
+        @param resource_types: the resources to generate (defaults to all those in the configuration)
+        @return: the resources by subject, for each chunk
+        """
+        if subject_ids is None:
+            subject_ids = self.content.subjects
+        subject_ids = set(x for x in subject_ids if self.has_subject(x))
+        transform = get_transform(domain)
+        for chunk in self._connector.iter_domain(domain, chunksize, columns=transform.columns, key=transform.key):
+            chunk = chunk[chunk[transform.key].isin(subject_ids)]
+            if len(chunk):
+                yield transform.apply(chunk, resource_types)
+
+    def merge_domain(self, domain: str, subject_id: Optional[str] = None, validate: bool = True) -> AddedResources:
+        """
+        Add the resources for the records of a domain for a subject (or all the subjects in the
+        bundle); the subject resources are already in the bundle, only the record resources are added
+        """
+        if subject_id is not None and not self.has_subject(subject_id):
+            raise ValueError(f"Subject {subject_id} does not exist")
+        transform = get_transform(domain)
+        resource_types = [x for x in transform.resource_types if x not in SUBJECT_RESOURCES]
+        if subject_id is not None:
+            resources = self.domain_resources(domain, [subject_id], resource_types)
+            return self.content.add_resources([x for y in resources.values() for x in y], validate=validate)
+        # the whole bundle, a chunk of the domain at a time
+        added = AddedResources()
+        for resources in self.iter_domain_resources(domain, resource_types=resource_types):
+            added += self.content.add_resources([x for y in resources.values() for x in y], validate=validate)
+        return added
 
     # def _generate_patient(self, subject_id: str) -> Patient:
     #     """
@@ -111,92 +176,101 @@ class Naptha:
 
     def clone(self, subject_id: str) -> Naptha:
         cloned = self._content.clone_subject(subject_id)
-        return Naptha(templatefile=None, templatecontent=cloned)
+        return Naptha(templatefile=None, templatecontent=cloned, connector=self._connector)
 
-    def merge_sv(self, subject_id: Optional[str] = None):
+    def _subjects_frame(self, domain: str, subject_ids: List[str]):
         """
-        Parse the SV dataset for a subject
+        Slice the rows for a set of subjects out of a domain, as loaded for the transforms
         """
-        if subject_id is None:
-            for _subject_id in self.get_subjects():
-                self.merge_sv(_subject_id)
-            else:
-                return
-        if subject_id not in self.get_subjects():
-            raise ValueError(f"Subject {subject_id} does not exist")
+        dataset = self._connector.load_cdiscpilot_dataset(domain, project=True)
+        index = self._connector.subject_index(domain, project=True)
+        positions = [index[x] for x in subject_ids if x in index]
+        if not positions:
+            return dataset.iloc[0:0]
+        return dataset.iloc[np.concatenate(positions)]
+
+    def sv_resources(self, subject_ids: Optional[List[str]] = None,
+                     validate_sample: int = 0) -> List[dict]:
+        """
+        Generate the CarePlan, ServiceRequest and Encounter resources (as dicts) for the
+        SV records of the subjects in one pass over the domain
+        @param subject_ids: the subjects (defaults to the subjects in the bundle)
+        @param validate_sample: the number of the generated resources to validate
+        """
+        if subject_ids is None:
+            subject_ids = self.content.subjects
+        subject_ids = [x for x in subject_ids if self.has_subject(x)]
+        sv = self._subjects_frame("SV", subject_ids)
+        visit_num = sv.VISITNUM.astype(str)
+        plan_def_id = visit_num.map(VISIT_PLAN_DEFINITIONS)
+        # drop the unknown and unplanned visits
+        keep = plan_def_id.notna().to_numpy()
+        sv, visit_num, plan_def_id = sv[keep], visit_num[keep], plan_def_id[keep]
         # the bundle will include the ResearchStudy, ResearchSubject, and Patient resources
-        patient_hash_id = hh(subject_id)
-        # slice the dataset
-        sv = self.get_subject_sv(subject_id)
-        pd_map = {"1.0": "H2Q-MC-LZZT-Study-Visit-1",
-                  "2.0": "H2Q-MC-LZZT-Study-Visit-2",
-                  "3.0": "H2Q-MC-LZZT-Study-Visit-3",
-                  "3.5": None,
-                  "4.0": "H2Q-MC-LZZT-Study-Visit-4",
-                  "5.0": "H2Q-MC-LZZT-Study-Visit-5",
-                  "6.0": "H2Q-MC-LZZT-Study-Visit-6",
-                  "7.0": "H2Q-MC-LZZT-Study-Visit-7",
-                  "8.0": "H2Q-MC-LZZT-Study-Visit-8",
-                  "8.1": None,
-                  "9.0": "H2Q-MC-LZZT-Study-Visit-9",
-                  "9.1": None,
-                  "10.0": "H2Q-MC-LZZT-Study-Visit-10",
-                  "10.1": None,
-                  "11.0": "H2Q-MC-LZZT-Study-Visit-11",
-                  "11.1": None,
-                  "12.0": "H2Q-MC-LZZT-Study-Visit-12",
-                  "13.0": "H2Q-MC-LZZT-Study-Visit-13",
-                  "101.0": "H2Q-MC-LZZT-Study-ET-14",
-                  "201.0": "H2Q-MC-LZZT-Study-RT-15",
-                  "501.0": None}
-        for record in sv.itertuples():
-            if record.USUBJID not in self.content.subjects:
-                continue
-            print("Processing patient {} -> {}".format(record.USUBJID, record.VISITNUM))
-            visit_num = record.VISITNUM
-            if str(visit_num) not in pd_map:
-                print("Skipping visit {}".format(visit_num))
-                continue
-            plan_def_id = pd_map[str(visit_num)]
-            if plan_def_id is None:
-                print("Ignoring visit", visit_num)
-                continue
-            care_plan_description = f"{patient_hash_id}-{visit_num}-CarePlan"
-            care_plan_id = hh(care_plan_description)
+        patient_hash_id = sv.USUBJID.map({x: hh(x) for x in sv.USUBJID.unique()}).astype(object)
+        care_plan_description = patient_hash_id + "-" + visit_num + "-CarePlan"
+        care_plan_id = care_plan_description.map(hh)
+        service_request_description = patient_hash_id + "-" + visit_num + "-ServiceRequest"
+        service_request_id = service_request_description.map(hh)
+        encounter_id = (care_plan_id + "-" + visit_num + "-Encounter").map(hh)
+        period_start = sv.SVSTDTC.map(lambda x: x.isoformat(), na_action="ignore")
+        period_end = sv.SVENDTC.map(lambda x: x.isoformat(), na_action="ignore")
+        resources = []
+        for row in zip(sv.USUBJID, visit_num, plan_def_id, patient_hash_id,
+                       care_plan_description, care_plan_id,
+                       service_request_description, service_request_id,
+                       encounter_id, period_start, period_end):
+            (subject_id, _visit_num, _plan_def_id, _patient_hash_id,
+             _cp_description, _cp_id, _sr_description, _sr_id,
+             _enc_id, _start, _end) = row
+            subject = dict(reference=f"Patient/{_patient_hash_id}")
             # create a care plan
-            care_plan = CarePlan(id=care_plan_id,
-                                 status="completed",
-                                 intent="order",
-                                 subject=Reference(reference=f"Patient/{patient_hash_id}"),
-                                 instantiatesCanonical=[f"PlanDefinition/{plan_def_id}"],
-                                 title=f"Subject {record.USUBJID} {visit_num}")
-            care_plan.identifier = [Identifier(value=care_plan_description)]
-            # bind the care plan - todo!
+            resources.append(dict(resourceType="CarePlan",
+                                  id=_cp_id,
+                                  identifier=[dict(value=_cp_description)],
+                                  status="completed",
+                                  intent="order",
+                                  subject=subject,
+                                  instantiatesCanonical=[f"PlanDefinition/{_plan_def_id}"],
+                                  title=f"Subject {subject_id} {_visit_num}"))
             # create the service request
-            service_request_description = f"{patient_hash_id}-{visit_num}-ServiceRequest"
-            service_request_id = hh(service_request_description)
-            service_request = ServiceRequest(id=service_request_id,
-                                             status="completed",
-                                             intent="order",
-                                             subject=Reference(reference=f"Patient/{patient_hash_id}"),
-                                             basedOn=[Reference(reference=f"CarePlan/{care_plan_id}")])
-            service_request.identifier = [Identifier(value=f"{service_request_description}")]
-            encounter = Encounter(id=hh(f"{care_plan_id}-{record.VISITNUM}-Encounter"),
-                                  status="finished",
-                                  class_fhir=Coding(code="IMP",
-                                                    system="http://hl7.org/fhir/v3/ActCode"),
-                                  subject=Reference(reference=f"Patient/{patient_hash_id}"),
-                                  basedOn=[Reference(reference=f"ServiceRequest/{service_request_id}")])
-            encounter.identifier = [Identifier(value=f"{care_plan_id}-Encounter")]
+            resources.append(dict(resourceType="ServiceRequest",
+                                  id=_sr_id,
+                                  identifier=[dict(value=_sr_description)],
+                                  status="completed",
+                                  intent="order",
+                                  subject=dict(subject),
+                                  basedOn=[dict(reference=f"CarePlan/{_cp_id}")]))
+            encounter = dict(resourceType="Encounter",
+                             id=_enc_id,
+                             identifier=[dict(value=f"{_cp_id}-Encounter")],
+                             status="finished",
+                             subject=dict(subject),
+                             basedOn=[dict(reference=f"ServiceRequest/{_sr_id}")])
+            encounter["class"] = dict(code="IMP", system="http://hl7.org/fhir/v3/ActCode")
             period = {}
-            if record.SVSTDTC:
-                period["start"] = record.SVSTDTC
-            if record.SVENDTC:
-                period["end"] = record.SVENDTC
+            if isinstance(_start, str):
+                period["start"] = _start
+            if isinstance(_end, str):
+                period["end"] = _end
             if period:
-                encounter.period = Period(**period)
+                encounter["period"] = period
             # later
-            # encounter.serviceProvider = Reference(reference=f"Organization/{self.org_id}")
-            self.content.add_resource(care_plan)
-            self.content.add_resource(service_request)
-            self.content.add_resource(encounter)
+            # encounter["serviceProvider"] = dict(reference=f"Organization/{self.org_id}")
+            resources.append(encounter)
+        for resource in random.sample(resources, min(validate_sample, len(resources))):
+            validate_resource(resource)
+        return resources
+
+    def merge_sv(self, subject_id: Optional[str] = None, validate: bool = True) -> AddedResources:
+        """
+        Parse the SV dataset for a subject (or all the subjects in the bundle)
+        """
+        if subject_id is not None and not self.has_subject(subject_id):
+            raise ValueError(f"Subject {subject_id} does not exist")
+        subject_ids = [subject_id] if subject_id is not None else None
+        if subject_id is not None and not self.content.has_resource('ResearchSubject', subject_id):
+            # only the subjects in the bundle will be merged
+            return AddedResources()
+        resources = self.sv_resources(subject_ids, validate_sample=0 if validate else 10)
+        return self.content.add_resources(resources, validate=validate)
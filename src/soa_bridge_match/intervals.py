@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import datetime
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from .references import resource_key
+from .search import DATE_ELEMENTS, resource_dates
+
+# the dates of the clinical resources (the onset for the conditions)
+CLINICAL_DATE_ELEMENTS = dict(DATE_ELEMENTS, Condition=("onsetDateTime", "onsetPeriod"))
+
+# the classification for the visits
+GREEN = "green"
+ORANGE = "orange"
+RED = "red"
+
+
+def day_ordinal(day: str) -> int:
+    """
+    The ordinal for a (possibly partial) day, partial dates take the first day
+    """
+    parts = [int(x) for x in day.split("-") if x.isdigit() and x != "99"]
+    year, month, _day = (parts + [1, 1])[:3]
+    return datetime.date(year, month, _day).toordinal()
+
+
+class IntervalIndex:
+    """
+    Static interval tree over (low, high, item) intervals; the intervals are held
+    sorted by low, as an implicit balanced tree where each node records the
+    highest high in its subtree
+    """
+
+    def __init__(self, intervals: Iterable[Tuple[Any, Any, Any]]) -> None:
+        self._intervals = sorted(intervals, key=lambda x: x[0])
+        self._lows = [x[0] for x in self._intervals]
+        self._max_high = [x[1] for x in self._intervals]
+        self._augment(0, len(self._intervals))
+
+    def __len__(self) -> int:
+        return len(self._intervals)
+
+    def _augment(self, lo: int, hi: int):
+        if lo >= hi:
+            return None
+        mid = (lo + hi) // 2
+        highs = [self._max_high[mid]]
+        for child in (self._augment(lo, mid), self._augment(mid + 1, hi)):
+            if child is not None:
+                highs.append(child)
+        self._max_high[mid] = max(highs)
+        return self._max_high[mid]
+
+    def overlapping(self, low=None, high=None) -> List[Any]:
+        """
+        Get the items with intervals overlapping [low, high] (None is unbounded)
+        """
+        found = []
+        pending = [(0, len(self._intervals))]
+        while pending:
+            lo, hi = pending.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            if low is not None and self._max_high[mid] < low:
+                # nothing in this subtree reaches the window
+                continue
+            pending.append((lo, mid))
+            if high is None or self._lows[mid] <= high:
+                _low, _high, item = self._intervals[mid]
+                if low is None or _high >= low:
+                    found.append((_low, item))
+                # only the right subtree can start after the window
+                pending.append((mid + 1, hi))
+        return [item for _, item in sorted(found, key=lambda x: x[0])]
+
+
+class VisitWindow(NamedTuple):
+    visit: str
+    # the window from the schedule (None is unbounded)
+    low: Optional[str] = None
+    high: Optional[str] = None
+    # the planned date
+    expected: Optional[str] = None
+    # the actual Encounter
+    encounter_start: Optional[str] = None
+    encounter_end: Optional[str] = None
+
+    def bounds(self) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        """
+        The dates for the resources of the visit; the Encounter is used for visits the schedule doesn't place
+        """
+        if self.low or self.high:
+            return self.low, self.high
+        if self.encounter_start:
+            return self.encounter_start, self.encounter_end or self.encounter_start
+        return None
+
+    def target(self) -> Optional[str]:
+        return self.expected or self.encounter_start or self.low or self.high
+
+
+class VisitMatch(NamedTuple):
+    status: str
+    counts: Dict[str, int]
+    resources: List[Tuple[str, str]]
+
+
+def classify_window(window: VisitWindow) -> str:
+    """
+    Green if the Encounter is on the planned date, orange if it is within the window
+    and red if it is missing or outside the window
+    """
+    if not window.encounter_start:
+        return RED
+    if window.expected:
+        if window.encounter_start == window.expected:
+            return GREEN
+    elif not (window.low or window.high):
+        # nothing planned for the visit to be matched against
+        return GREEN
+    if (window.low is None or window.encounter_start >= window.low) and \
+            (window.high is None or window.encounter_start <= window.high):
+        return ORANGE
+    return RED
+
+
+class SubjectTimeline:
+    """
+    The clinical resources for a subject indexed by their dates
+    """
+
+    def __init__(self, resources: Iterable[dict]) -> None:
+        intervals = []
+        for resource in resources:
+            dates = resource_dates(resource, CLINICAL_DATE_ELEMENTS)
+            if dates:
+                intervals.append((dates[0], dates[1], resource_key(resource)))
+        self._starts = {key: start for start, _, key in intervals}
+        self._index = IntervalIndex(intervals)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def in_window(self, low: Optional[str] = None,
+                  high: Optional[str] = None,
+                  resource_type: Optional[str] = None) -> List[Tuple[str, str]]:
+        """
+        Get the keys for the resources in the window (days, None is unbounded)
+        """
+        keys = self._index.overlapping(low, high)
+        if resource_type is None:
+            return keys
+        return [x for x in keys if x[0] == resource_type]
+
+    def assign(self, windows: List[VisitWindow]) -> Dict[str, VisitMatch]:
+        """
+        Assign each resource to the visit with the nearest target out of the windows it falls in
+        """
+        best = {}
+        for idx, window in enumerate(windows):
+            bounds = window.bounds()
+            target = window.target()
+            if bounds is None or target is None:
+                continue
+            _target = day_ordinal(target)
+            for key in self._index.overlapping(*bounds):
+                distance = abs(day_ordinal(self._starts[key]) - _target)
+                # ties go to the earlier visit
+                if key not in best or distance < best[key][0]:
+                    best[key] = (distance, idx)
+        assigned = {idx: [] for idx in range(len(windows))}
+        for key, (_, idx) in best.items():
+            assigned[idx].append(key)
+        matches = {}
+        for idx, window in enumerate(windows):
+            counts = {}
+            for resource_type, _ in assigned[idx]:
+                counts[resource_type] = counts.get(resource_type, 0) + 1
+            matches[window.visit] = VisitMatch(classify_window(window), counts, assigned[idx])
+        return matches
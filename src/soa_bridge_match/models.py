@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import json
+
+from fhir.resources import get_fhir_model_class
+from fhir.resources.bundle import BundleEntry, BundleEntryRequest
+from fhir.resources.resource import Resource
+
+
+def _construct(model_class, data: dict):
+    values = {}
+    for field in model_class.__fields__.values():
+        if field.alias not in data:
+            continue
+        value = data[field.alias]
+        element_type = getattr(field.type_, "__resource_type__", None)
+        if element_type and element_type not in ("Resource", "Element"):
+            element_class = get_fhir_model_class(element_type)
+            if isinstance(value, list):
+                value = [_construct(element_class, x) if isinstance(x, dict) else x for x in value]
+            elif isinstance(value, dict):
+                value = _construct(element_class, value)
+        elif field.alias == "contained" and isinstance(value, list):
+            value = [construct_resource(x) if isinstance(x, dict) else x for x in value]
+        values[field.alias] = value
+    return model_class.construct(**values)
+
+
+def construct_resource(data: dict) -> Resource:
+    """
+    Build a resource model from a resource dict without validation (the values
+    are used as supplied, so dates remain strings)
+    """
+    return _construct(get_fhir_model_class(data["resourceType"]), data)
+
+
+def validate_resource(data: dict) -> Resource:
+    """
+    Build a resource model from a resource dict, validating the content
+    """
+    return get_fhir_model_class(data["resourceType"]).parse_obj(data)
+
+
+def upsert_request(resource_type: str, resource_id: str) -> dict:
+    """
+    The PUT request used for the uploads
+    """
+    return dict(method="PUT",
+                url=f"{resource_type}/{resource_id}",
+                ifNoneExist=f"identifier={resource_id}")
+
+
+def resource_dict(resource: Resource) -> dict:
+    """
+    Convert a resource model to the JSON representation
+    """
+    return json.loads(resource.json())
+
+
+def upsert_entry(resource: Resource, validate: bool = True) -> BundleEntry:
+    """
+    Wrap a resource in a bundle entry with the PUT request used for the uploads
+    """
+    request = upsert_request(resource.resource_type, resource.id)
+    if validate:
+        return BundleEntry(resource=resource, request=BundleEntryRequest(**request))
+    return BundleEntry.construct(resource=resource, request=BundleEntryRequest.construct(**request))
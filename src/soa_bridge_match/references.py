@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+from typing import List, Optional, Tuple, Union
+
+# elements used to bind the subject data together (see DESIGN.md)
+REFERENCE_ELEMENTS = ("subject", "individual", "basedOn", "encounter", "instantiatesCanonical")
+
+# resources shared by all the subjects in a study
+COMMON_RESOURCE_TYPES = ("ResearchStudy", "Group", "Organization", "Practitioner", "Medication")
+
+
+def is_common_resource(resource_type: str) -> bool:
+    """
+    Design (and other shared) resources are not owned by a subject
+    """
+    return resource_type in COMMON_RESOURCE_TYPES or resource_type.endswith('Definition')
+
+
+def _get(obj, name: str):
+    """
+    Read an element from either a resource model or a resource dict
+    """
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def normalise_reference(reference: str) -> str:
+    """
+    Reduce a (possibly absolute) reference to the ResourceType/id form
+    """
+    reference = reference.split("|")[0]
+    parts = reference.rstrip("/").split("/")
+    if len(parts) > 2:
+        # absolute or versioned reference
+        if "_history" in parts:
+            parts = parts[:parts.index("_history")]
+        parts = parts[-2:]
+    return "/".join(parts)
+
+
+def _element_references(value) -> List[str]:
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        refs = []
+        for item in value:
+            refs.extend(_element_references(item))
+        return refs
+    if isinstance(value, str):
+        # canonical
+        return [normalise_reference(value)]
+    reference = _get(value, "reference")
+    return [normalise_reference(reference)] if reference else []
+
+
+def extract_references(resource: Union[dict, object]) -> List[Tuple[str, str]]:
+    """
+    Extract the (element, reference) pairs for a resource; references on contained
+    resources are reported against the container as contained.<element>
+    """
+    refs = []
+    for element in REFERENCE_ELEMENTS:
+        for reference in _element_references(_get(resource, element)):
+            refs.append((element, reference))
+    for contained in _get(resource, "contained") or []:
+        for element, reference in extract_references(contained):
+            refs.append((f"contained.{element}", reference))
+    return refs
+
+
+def resource_key(resource: Union[dict, object]) -> Tuple[str, str]:
+    """
+    Get the (resourceType, id) key for a resource
+    """
+    if isinstance(resource, dict):
+        return resource["resourceType"], resource["id"]
+    return resource.resource_type, resource.id
+
+
+class ReferenceGraph:
+    """
+    Forward and reverse reference edges between the resources of a bundle
+    """
+
+    def __init__(self) -> None:
+        # (resource type, id) -> [(element, ResourceType/id)]
+        self._forward = {}
+        # ResourceType/id -> {(resource type, id): [element]}
+        self._reverse = {}
+
+    def add(self, resource: Union[dict, object]) -> None:
+        """
+        Register the outgoing references for a resource
+        """
+        key = resource_key(resource)
+        if key in self._forward:
+            return
+        edges = extract_references(resource)
+        self._forward[key] = edges
+        for element, target in edges:
+            self._reverse.setdefault(target, {}).setdefault(key, []).append(element)
+
+    def remove(self, resource_type: str, resource_id: str) -> None:
+        """
+        Drop the outgoing references for a resource
+        """
+        key = (resource_type, resource_id)
+        for _, target in self._forward.pop(key, []):
+            sources = self._reverse.get(target, {})
+            sources.pop(key, None)
+            if not sources:
+                self._reverse.pop(target, None)
+
+    def references(self, resource_type: str, resource_id: str,
+                   element: Optional[str] = None) -> List[str]:
+        """
+        Get the references made by a resource
+        """
+        return [target for _element, target in self._forward.get((resource_type, resource_id), [])
+                if element is None or _element == element]
+
+    def referencing(self, target: str,
+                    element: Optional[str] = None,
+                    resource_type: Optional[str] = None,
+                    include_contained: bool = False) -> List[Tuple[str, str]]:
+        """
+        Get the keys of the resources that reference the target (ResourceType/id)
+        @param include_contained: also match references made by contained resources using the element
+        """
+        target = normalise_reference(target)
+        keys = []
+        for key, elements in self._reverse.get(target, {}).items():
+            if resource_type is not None and key[0] != resource_type:
+                continue
+            if not include_contained:
+                elements = [x for x in elements if not x.startswith("contained.")]
+            if element is not None:
+                elements = [x for x in elements if x in (element, f"contained.{element}")]
+            if elements:
+                keys.append(key)
+        return keys
+
+    def cascade(self, target: str, element: str = "basedOn") -> List[Tuple[str, str]]:
+        """
+        Walk the reverse edges for an element transitively (eg CarePlan <- ServiceRequest <- Encounter)
+        """
+        found = []
+        seen = {normalise_reference(target)}
+        pending = [normalise_reference(target)]
+        while pending:
+            _target = pending.pop(0)
+            for key in self.referencing(_target, element=element):
+                reference = "/".join(key)
+                if reference in seen:
+                    continue
+                seen.add(reference)
+                found.append(key)
+                pending.append(reference)
+        return found
@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
+from typing import Any, Callable, Iterable, List, NamedTuple, Optional, Sequence
+
+from .connector import Connector, DatasetRegistry, get_registry, set_registry
+
+# the connector for this process; inherited (or pickled) into the workers
+_connector = None
+
+
+class TaskResult(NamedTuple):
+    item: Any
+    elapsed: float
+    error: Optional[str] = None
+
+
+def _init_worker(connector: Optional[Connector], initializer: Optional[Callable], initargs: Sequence) -> None:
+    global _connector
+    if connector is not None:
+        _connector = connector
+        if connector.registry is not get_registry():
+            # spawned worker, share the copy of the loaded datasets with the process
+            set_registry(connector.registry)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def worker_connector() -> Connector:
+    """
+    Get the Connector shared with this process
+    """
+    global _connector
+    if _connector is None:
+        _connector = Connector()
+    return _connector
+
+
+def json_files(dirname: str) -> List[str]:
+    """
+    List the JSON files in a directory
+    """
+    return [os.path.join(dirname, fname) for fname in sorted(os.listdir(dirname)) if fname.endswith('.json')]
+
+
+def _run_one(func: Callable, item: Any, args: Sequence) -> TaskResult:
+    start = time.perf_counter()
+    try:
+        func(item, *args)
+    except Exception as exc:
+        traceback.print_exc()
+        return TaskResult(item, time.perf_counter() - start, f"{type(exc).__name__}: {exc}")
+    return TaskResult(item, time.perf_counter() - start)
+
+
+def run_parallel(func: Callable, items: Iterable[Any],
+                 jobs: int = 1,
+                 preload: Sequence[str] = (),
+                 args: Sequence = (),
+                 initializer: Optional[Callable] = None,
+                 initargs: Sequence = (),
+                 connector: Optional[Connector] = None) -> List[TaskResult]:
+    """
+    Run func(item, *args) for each item across a pool of worker processes
+    @param func: the (module level) function to run
+    @param items: the items to process (eg filenames)
+    @param jobs: the number of worker processes
+    @param preload: the SDTM domains to load once (as the transforms use them), before the workers start
+    @param args: extra arguments passed to func
+    @param initializer: called with initargs in each worker to set up shared state
+    @param connector: the Connector to share with the workers (one is created to preload the domains)
+    """
+    global _connector
+    items = list(items)
+    start = time.perf_counter()
+    if connector is not None:
+        _connector = connector
+    elif preload:
+        connector = worker_connector()
+    for domain in preload:
+        connector.load_cdiscpilot_dataset(domain, project=True)
+    if preload:
+        connector.memory_report()
+    if jobs <= 1 or len(items) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        results = [_run_one(func, item, args) for item in items]
+    else:
+        # fork shares the loaded domains with the workers without copying them
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = None
+        with ProcessPoolExecutor(max_workers=jobs,
+                                 mp_context=context,
+                                 initializer=_init_worker,
+                                 initargs=(connector, initializer, initargs)) as pool:
+            # batch the items to cut the IPC overhead for many small tasks
+            chunksize = max(1, len(items) // (jobs * 8))
+            results = list(pool.map(partial(_run_one, func), items, repeat(args), chunksize=chunksize))
+    report(results, time.perf_counter() - start, connector.registry if connector else None)
+    return results
+
+
+def report(results: List[TaskResult], wall_time: Optional[float] = None,
+           registry: Optional[DatasetRegistry] = None) -> None:
+    """
+    Print the timings and errors for a run
+    @param registry: the registry the datasets were loaded into (defaults to the process registry)
+    """
+    if not results:
+        print("Nothing to process")
+        return
+    total = sum(x.elapsed for x in results)
+    failed = [x for x in results if x.error]
+    # the individual timings are only useful for a handful of items
+    for result in (results if len(results) <= 50 else failed):
+        print(f"{result.item}: {result.elapsed:.2f}s{' ' + result.error if result.error else ''}")
+    print(f"Processed {len(results)} items ({len(failed)} failed) in {total:.2f}s "
+          f"(mean {total / len(results):.2f}s)")
+    if wall_time:
+        print(f"Elapsed {wall_time:.2f}s ({len(results) / wall_time:.1f} items/s)")
+    stats = (registry if registry else get_registry()).stats()
+    if stats["hits"] or stats["misses"]:
+        print("Dataset registry: {}".format(", ".join(f"{k}={v}" for k, v in stats.items())))
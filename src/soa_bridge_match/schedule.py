@@ -0,0 +1,230 @@
+from __future__ import annotations
+
+import hashlib
+import json
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+
+from .connector import ARTIFACT_DIR, ArtifactCache
+
+# bump when the layout of the compiled schedule changes
+SCHEDULE_VERSION = 2
+
+# offset units (UCUM codes and the common names) in minutes
+UNITS = {
+    "min": 1,
+    "h": 60,
+    "d": 24 * 60,
+    "wk": 7 * 24 * 60,
+    # UCUM mean Julian month and year
+    "mo": 30.4375 * 24 * 60,
+    "a": 365.25 * 24 * 60,
+}
+UNIT_ALIASES = {
+    "minute": "min", "minutes": "min",
+    "hour": "h", "hours": "h", "hr": "h",
+    "day": "d", "days": "d",
+    "week": "wk", "weeks": "wk", "w": "wk",
+    "month": "mo", "months": "mo",
+    "year": "a", "years": "a", "yr": "a", "y": "a",
+}
+
+
+def offset_minutes(quantity: Optional[dict]) -> Optional[int]:
+    """
+    Convert an offset Quantity (value, code/unit) to minutes
+    """
+    if not quantity or quantity.get("value") is None:
+        return None
+    unit = quantity.get("code") or quantity.get("unit") or "d"
+    unit = UNIT_ALIASES.get(unit.lower(), unit) if unit not in UNITS else unit
+    if unit not in UNITS:
+        raise ValueError(f"Unsupported offset unit {unit}")
+    return int(round(float(quantity["value"]) * UNITS[unit]))
+
+
+def _add(value: Optional[int], offset: Optional[int], sign: int = 1) -> Optional[int]:
+    if value is None or offset is None:
+        return None
+    return value + sign * offset
+
+
+def _as_dict(plan_definition) -> dict:
+    if isinstance(plan_definition, dict):
+        return plan_definition
+    return json.loads(plan_definition.json())
+
+
+class ProtocolSchedule:
+    """
+    The visit schedule compiled from the PlanDefinition actions; each action is
+    placed relative to the root (index) action of its relatedAction chain, as
+    offsets in minutes for the window (low, high, None is open) and the planned date
+    """
+
+    def __init__(self, key: str, actions: List[dict]) -> None:
+        self.key = key
+        # definition, root, low, high, expected (in topological order)
+        self._actions = actions
+        self._by_definition = {x["definition"]: x for x in actions}
+
+    @property
+    def actions(self) -> List[str]:
+        return [x["definition"] for x in self._actions]
+
+    @property
+    def roots(self) -> List[str]:
+        """
+        The index actions that other actions are scheduled from
+        """
+        roots = {x["root"] for x in self._actions if x["root"] != x["definition"]}
+        return [x for x in self.actions if x in roots]
+
+    def action(self, definition: str) -> dict:
+        return self._by_definition[definition]
+
+    @staticmethod
+    def cache_key(plan_definition) -> str:
+        """
+        The PlanDefinition url (or id) and version; the content digest stands in for a missing version
+        """
+        plan_definition = _as_dict(plan_definition)
+        version = plan_definition.get("version")
+        if not version:
+            version = hashlib.md5(json.dumps(plan_definition, sort_keys=True).encode('utf-8')).hexdigest()
+        return f"{plan_definition.get('url') or plan_definition.get('id')}|{version}"
+
+    @classmethod
+    def from_plan_definition(cls, plan_definition) -> ProtocolSchedule:
+        """
+        Resolve the relatedAction chains of the protocol design
+        """
+        plan_definition = _as_dict(plan_definition)
+        actions = plan_definition.get("action", [])
+        ids = {}
+        relations = {}
+        definitions = []
+        for idx, action in enumerate(actions):
+            definition = action.get("definitionUri") or action.get("definitionCanonical") or action.get("id") or str(idx)
+            definitions.append(definition)
+            if action.get("id"):
+                ids[action["id"]] = definition
+            for related in action.get("relatedAction", []):
+                if related.get("actionId"):
+                    relations[definition] = related
+                    break
+        # resolve the actions from the roots out (topological order)
+        compiled = {}
+        pending = list(definitions)
+        while pending:
+            progressed = False
+            for definition in list(pending):
+                related = relations.get(definition)
+                if related is None:
+                    compiled[definition] = dict(definition=definition, root=definition, low=0, high=0, expected=0)
+                else:
+                    if related["actionId"] not in ids:
+                        raise ValueError(f"Action {definition} is related to unknown action {related['actionId']}")
+                    parent = compiled.get(ids[related["actionId"]])
+                    if parent is None:
+                        continue
+                    offset = related.get("offsetRange") or {}
+                    # without an offset the action is only ordered against the related action
+                    low = offset_minutes(offset.get("low")) or 0
+                    high = offset_minutes(offset.get("high"))
+                    if "offsetDuration" in related:
+                        low = high = offset_minutes(related["offsetDuration"])
+                    if related.get("relationship", "after").startswith("before"):
+                        compiled[definition] = dict(definition=definition,
+                                                    root=parent["root"],
+                                                    low=_add(parent["low"], high, -1),
+                                                    high=_add(parent["high"], low, -1),
+                                                    expected=_add(parent["expected"], low, -1))
+                    else:
+                        compiled[definition] = dict(definition=definition,
+                                                    root=parent["root"],
+                                                    low=_add(parent["low"], low),
+                                                    high=_add(parent["high"], high),
+                                                    expected=_add(parent["expected"], low))
+                    compiled[definition]["parent"] = ids[related["actionId"]]
+                    compiled[definition]["relationship"] = related.get("relationship", "after")
+                pending.remove(definition)
+                progressed = True
+            if not progressed:
+                raise ValueError(f"The relatedAction chains for {', '.join(pending)} are circular")
+        return cls(cls.cache_key(plan_definition), [compiled[x] for x in definitions])
+
+    @classmethod
+    def compile(cls, plan_definition, cache_dir: Optional[str] = ARTIFACT_DIR) -> ProtocolSchedule:
+        """
+        Get the schedule for the PlanDefinition, from the disk cache when it has been compiled before
+        @param cache_dir: where the compiled schedules are kept (None to skip the cache)
+        """
+        cache = ArtifactCache(cache_dir, fmt="json")
+        key = cls.cache_key(plan_definition)
+        name = f"schedule-{hashlib.md5(key.encode('utf-8')).hexdigest()}"
+        data = cache.get(name, SCHEDULE_VERSION)
+        if data is not None and data.get("key") == key:
+            return cls.from_dict(data)
+        schedule = cls.from_plan_definition(plan_definition)
+        cache.put(name, SCHEDULE_VERSION, schedule.to_dict())
+        return schedule
+
+    def to_dict(self) -> dict:
+        return dict(key=self.key, actions=self._actions)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> ProtocolSchedule:
+        return cls(data["key"], data["actions"])
+
+    def is_scheduled(self, definition: str) -> bool:
+        """
+        Is the action placed by the schedule (a root, or related to one)
+        """
+        action = self._by_definition[definition]
+        return action["root"] != definition or definition in self.roots
+
+    def apply(self, index_dates: Union[Sequence, np.ndarray],
+              root: Optional[str] = None) -> Dict[str, np.ndarray]:
+        """
+        Work out the windows of the actions scheduled from a root for an array of index dates
+        @param index_dates: the index (root action) dates, one per subject
+        @param root: the root action (defaults to the only root)
+        @return: low, high and expected arrays of shape (subjects, actions), NaT where the window
+                 is open; actions follow the actions() order, those from other roots are NaT
+        """
+        if root is None:
+            roots = self.roots
+            if len(roots) != 1:
+                raise ValueError(f"The schedule has {len(roots)} roots, select one")
+            root = roots[0]
+        dates = np.asarray(index_dates, dtype="datetime64[m]")[:, None]
+        result = {}
+        for name in ("low", "high", "expected"):
+            offsets = np.array([x[name] if x["root"] == root and x[name] is not None else np.iinfo(np.int64).min
+                                for x in self._actions], dtype=np.int64)
+            # the minimum int64 is NaT
+            offsets = offsets.view("timedelta64[m]")[None, :]
+            result[name] = (dates + offsets).astype("datetime64[D]")
+        return result
+
+    def windows_many(self, index_dates: Union[Sequence, np.ndarray],
+                     root: Optional[str] = None) -> List[Dict[str, dict]]:
+        """
+        The windows (ISO dates, None if open) for the actions scheduled from the root, for each index date
+        """
+        root = root or self.roots[0]
+        applied = self.apply(index_dates, root)
+        columns = [(idx, x["definition"]) for idx, x in enumerate(self._actions) if x["root"] == root]
+        names = ("low", "high", "expected")
+        # NaT -> None, once for the whole array
+        text = {x: np.where(np.isnat(applied[x]), None, np.datetime_as_string(applied[x], unit="D")) for x in names}
+        return [{definition: {x: text[x][row, idx] for x in names} for idx, definition in columns}
+                for row in range(len(applied["low"]))]
+
+    def windows(self, index_date, root: Optional[str] = None) -> Dict[str, dict]:
+        """
+        The windows (ISO dates, None if open) for the actions scheduled from the root for one subject
+        """
+        return self.windows_many([index_date], root)[0]
@@ -0,0 +1,265 @@
+from __future__ import annotations
+
+import os
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl
+
+from .bundler import SourcedBundle
+from .references import ReferenceGraph, normalise_reference, resource_key
+
+# the elements searched by the date parameter
+DATE_ELEMENTS = {
+    "Encounter": ("period",),
+    "CarePlan": ("period",),
+    "Observation": ("effectiveDateTime", "effectivePeriod", "effectiveInstant"),
+    "MedicationStatement": ("effectiveDateTime", "effectivePeriod"),
+    "Procedure": ("performedDateTime", "performedPeriod"),
+    "AdverseEvent": ("date",),
+}
+
+# reference search parameters -> the element they search
+REFERENCE_PARAMETERS = {
+    "subject": "subject",
+    "based-on": "basedOn",
+    "encounter": "encounter",
+    "instantiates-canonical": "instantiatesCanonical",
+}
+
+# parameters that don't filter the results
+IGNORED_PARAMETERS = ("_count", "_format", "_sort", "_elements")
+
+# date search prefixes
+DATE_PREFIXES = ("eq", "ne", "gt", "lt", "ge", "le")
+
+
+def _day(value: str, upper: bool = False) -> str:
+    """
+    Reduce a date(time) to day precision; partial dates cover the whole year or month
+    """
+    if len(value) >= 10:
+        return value[:10]
+    if upper:
+        return value + "-99" * ((10 - len(value)) // 3)
+    return value
+
+
+def resource_dates(resource: dict, elements: Optional[dict] = None) -> Optional[Tuple[str, str]]:
+    """
+    The (start, end) days for the date of a resource, None if it has none
+    @param elements: the date elements by resource type (defaults to those for the date parameter)
+    """
+    elements = elements if elements else DATE_ELEMENTS
+    for element in elements.get(resource["resourceType"], ()):
+        value = resource.get(element)
+        if not value:
+            continue
+        if isinstance(value, dict):
+            if not value.get("start"):
+                continue
+            # a period without an end is ongoing
+            return _day(value["start"]), _day(value["end"], True) if value.get("end") else "9999-99-99"
+        return _day(value), _day(value, True)
+    return None
+
+
+def date_matches(dates: Optional[Tuple[str, str]], value: str) -> bool:
+    """
+    Match the dates of a resource against a date search value (eg ge2014-01-01)
+    """
+    if dates is None:
+        return False
+    prefix, value = (value[:2], value[2:]) if value[:2].isalpha() else ("eq", value)
+    if prefix not in DATE_PREFIXES:
+        raise ValueError(f"Unsupported date prefix {prefix}")
+    start, end = dates
+    low, high = _day(value), _day(value, True)
+    if prefix == "eq":
+        return low <= start and end <= high
+    if prefix == "ne":
+        return not (low <= start and end <= high)
+    if prefix == "ge":
+        return end >= low
+    if prefix == "le":
+        return start <= high
+    if prefix == "gt":
+        return end > high
+    return start < low
+
+
+class BundleSearch:
+    """
+    In-memory FHIR search over a set of subject bundles, implementing the subset
+    of the search API used by StudyWindow; it offers the same get/get_many interface
+    as the HTTP query engine, so it can be used in place of a server
+    """
+
+    def __init__(self, bundles: Iterable[SourcedBundle] = ()) -> None:
+        self._resources = {}
+        # insertion order, so the results come back in a stable order
+        self._order = {}
+        self._types = {}
+        self._dates = {}
+        self._graph = ReferenceGraph()
+        for bundle in bundles:
+            self.add_bundle(bundle)
+
+    @classmethod
+    def from_directory(cls, dirname: str) -> BundleSearch:
+        """
+        Index the bundles in a directory (eg the generated subject bundles)
+        """
+        search = cls()
+        for fname in sorted(os.listdir(dirname)):
+            if fname.endswith('.json'):
+                search.add_bundle(SourcedBundle.from_bundle_file(os.path.join(dirname, fname), raw=True))
+        return search
+
+    def __len__(self) -> int:
+        return len(self._resources)
+
+    def add_bundle(self, bundle: SourcedBundle) -> None:
+        for resource in bundle.resource_dicts():
+            self.add(resource)
+
+    def add(self, resource: dict) -> None:
+        """
+        Index a resource (the shared resources in several bundles are only indexed once)
+        """
+        key = resource_key(resource)
+        if key in self._resources:
+            return
+        self._resources[key] = resource
+        self._order[key] = len(self._order)
+        self._types.setdefault(key[0], []).append(key)
+        self._dates[key] = resource_dates(resource)
+        self._graph.add(resource)
+
+    def read(self, resource_type: str, resource_id: str) -> Optional[dict]:
+        return self._resources.get((resource_type, resource_id))
+
+    def _patient_keys(self, resource_type: str, value: str) -> Set[tuple]:
+        target = value if "/" in value else f"Patient/{value}"
+        return (set(self._graph.referencing(target, "subject", resource_type)) |
+                set(self._graph.referencing(target, "individual", resource_type)))
+
+    def _study_matches(self, resource: dict, value: str) -> bool:
+        reference = (resource.get("study") or {}).get("reference")
+        if not reference:
+            return False
+        study_id = normalise_reference(reference).split("/")[-1]
+        if study_id == value:
+            return True
+        study = self._resources.get(("ResearchStudy", study_id), {})
+        return any(x.get("value") == value for x in study.get("identifier", []))
+
+    @staticmethod
+    def _identifier_matches(resource: dict, value: str) -> bool:
+        system, _, value = value.rpartition("|")
+        return any(x.get("value") == value and (not system or x.get("system") == system)
+                   for x in resource.get("identifier", []))
+
+    def _revinclude(self, keys: List[tuple], value: str) -> List[tuple]:
+        resource_type, _, parameter = value.partition(":")
+        if parameter not in REFERENCE_PARAMETERS and parameter != "patient":
+            raise ValueError(f"Unsupported _revinclude {value}")
+        element = REFERENCE_PARAMETERS.get(parameter, "subject")
+        included = []
+        for key in keys:
+            included.extend(self._graph.referencing("/".join(key), element, resource_type))
+        return included
+
+    def search_keys(self, resource_type: str, params: List[Tuple[str, str]]) -> List[tuple]:
+        """
+        Get the keys of the resources matching the search parameters
+        """
+        candidates = None
+        filters = []
+        for name, value in params:
+            if name in IGNORED_PARAMETERS or name.startswith("_revinclude") or name == "_summary":
+                continue
+            if name == "patient":
+                keys = self._patient_keys(resource_type, value)
+            elif name in REFERENCE_PARAMETERS:
+                keys = set(self._graph.referencing(value, REFERENCE_PARAMETERS[name], resource_type))
+            elif name == "_id":
+                keys = {(resource_type, value)} if (resource_type, value) in self._resources else set()
+            elif name == "identifier":
+                filters.append(lambda key, _value=value: self._identifier_matches(self._resources[key], _value))
+                continue
+            elif name == "study":
+                filters.append(lambda key, _value=value: self._study_matches(self._resources[key], _value))
+                continue
+            elif name == "date":
+                filters.append(lambda key, _value=value: date_matches(self._dates[key], _value))
+                continue
+            else:
+                raise ValueError(f"Unsupported search parameter {name}")
+            candidates = keys if candidates is None else candidates & keys
+        if candidates is None:
+            candidates = self._types.get(resource_type, [])
+        matches = [key for key in candidates if all(x(key) for x in filters)]
+        return sorted(matches, key=self._order.get)
+
+    def search(self, resource_type: str, params: List[Tuple[str, str]]) -> dict:
+        """
+        Run a search, returning the searchset Bundle
+        """
+        matches = self.search_keys(resource_type, params)
+        summary = dict(params).get("_summary")
+        if summary == "count":
+            return dict(resourceType="Bundle", type="searchset", total=len(matches))
+        entries = [(key, "match") for key in matches]
+        seen = set(matches)
+        for name, value in params:
+            if name == "_revinclude":
+                for key in self._revinclude(matches, value):
+                    if key not in seen:
+                        seen.add(key)
+                        entries.append((key, "include"))
+        iterate = [value for name, value in params if name == "_revinclude:iterate"]
+        pending = [key for key, _ in entries]
+        while iterate and pending:
+            found = []
+            for value in iterate:
+                for key in self._revinclude(pending, value):
+                    if key not in seen:
+                        seen.add(key)
+                        found.append(key)
+                        entries.append((key, "include"))
+            pending = found
+        return dict(resourceType="Bundle",
+                    type="searchset",
+                    total=len(matches),
+                    entry=[dict(fullUrl="/".join(key),
+                                resource=self._resources[key],
+                                search=dict(mode=mode)) for key, mode in entries])
+
+    def capability_statement(self) -> dict:
+        revincludes = [f"{x}:{y}" for x in ("ServiceRequest", "Encounter") for y in REFERENCE_PARAMETERS]
+        return dict(resourceType="CapabilityStatement",
+                    status="active",
+                    kind="instance",
+                    fhirVersion="4.0.1",
+                    format=["json"],
+                    rest=[dict(mode="server",
+                               resource=[dict(type=x, searchRevInclude=revincludes) for x in sorted(self._types)])])
+
+    def get(self, url: str) -> Optional[dict]:
+        """
+        Run a (relative) FHIR URL; None where a server would not respond with a 200
+        """
+        path, _, query = url.partition("?")
+        path = path.strip("/")
+        if path == "metadata":
+            return self.capability_statement()
+        if not query and "/" in path:
+            resource_type, resource_id = path.split("/", 1)
+            return self.read(resource_type, resource_id)
+        try:
+            return self.search(path, parse_qsl(query))
+        except ValueError as exc:
+            print(f"Unable to search {url}: {exc}")
+            return None
+
+    def get_many(self, urls: Iterable[str]) -> Dict[str, Optional[dict]]:
+        return {url: self.get(url) for url in urls}
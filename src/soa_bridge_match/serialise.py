@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import datetime
+import decimal
+import gzip
+import json
+import re
+from typing import BinaryIO, Callable, Iterable, Optional
+
+from pydantic.datetime_parse import parse_date, parse_datetime, parse_time
+
+try:
+    import orjson
+except ImportError:
+    # the stdlib encoder is used instead
+    orjson = None
+
+FORMATS = ("json", "ndjson")
+
+# the strings that are parsed into dates, datetimes and times
+_TEMPORAL = re.compile(r"^(\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}:\d{2}.*)?|\d{2}:\d{2}:\d{2}(\.\d+)?)$")
+
+
+def _default(obj):
+    """
+    Encode the values the model dicts carry that JSON has no type for
+    """
+    if isinstance(obj, decimal.Decimal):
+        # as the pydantic encoder does, so 58.0 stays 58.0
+        return int(obj) if obj.as_tuple().exponent >= 0 else float(obj)
+    if isinstance(obj, (datetime.date, datetime.datetime, datetime.time)):
+        return obj.isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def _temporal_key(value) -> tuple:
+    # equal datetimes in different timezones are different strings
+    offset = value.utcoffset() if isinstance(value, (datetime.datetime, datetime.time)) else None
+    return type(value), value, offset
+
+
+def _parse_temporal(value: str):
+    if "T" in value:
+        return parse_datetime(value)
+    if "-" in value:
+        return parse_date(value)
+    return parse_time(value)
+
+
+class TemporalStrings:
+    """
+    The source strings for the dates, datetimes and times parsed into the models, so
+    that the values are written as they were read (the parsed value loses the form,
+    e.g. Z rather than +00:00 or the number of fraction digits)
+    """
+
+    def __init__(self) -> None:
+        # (type, value, utc offset) -> source string
+        self._strings = {}
+
+    def __len__(self) -> int:
+        return len(self._strings)
+
+    def collect(self, content) -> None:
+        """
+        Record the temporal strings in the parsed JSON
+        """
+        if isinstance(content, dict):
+            for value in content.values():
+                self.collect(value)
+        elif isinstance(content, list):
+            for value in content:
+                self.collect(value)
+        elif isinstance(content, str) and _TEMPORAL.match(content):
+            try:
+                value = _parse_temporal(content)
+            except ValueError:
+                return
+            self._strings.setdefault(_temporal_key(value), content)
+
+    def default(self, obj):
+        """
+        Encoder that writes the source string for a known value
+        """
+        if isinstance(obj, (datetime.date, datetime.datetime, datetime.time)):
+            source = self._strings.get(_temporal_key(obj))
+            if source is not None:
+                return source
+        return _default(obj)
+
+
+def dumps(obj, indent: bool = False, default: Optional[Callable] = None) -> bytes:
+    """
+    Serialise to JSON, using orjson when available
+    @param default: encoder for the values JSON has no type for (this includes the
+                    dates, datetimes and times, rather than the isoformat)
+    """
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 if indent else 0
+        if default is not None:
+            option |= orjson.OPT_PASSTHROUGH_DATETIME
+        return orjson.dumps(obj, default=default or _default, option=option)
+    if indent:
+        return json.dumps(obj, default=default or _default, indent=2).encode("utf-8")
+    return json.dumps(obj, default=default or _default, separators=(",", ":")).encode("utf-8")
+
+
+def loads(content: bytes):
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def open_output(filename: str, compress: bool = False) -> BinaryIO:
+    if compress:
+        return gzip.open(filename, "wb")
+    return open(filename, "wb")
+
+
+def output_filename(name: str, fmt: str = "json", compress: bool = False) -> str:
+    return f"{name}.{fmt}{'.gz' if compress else ''}"
+
+
+def write_json(f: BinaryIO, header: dict, entries: Iterable[dict], indent: bool = False,
+               default: Optional[Callable] = None) -> None:
+    """
+    Write a bundle one entry at a time, rather than building the whole document
+    (entries that are already serialised are written as is)
+    @param default: encoder passed to dumps
+    """
+    newline = b"\n" if indent else b""
+    f.write(b"{" + newline)
+    for key, value in header.items():
+        if key == "entry":
+            continue
+        f.write(dumps(key) + b":" + dumps(value, default=default) + b"," + newline)
+    f.write(b'"entry":[' + newline)
+    for idx, entry in enumerate(entries):
+        if idx:
+            f.write(b"," + newline)
+        f.write(entry if isinstance(entry, bytes) else dumps(entry, indent, default))
+    f.write(newline + b"]}" + newline)
+
+
+def write_ndjson(f: BinaryIO, resources: Iterable[dict], default: Optional[Callable] = None) -> None:
+    """
+    Write one resource per line (for the FHIR bulk import)
+    @param default: encoder passed to dumps
+    """
+    for resource in resources:
+        f.write(resource if isinstance(resource, bytes) else dumps(resource, default=default))
+        f.write(b"\n")
@@ -1,14 +1,219 @@
+import hashlib
+import json
 import os
 import random
-from typing import Optional
+from typing import Dict, List, Optional, Tuple, Union
 
 from fhir.resources.bundle import Bundle
-from fhir.resources.codeableconcept import CodeableConcept
 from fhir.resources.observation import Observation
 from dotenv import load_dotenv
 
+from .connector import ARTIFACT_DIR, ArtifactCache
+
 load_dotenv()
 
+# where the observation catalogues are written (defaults to the artifact directory)
+SYNTHEA_INDEX_DIR = os.getenv("SYNTHEA_INDEX_DIR", ARTIFACT_DIR)
+
+# bump when the layout of the catalogue changes
+CATALOGUE_VERSION = 2
+
+LOINC = "http://loinc.org"
+
+
+def _scan_entries(content: bytes):
+    """
+    Yield (offset, length, entry) for the entries of a bundle document
+    """
+    # latin-1 maps each byte to one character, so the positions are byte offsets
+    # (the values we look at are all ASCII)
+    text = content.decode("latin-1")
+    decoder = json.JSONDecoder()
+    start = text.find('"entry"')
+    if start == -1:
+        return
+    idx = text.index("[", start) + 1
+    while True:
+        while text[idx] in " \t\r\n,":
+            idx += 1
+        if text[idx] == "]":
+            return
+        entry, end = decoder.raw_decode(text, idx)
+        yield idx, end - idx, entry
+        idx = end
+
+
+def index_observations(filename: str) -> List[list]:
+    """
+    Catalogue the Observations in a Synthea bundle as [offset, length, categories, LOINC code]
+    """
+    with open(filename, "rb") as f:
+        content = f.read()
+    rows = []
+    for offset, length, entry in _scan_entries(content):
+        resource = entry.get("resource", {})
+        if resource.get("resourceType") != "Observation":
+            continue
+        categories = sorted({coding.get("code") for category in resource.get("category", [])
+                             for coding in category.get("coding", []) if coding.get("code")})
+        codes = [coding.get("code") for coding in resource.get("code", {}).get("coding", [])
+                 if coding.get("system") == LOINC]
+        rows.append([offset, length, categories, codes[0] if codes else None])
+    return rows
+
+
+class ObservationCatalogue:
+    """
+    Persistent index of the Observations in the Synthea bundles, so a pick only
+    reads the one resource; files are re-indexed when they change
+    """
+
+    def __init__(self, path: str, index_dir: Optional[str] = None) -> None:
+        self.path = path
+        self._cache = ArtifactCache(index_dir if index_dir else SYNTHEA_INDEX_DIR, fmt="json")
+        self._files = {}
+        # category -> [(file name, offset, length)]
+        self._by_category = {}
+        # (category, LOINC code) -> [(file name, offset, length)]
+        self._by_code = {}
+
+    @property
+    def name(self) -> str:
+        return f"synthea-{hashlib.md5(os.path.abspath(self.path).encode('utf-8')).hexdigest()}"
+
+    def _read(self) -> dict:
+        catalogue = self._cache.get(self.name, CATALOGUE_VERSION)
+        return catalogue.get("files", {}) if catalogue else {}
+
+    def _write(self) -> None:
+        self._cache.put(self.name, CATALOGUE_VERSION, dict(path=self.path, files=self._files))
+
+    def refresh(self) -> int:
+        """
+        Bring the catalogue up to date with the directory, returning the number of files indexed
+        """
+        known = self._read()
+        files = {}
+        indexed = 0
+        for fname in sorted(os.listdir(self.path)):
+            filename = os.path.join(self.path, fname)
+            if not fname.endswith(".json") or not os.path.isfile(filename):
+                continue
+            stat = os.stat(filename)
+            entry = known.get(fname)
+            if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                files[fname] = entry
+                continue
+            files[fname] = dict(size=stat.st_size, mtime=stat.st_mtime,
+                                observations=index_observations(filename))
+            indexed += 1
+        self._files = files
+        if indexed or len(files) != len(known):
+            print(f"Indexed {indexed} Synthea files ({len(files)} in catalogue)")
+            self._write()
+        self._build()
+        return indexed
+
+    def _build(self) -> None:
+        self._by_category = {}
+        self._by_code = {}
+        for fname, entry in self._files.items():
+            for offset, length, categories, code in entry["observations"]:
+                location = (fname, offset, length)
+                for category in categories:
+                    self._by_category.setdefault(category, []).append(location)
+                    if code:
+                        self._by_code.setdefault((category, code), []).append(location)
+
+    def _ensure(self) -> None:
+        if not self._files:
+            self.refresh()
+
+    def count(self, category: str, code: Optional[str] = None) -> int:
+        self._ensure()
+        if code:
+            return len(self._by_code.get((category, code), []))
+        return len(self._by_category.get(category, []))
+
+    def codes(self, category: str) -> Dict[str, int]:
+        """
+        The LOINC codes (and counts) catalogued for a category
+        """
+        self._ensure()
+        return {code: len(x) for (_category, code), x in self._by_code.items() if _category == category}
+
+    def locations(self, category: str, code: Optional[str] = None) -> List[Tuple[str, int, int]]:
+        self._ensure()
+        if code:
+            return self._by_code.get((category, code), [])
+        return self._by_category.get(category, [])
+
+    def read(self, location: Tuple[str, int, int]) -> dict:
+        """
+        Read a single catalogued Observation
+        """
+        fname, offset, length = location
+        with open(os.path.join(self.path, fname), "rb") as f:
+            f.seek(offset)
+            entry = json.loads(f.read(length))
+        return entry["resource"]
+
+    def read_many(self, locations: List[Tuple[str, int, int]]) -> List[dict]:
+        """
+        Read a batch of catalogued Observations (in order), opening each file once
+        """
+        resources = [None] * len(locations)
+        by_file = {}
+        for idx, (fname, offset, length) in enumerate(locations):
+            by_file.setdefault(fname, []).append((offset, length, idx))
+        for fname, items in by_file.items():
+            with open(os.path.join(self.path, fname), "rb") as f:
+                for offset, length, idx in sorted(items):
+                    f.seek(offset)
+                    resources[idx] = json.loads(f.read(length))["resource"]
+        return resources
+
+    def sample(self, category: str, k: int,
+               distribution: Union[str, Dict[str, float]] = "uniform",
+               rng: random.Random = random) -> List[Tuple[str, int, int]]:
+        """
+        Sample the locations of k Observations
+        @param distribution: uniform (over the Observations), by-code (each LOINC code equally likely)
+                             or a dict of weights by LOINC code
+        """
+        locations = self.locations(category)
+        if not locations:
+            raise ValueError(f"No Synthea Observations for category {category}")
+        if distribution == "uniform":
+            return rng.choices(locations, k=k)
+        if distribution == "by-code":
+            codes = sorted(self.codes(category))
+            weights = None
+        elif isinstance(distribution, dict):
+            codes = [x for x in distribution if self.count(category, x)]
+            weights = [distribution[x] for x in codes]
+            if not codes:
+                raise ValueError(f"No Synthea Observations for category {category} with the weighted codes")
+        else:
+            raise ValueError(f"Unknown distribution {distribution}")
+        return [rng.choice(self.locations(category, code)) for code in rng.choices(codes, weights=weights, k=k)]
+
+    def pick(self, category: str, code: Optional[str] = None, rng: random.Random = random) -> dict:
+        locations = self.locations(category, code)
+        if not locations:
+            raise ValueError(f"No Synthea Observations for category {category}" + (f" and code {code}" if code else ""))
+        return self.read(rng.choice(locations))
+
+
+# the catalogues loaded in this process (by path)
+_catalogues = {}
+
+
+def get_catalogue(path: str) -> ObservationCatalogue:
+    if path not in _catalogues:
+        _catalogues[path] = ObservationCatalogue(path)
+    return _catalogues[path]
+
 
 class SyntheaPicker:
 
@@ -25,6 +230,10 @@ class SyntheaPicker:
                                 os.path.splitext(os.path.join(self.path, f))[1] == '.json']
         return self._candidates
 
+    @property
+    def catalogue(self) -> ObservationCatalogue:
+        return get_catalogue(self.path)
+
     def pick_file(self, file_name):
         return os.path.join(self.path, file_name)
 
@@ -34,17 +243,16 @@ class SyntheaPicker:
         bundle = Bundle.parse_file(self.pick_file(target))
         return bundle
 
-    def _pick_observation_by_category(self, category: str) -> Observation:
-        bundle = self.get_pick()
-        _obs = []
-        for entry in bundle.entry:
-            if entry.resource.resource_type == 'Observation':
-                resource = entry.resource  # type: Observation
-                for code in resource.category:  # type: CodeableConcept
-                    for coding in code.coding:
-                        if coding.code == category:
-                            _obs.append(resource)
-        return random.choice(_obs)
+    def _pick_observation_by_category(self, category: str, code: Optional[str] = None) -> Observation:
+        return Observation.parse_obj(self.catalogue.pick(category, code))
+
+    def get_observation(self, category: str, code: Optional[str] = None) -> Observation:
+        """
+        Pick an Observation from the catalogue
+        @param category: the Observation category (eg laboratory)
+        @param code: the LOINC code
+        """
+        return self._pick_observation_by_category(category, code)
 
     def get_lab_observation(self) -> Observation:
         return self._pick_observation_by_category('laboratory')
@@ -0,0 +1,519 @@
+from __future__ import annotations
+
+import os
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from fhir.resources import get_fhir_model_class
+from pandas import DataFrame, Series
+
+from .cloner import hh
+from .config import Configuration, TestCodeMapper
+from .units import ucum_quantity
+
+# where the domain configurations are kept
+CONFIG_DIR = os.getenv("CDISCPILOT_CONFIG_DIR",
+                       os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "doc", "config"))
+
+LOINC = "http://loinc.org"
+SNOMED = "http://snomed.info/sct"
+BODY_POSITION = "http://hl7.org/fhir/StructureDefinition/observation-bodyPosition"
+
+# VSPOS -> SNOMED body position
+POSITIONS = {"SUPINE": ("40199007", "Supine body position"),
+             "STANDING": ("10904000", "Orthostatic body position"),
+             "SITTING": ("33586001", "Sitting position")}
+
+# the column used where a complex element is mapped from a single column
+DEFAULT_ELEMENTS = {"Identifier": "value",
+                    "CodeableConcept": "text",
+                    "Quantity": "value",
+                    "Reference": "display"}
+
+
+# the study the subjects are enrolled in
+STUDY_COLUMN = "STUDYID"
+
+# the resources there is one of per subject, and their ids from the subject id
+SUBJECT_RESOURCES = {"Patient": hh,
+                     "ResearchSubject": lambda x: x}
+
+
+def _present(values: Series) -> Series:
+    """
+    Missing values to None (the element is left out)
+    """
+    return values.astype(object).where(values.notna(), None)
+
+
+def map_distinct(values: Series, func: Callable) -> Series:
+    """
+    Map the values of a column through a function called once for each distinct value;
+    the domain columns (test codes, units, dates) have few distinct values
+    """
+    codes, uniques = pd.factorize(values)
+    # the missing values (code -1) pick the trailing None
+    mapped = np.array([func(x) for x in uniques] + [None], dtype=object)
+    return Series(mapped[codes], index=values.index, dtype=object)
+
+
+def _text(value) -> Optional[str]:
+    if isinstance(value, (float, np.floating)):
+        # SAS stores the numbers as floats
+        return str(int(value)) if value == int(value) else str(value)
+    return str(value).strip() or None
+
+
+def _as_string(values: Series, frame: DataFrame) -> Series:
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return _as_datetime(values, frame)
+    return map_distinct(values, _text)
+
+
+def _as_decimal(values: Series, frame: DataFrame) -> Series:
+    numbers = pd.to_numeric(values, errors="coerce")
+    if numbers.dtype == np.float32:
+        # (compacted) the float32 values are exact
+        numbers = numbers.astype(np.float64)
+    return _present(numbers)
+
+
+def _as_integer(values: Series, frame: DataFrame) -> Series:
+    return _present(pd.to_numeric(values, errors="coerce").round().astype("Int64"))
+
+
+def _as_date(values: Series, frame: DataFrame) -> Series:
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return map_distinct(values, lambda x: x.strftime("%Y-%m-%d"))
+    return map_distinct(values, lambda x: _text(x)[:10] if _text(x) else None)
+
+
+def _as_datetime(values: Series, frame: DataFrame) -> Series:
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return map_distinct(values, lambda x: x.strftime("%Y-%m-%dT%H:%M:%S"))
+    return map_distinct(values, _text)
+
+
+# FHIR primitive type -> column conversion
+CONVERTERS = {"Decimal": _as_decimal,
+              "Integer": _as_integer,
+              "PositiveInt": _as_integer,
+              "UnsignedInt": _as_integer,
+              "Date": _as_date,
+              "DateTime": _as_datetime,
+              "Instant": _as_datetime}
+
+
+def _lookup_unit_ucum(values: Series, frame: DataFrame) -> Series:
+    """
+    The unit with its UCUM code, from the CDISC unit code table
+    """
+    return map_distinct(_as_string(values, frame), ucum_quantity)
+
+
+def _lookup_loinc_code(values: Series, frame: DataFrame) -> Series:
+    """
+    The LOINC coding for the test, from the --LOINC column where the domain has one, otherwise
+    (for LB) from the LOINC to LB mapping
+    """
+    prefix = values.name[:2]
+    codes = Series(None, index=values.index, dtype=object)
+    displays = Series(None, index=values.index, dtype=object)
+    if prefix == "LB":
+        match = get_mapper().map_many(frame, prefix)
+        codes, displays = match.codes.LOINC, match.codes.DISPLAY
+    if f"{prefix}LOINC" in frame.columns:
+        given = _as_string(frame[f"{prefix}LOINC"], frame)
+        codes = given.where(given.notna(), codes)
+        displays = displays.where(given.isna(), None)
+    if codes.isna().all():
+        return codes
+
+    def _coding(code_display):
+        code, display = code_display
+        if not code:
+            return None
+        return dict(coding=[dict(system=LOINC, code=code, display=display) if display else dict(system=LOINC, code=code)])
+
+    return map_distinct(Series(list(zip(codes, displays)), index=values.index, dtype=object), _coding)
+
+
+_mapper = None
+
+
+def get_mapper() -> TestCodeMapper:
+    global _mapper
+    if _mapper is None:
+        _mapper = TestCodeMapper()
+    return _mapper
+
+
+def _lookup_loinc_name(values: Series, frame: DataFrame) -> Series:
+    return map_distinct(_as_string(values, frame), lambda x: dict(text=x))
+
+
+def _lookup_body_position(values: Series, frame: DataFrame) -> Series:
+    def _extension(position):
+        if position not in POSITIONS:
+            return None
+        code, display = POSITIONS[position]
+        return dict(url=BODY_POSITION,
+                    valueCodeableConcept=dict(coding=[dict(system=SNOMED, code=code, display=display)]))
+
+    return map_distinct(_as_string(values, frame), _extension)
+
+
+def _lookup_snomed_code(values: Series, frame: DataFrame) -> Series:
+    # no SNOMED table for the locations, they are kept as text
+    return map_distinct(_as_string(values, frame), lambda x: dict(text=x))
+
+
+# the _lookup_* hooks for the configurations; each takes the column (and the domain)
+# and returns the partial element for each row (None to leave it out); the elements are
+# shared between the rows with the same value, so they are not changed once set
+HOOKS = {"_lookup_unit_ucum": _lookup_unit_ucum,
+         "_lookup_loinc_code": _lookup_loinc_code,
+         "_lookup_loinc_name": _lookup_loinc_name,
+         "_lookup_loinc_test": _lookup_loinc_name,
+         "_lookup_body_position": _lookup_body_position,
+         "_lookup_snomed_code": _lookup_snomed_code}
+
+# the other columns of the domain (by suffix) a hook reads
+HOOK_COLUMNS = {"_lookup_loinc_code": ("TESTCD", "CAT", "SPEC", "ORRESU", "LOINC")}
+
+
+def _merge(target: dict, value: dict) -> None:
+    """
+    Merge a partial element into an element; only the target is changed, the lists and
+    elements under it are replaced rather than updated, so they can be shared between rows
+    """
+    for name, item in value.items():
+        current = target.get(name)
+        if isinstance(item, list) and isinstance(current, list):
+            target[name] = current + item
+        elif isinstance(item, dict) and isinstance(current, dict):
+            merged = dict(current)
+            _merge(merged, item)
+            target[name] = merged
+        else:
+            target[name] = item
+
+
+def make_setter(path: Tuple[Tuple[str, bool], ...], merge: bool = False) -> Callable[[dict, object], None]:
+    """
+    Build the function that sets a value at an element path in a resource dict
+    @param path: the (element, is a list) steps; lists are set on their first item
+    @param merge: the value is a partial element merged into the element (an item added to a list)
+    """
+    parents, (leaf, leaf_list) = path[:-1], path[-1]
+    if leaf_list:
+        def put(node: dict, value) -> None:
+            node.setdefault(leaf, []).append(value)
+    elif merge:
+        def put(node: dict, value) -> None:
+            current = node.get(leaf)
+            if current is None:
+                node[leaf] = value
+            else:
+                merged = dict(current)
+                _merge(merged, value)
+                node[leaf] = merged
+    else:
+        def put(node: dict, value) -> None:
+            node[leaf] = value
+    if not parents:
+        return put
+    if len(parents) == 1:
+        # the common cases are spelled out, rather than walking the path
+        parent, parent_list = parents[0]
+        if parent_list:
+            def setter(resource: dict, value) -> None:
+                put(resource.setdefault(parent, [{}])[0], value)
+        else:
+            def setter(resource: dict, value) -> None:
+                put(resource.setdefault(parent, {}), value)
+        return setter
+
+    def setter(resource: dict, value) -> None:
+        node = resource
+        for name, is_list in parents:
+            if is_list:
+                node = node.setdefault(name, [{}])[0]
+            else:
+                node = node.setdefault(name, {})
+        put(node, value)
+    return setter
+
+
+class ColumnRule(NamedTuple):
+    column: str
+    resource_type: str
+    path: Tuple[Tuple[str, bool], ...]
+    # the values for the rows, from the column and the domain
+    values: Callable[[Series, DataFrame], Series]
+    setter: Callable[[dict, object], None]
+    # the value, for the fixed values
+    constant: Optional[str] = None
+    # the values are partial elements (from a hook)
+    merge: bool = False
+    # the other columns the values are worked out from
+    columns: Tuple[str, ...] = ()
+
+    @property
+    def element(self) -> str:
+        return ".".join(x for x, _ in self.path)
+
+
+def _element_type(field) -> Tuple[Optional[type], str]:
+    """
+    The model class (None for a primitive) and the FHIR type name for a model field
+    """
+    type_name = getattr(field.type_, "__resource_type__", None)
+    if type_name and type_name not in ("Resource", "Element"):
+        return get_fhir_model_class(type_name), type_name
+    return None, field.type_.__name__
+
+
+def _field(model_class, name: str):
+    for field in model_class.__fields__.values():
+        if field.alias == name:
+            return field
+    raise ValueError(f"{model_class.__name__} has no element {name}")
+
+
+def _complete_research_subjects(resources: List[dict], subject_ids: List[str],
+                                studies: List[Optional[str]]) -> Tuple[List[dict], List[str]]:
+    """
+    Fill in the elements a ResearchSubject requires that the configuration doesn't map: the
+    status, the subject's Patient and the study (from STUDYID); those without a study are left out
+    """
+    complete = ([], [])
+    for resource, subject_id, study in zip(resources, subject_ids, studies):
+        resource.setdefault("status", "on-study")
+        resource.setdefault("individual", dict(reference=f"Patient/{hh(subject_id)}"))
+        if "study" not in resource and study:
+            resource["study"] = dict(identifier=dict(value=study))
+        if "study" in resource:
+            complete[0].append(resource)
+            complete[1].append(subject_id)
+    if len(complete[0]) < len(resources):
+        print(f"No study for {len(resources) - len(complete[0])} ResearchSubject resources, left out")
+    return complete
+
+
+class DomainTransform:
+    """
+    An SDTM domain configuration compiled into the rules that convert the domain to FHIR
+    resources; the element paths, the value conversions and the _lookup_* hooks are
+    resolved once, so converting a domain is a pass over each mapped column
+    """
+
+    def __init__(self, domain: str, key: str, rules: List[ColumnRule],
+                 id_columns: Optional[List[str]] = None) -> None:
+        self.domain = domain
+        self.key = key
+        self.rules = rules
+        # the columns identifying a record (the key and the --SEQ column by default)
+        self.id_columns = id_columns
+
+    @classmethod
+    def for_domain(cls, domain: str, config_dir: str = CONFIG_DIR,
+                   hooks: Optional[Dict[str, Callable]] = None) -> DomainTransform:
+        """
+        Compile the configuration for a domain (eg lb.yml for LB)
+        """
+        path = os.path.join(config_dir, f"{domain.lower()}.yml")
+        if not os.path.exists(path):
+            raise ValueError(f"No configuration for {domain} in {config_dir}")
+        return cls.compile(Configuration.from_file(path), domain.upper(), hooks)
+
+    @classmethod
+    def compile(cls, config: Configuration, domain: str,
+                hooks: Optional[Dict[str, Callable]] = None) -> DomainTransform:
+        """
+        Compile the column mappings of a configuration
+        @param hooks: the _lookup_* hooks (added to, or replacing, the defaults)
+        """
+        hooks = dict(HOOKS, **(hooks or {}))
+        rules = []
+        for column, mappings in config.mappings().items():
+            for resource_type, spec in (mappings or {}).items():
+                rules.extend(cls._compile(column, resource_type, get_fhir_model_class(resource_type),
+                                          spec, (), hooks))
+        keys = config.keys()
+        return cls(domain, keys[0], rules, config.id_columns())
+
+    @classmethod
+    def _compile(cls, column: str, resource_type: str, element, spec, path: tuple,
+                 hooks: Dict[str, Callable]) -> List[ColumnRule]:
+        """
+        Walk a mapping; element is the model class of the element at the path, or the
+        name of its primitive type
+        """
+        if spec is None:
+            if not path:
+                # not mapped yet
+                return []
+            return cls._leaf(column, resource_type, element, path)
+        if isinstance(spec, dict):
+            rules = []
+            for name, sub in spec.items():
+                if name == "maps":
+                    rules.extend(cls._leaf(column, resource_type, element, path, maps=sub))
+                    continue
+                if isinstance(element, str):
+                    raise ValueError(f"{column}: {resource_type}.{'.'.join(x for x, _ in path)} is a primitive")
+                field = _field(element, name)
+                model_class, type_name = _element_type(field)
+                rules.extend(cls._compile(column, resource_type, model_class or type_name, sub,
+                                          path + ((name, field.shape != 1),), hooks))
+            return rules
+        spec = str(spec)
+        if spec.startswith("_lookup_"):
+            if spec not in hooks:
+                raise ValueError(f"{column}: no hook {spec}")
+            if not path:
+                raise ValueError(f"{column}: {spec} needs an element of {resource_type}")
+            return [ColumnRule(column, resource_type, path, hooks[spec], make_setter(path, merge=True), merge=True,
+                               columns=tuple(column[:2] + x for x in HOOK_COLUMNS.get(spec, ())))]
+        if isinstance(element, str):
+            # a fixed value for a primitive
+            return [ColumnRule(column, resource_type, path,
+                               lambda values, frame, _value=spec: Series(_value, index=values.index, dtype=object),
+                               make_setter(path), constant=spec)]
+        if element.__name__ == "Reference" and spec in SUBJECT_RESOURCES:
+            # a reference to the subject's resource
+            return [ColumnRule(column, resource_type, path + (("reference", False),),
+                               lambda values, frame, _type=spec: map_distinct(
+                                   _as_string(values, frame), lambda x: f"{_type}/{SUBJECT_RESOURCES[_type](x)}"),
+                               make_setter(path + (("reference", False),)))]
+        return cls._compile(column, resource_type, element, {spec: None}, path, hooks)
+
+    @classmethod
+    def _leaf(cls, column: str, resource_type: str, element, path: tuple,
+              maps: Optional[dict] = None) -> List[ColumnRule]:
+        if not isinstance(element, str):
+            # a complex element set from the column
+            name = DEFAULT_ELEMENTS.get(element.__name__)
+            if name is None:
+                raise ValueError(f"{column}: map {resource_type}.{'.'.join(x for x, _ in path)} to an element")
+            field = _field(element, name)
+            model_class, type_name = _element_type(field)
+            return cls._leaf(column, resource_type, model_class or type_name,
+                             path + ((name, field.shape != 1),), maps)
+        convert = CONVERTERS.get(element, _as_string)
+        if maps:
+            _maps = {str(x): y for x, y in maps.items()}
+            values = lambda _values, frame: map_distinct(_as_string(_values, frame), _maps.get)
+        else:
+            values = convert
+        return [ColumnRule(column, resource_type, path, values, make_setter(path))]
+
+    @property
+    def resource_types(self) -> List[str]:
+        return list(dict.fromkeys(x.resource_type for x in self.rules))
+
+    @property
+    def columns(self) -> List[str]:
+        """
+        The columns of the domain the transform reads
+        """
+        columns = [self.key] + (self.id_columns or [f"{self.domain}SEQ"])
+        if "ResearchSubject" in self.resource_types:
+            columns.append(STUDY_COLUMN)
+        for rule in self.rules:
+            columns.append(rule.column)
+            columns.extend(rule.columns)
+        return list(dict.fromkeys(columns))
+
+    def _record_ids(self, frame: DataFrame, resource_type: str) -> List[str]:
+        columns = self.id_columns or [self.key] + [x for x in (f"{self.domain}SEQ",) if x in frame.columns]
+        description = Series(f"{self.domain}-{resource_type}", index=frame.index)
+        for column in columns:
+            description = description + "-" + _as_string(frame[column], frame).fillna("")
+        if not self.id_columns and len(columns) == 1:
+            # no sequence, the position in the dataset identifies the record
+            description = description + "-" + Series(frame.index, index=frame.index).astype(str)
+        return description.map(hh).tolist()
+
+    def apply(self, frame: DataFrame,
+              resource_types: Optional[Iterable[str]] = None) -> Dict[str, List[dict]]:
+        """
+        Convert the records of the domain, returning the resource dicts by subject; there is a
+        resource for each record, except the subject resources (Patient, ResearchSubject) which
+        come from the subject's first record
+        @param resource_types: the resources to generate (defaults to all those mapped)
+        """
+        resource_types = list(resource_types) if resource_types is not None else self.resource_types
+        subjects = _as_string(frame[self.key], frame).tolist()
+        firsts = ~frame[self.key].duplicated().to_numpy()
+        converted = {}
+        resources = {x: [] for x in dict.fromkeys(subjects)}
+        for resource_type in resource_types:
+            rules = [x for x in self.rules if x.resource_type == resource_type and x.column in frame.columns]
+            if resource_type in SUBJECT_RESOURCES:
+                rows = [idx for idx, first in enumerate(firsts) if first]
+                _resources = [dict(resourceType=resource_type, id=SUBJECT_RESOURCES[resource_type](subjects[x]))
+                              for x in rows]
+            else:
+                rows = None
+                _resources = [dict(resourceType=resource_type, id=x) for x in self._record_ids(frame, resource_type)]
+                model_class = get_fhir_model_class(resource_type)
+                if "subject" in model_class.__fields__:
+                    patients = {x: f"Patient/{hh(x)}" for x in resources}
+                    for resource, subject_id in zip(_resources, subjects):
+                        resource["subject"] = dict(reference=patients[subject_id])
+            # the fixed elements no column adds to are built once, and shared by the resources
+            mapped = {x.path[0][0] for x in rules if x.constant is None}
+            shared = {}
+            for rule in [x for x in rules if x.constant is not None and x.path[0][0] not in mapped]:
+                rule.setter(shared, rule.constant)
+                rules.remove(rule)
+            if shared:
+                for resource in _resources:
+                    resource.update(shared)
+            # the hook elements are merged last, so nothing is set inside the (shared) elements
+            for rule in sorted(rules, key=lambda x: x.merge):
+                # each column (and hook) is converted once for all the rules using it
+                key = (rule.column, rule.values)
+                if key not in converted:
+                    # (a hook mapping every row to None comes back as NaN)
+                    converted[key] = _present(rule.values(frame[rule.column], frame)).tolist()
+                values = converted[key]
+                if rows is not None:
+                    values = [values[x] for x in rows]
+                setter = rule.setter
+                for resource, value in zip(_resources, values):
+                    if value is not None:
+                        setter(resource, value)
+            owners = subjects if rows is None else [subjects[x] for x in rows]
+            if resource_type == "ResearchSubject":
+                studies = _as_string(frame[STUDY_COLUMN], frame).tolist() if STUDY_COLUMN in frame.columns else []
+                studies = [studies[x] for x in rows] if studies else [None] * len(rows)
+                _resources, owners = _complete_research_subjects(_resources, owners, studies)
+            for resource, subject_id in zip(_resources, owners):
+                resources[subject_id].append(resource)
+        return resources
+
+
+_transforms = {}
+
+
+def get_transform(domain: str) -> DomainTransform:
+    """
+    The compiled transform for a domain, compiled on first use
+    """
+    domain = domain.upper()
+    if domain not in _transforms:
+        _transforms[domain] = DomainTransform.for_domain(domain)
+    return _transforms[domain]
+
+
+def config_columns(domain: str) -> Optional[List[str]]:
+    """
+    The columns of a domain its configuration reads (None without a configuration)
+    """
+    if not os.path.exists(os.path.join(CONFIG_DIR, f"{domain.lower()}.yml")):
+        return None
+    return get_transform(domain).columns
@@ -0,0 +1,300 @@
+from __future__ import annotations
+
+import functools
+import os
+import re
+from typing import Dict, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .connector import ARTIFACT_DIR, ArtifactCache, file_digest
+
+UCUM = "http://unitsofmeasure.org"
+
+# the CDISC unit terminology with the UCUM expressions
+UCUM_CODETABLE = os.getenv("CDISCPILOT_UCUM_CODETABLE",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "doc", "resources",
+                                        "Unit-UCUM_Codetable_2022-03-25.xlsx"))
+
+# bump when the layout of the table changes
+UNIT_TABLE_VERSION = 2
+
+# UCUM prefixes
+PREFIXES = {"Y": 1e24, "Z": 1e21, "E": 1e18, "P": 1e15, "T": 1e12, "G": 1e9, "M": 1e6, "k": 1e3,
+            "h": 1e2, "da": 1e1, "d": 1e-1, "c": 1e-2, "m": 1e-3, "u": 1e-6, "n": 1e-9, "p": 1e-12,
+            "f": 1e-15, "a": 1e-18}
+
+# UCUM atoms as a scale in the base units (g, m, s, mol) and the dimension; the arbitrary
+# units (and any other [unit]) and temperatures (which have an offset) are only commensurable
+# with themselves
+ATOMS = {"g": (1, {"g": 1}),
+         "m": (1, {"m": 1}),
+         "s": (1, {"s": 1}),
+         "mol": (1, {"mol": 1}),
+         "eq": (1, {"mol": 1}),
+         "L": (1e-3, {"m": 3}),
+         "l": (1e-3, {"m": 3}),
+         "min": (60, {"s": 1}),
+         "h": (3600, {"s": 1}),
+         "d": (86400, {"s": 1}),
+         "wk": (604800, {"s": 1}),
+         "mo": (2629800, {"s": 1}),
+         "a": (31557600, {"s": 1}),
+         "Hz": (1, {"s": -1}),
+         "Bq": (1, {"s": -1}),
+         "Ci": (3.7e10, {"s": -1}),
+         "osm": (1, {"mol": 1}),
+         "U": (1e-6 / 60, {"mol": 1, "s": -1}),
+         "kat": (1, {"mol": 1, "s": -1}),
+         "Pa": (1e3, {"g": 1, "m": -1, "s": -2}),
+         "m[Hg]": (133322387.415, {"g": 1, "m": -1, "s": -2}),
+         "[in_i]": (0.0254, {"m": 1}),
+         "[ft_i]": (0.3048, {"m": 1}),
+         "[lb_av]": (453.59237, {"g": 1}),
+         "[oz_av]": (28.349523125, {"g": 1}),
+         "%": (1e-2, {}),
+         "[ppm]": (1e-6, {}),
+         "[ppb]": (1e-9, {}),
+         "[IU]": (1, {"[IU]": 1}),
+         "[iU]": (1, {"[IU]": 1}),
+         "IU": (1, {"[IU]": 1}),
+         "Cel": (1, {"Cel": 1}),
+         "[degF]": (1, {"[degF]": 1}),
+         "[pH]": (1, {"[pH]": 1})}
+
+ANNOTATION = re.compile(r"\{[^}]*\}")
+TOKEN = re.compile(r"[()./]|[^()./]+")
+COMPONENT = re.compile(r"(.*?)([+-]?\d+)?")
+POWER = re.compile(r"10[*^]([+-]?\d+)")
+
+
+def _component(token: str) -> Tuple[float, Dict[str, int]]:
+    """
+    The scale and dimension for a UCUM component (prefixed atom with an exponent, or a factor)
+    """
+    power = POWER.fullmatch(token)
+    if power:
+        return 10.0 ** int(power.group(1)), {}
+    if token.isdigit():
+        return float(token), {}
+    atom, exponent = COMPONENT.fullmatch(token).groups()
+    exponent = int(exponent) if exponent else 1
+    if atom in ATOMS:
+        scale, dimension = ATOMS[atom]
+    else:
+        for prefix in sorted(PREFIXES, key=len, reverse=True):
+            if atom.startswith(prefix) and atom[len(prefix):] in ATOMS:
+                scale, dimension = ATOMS[atom[len(prefix):]]
+                scale = scale * PREFIXES[prefix]
+                break
+        else:
+            if not atom.endswith("]"):
+                raise ValueError(f"Unknown UCUM unit {atom}")
+            scale, dimension = 1, {atom: 1}
+    return scale ** exponent, {x: y * exponent for x, y in dimension.items()}
+
+
+@functools.lru_cache(maxsize=None)
+def ucum_scale(code: str) -> Tuple[float, Optional[str]]:
+    """
+    The scale of a UCUM expression in the base units and its dimension (eg g.m-3 for mg/dL);
+    units with the same dimension convert by the ratio of their scales
+    @return: the scale and dimension, NaN and None where the expression isn't understood
+    """
+    tokens = TOKEN.findall(ANNOTATION.sub("", code))
+    position = 0
+
+    def _term() -> Tuple[float, Dict[str, int]]:
+        nonlocal position
+        scale, dimension = 1.0, {}
+        operator = "."
+        while position < len(tokens) and tokens[position] != ")":
+            token = tokens[position]
+            position += 1
+            if token in (".", "/"):
+                operator = token
+                continue
+            if token == "(":
+                _scale, _dimension = _term()
+                # the closing parenthesis
+                position += 1
+            else:
+                _scale, _dimension = _component(token)
+            sign = -1 if operator == "/" else 1
+            scale *= _scale ** sign
+            for name, exponent in _dimension.items():
+                dimension[name] = dimension.get(name, 0) + sign * exponent
+            operator = "."
+        return scale, dimension
+
+    try:
+        scale, dimension = _term()
+    except ValueError:
+        return float("nan"), None
+    return scale, ".".join(f"{x}{y}" for x, y in sorted(dimension.items()) if y)
+
+
+class UnitTable:
+    """
+    The SDTM units (CDISC submission values and synonyms) compiled to their UCUM codes, with
+    the scale and dimension of each code; the table is kept on disk, keyed by the content of
+    the code table
+    """
+
+    def __init__(self, units: pd.DataFrame) -> None:
+        # UNIT -> UCUM, SCALE, DIMENSION
+        self.units = units
+        self._ucum = dict(zip(units.UNIT, units.UCUM))
+        self._upper = {}
+        for unit, ucum in zip(units.UNIT, units.UCUM):
+            self._upper.setdefault(unit.upper(), ucum)
+        self._codes = dict(zip(units.UCUM, zip(units.SCALE, units.DIMENSION)))
+
+    def __len__(self) -> int:
+        return len(self._ucum)
+
+    def ucum(self, unit) -> Optional[str]:
+        """
+        The UCUM code for an SDTM unit, the exact submission value first
+        """
+        if not isinstance(unit, str) or not unit.strip():
+            return None
+        unit = unit.strip()
+        return self._ucum.get(unit) or self._upper.get(unit.upper())
+
+    def scale(self, unit) -> Tuple[float, Optional[str]]:
+        """
+        The scale and dimension for an SDTM unit (or a UCUM code not in the table)
+        """
+        code = self.ucum(unit)
+        if code is None:
+            if not isinstance(unit, str):
+                return float("nan"), None
+            code = unit.strip()
+        if code in self._codes:
+            return self._codes[code]
+        return ucum_scale(code)
+
+    @classmethod
+    def from_frame(cls, codetable: pd.DataFrame) -> UnitTable:
+        """
+        Compile the code table; the submission values take precedence over the UCUM
+        expressions (which stand for themselves) and the synonyms
+        """
+        terms = codetable[codetable["Codelist Code"].notna()]
+        expressions = terms[[x for x in codetable.columns if x.startswith("UCUM Expression")]]
+        # the first expression is the preferred one
+        ucum = expressions.bfill(axis=1).iloc[:, 0]
+        names = [terms["CDISC Submission Value"].to_frame("UNIT").assign(UCUM=ucum, _priority=0)]
+        for column in expressions.columns:
+            names.append(expressions[column].to_frame("UNIT").assign(UCUM=ucum, _priority=1))
+        synonyms = terms["CDISC Synonym(s)"].str.split(";").explode()
+        names.append(synonyms.to_frame("UNIT").assign(UCUM=ucum.reindex(synonyms.index), _priority=2))
+        units = pd.concat(names)
+        units["UNIT"] = units.UNIT.str.strip()
+        units = units[units.UNIT.notna() & (units.UNIT != "") & units.UCUM.notna()]
+        units = units.sort_values("_priority", kind="stable").drop_duplicates("UNIT")
+        scales = {x: ucum_scale(x) for x in units.UCUM.unique()}
+        units["SCALE"] = units.UCUM.map(lambda x: scales[x][0])
+        units["DIMENSION"] = units.UCUM.map(lambda x: scales[x][1])
+        return cls(units.drop(columns="_priority").reset_index(drop=True))
+
+    @classmethod
+    def from_workbook(cls, path: str = UCUM_CODETABLE) -> UnitTable:
+        return cls.from_frame(pd.read_excel(path, dtype=str))
+
+    @classmethod
+    def load(cls, path: str = UCUM_CODETABLE, cache_dir: Optional[str] = ARTIFACT_DIR) -> UnitTable:
+        """
+        Get the table for the code table, reading the workbook only if it has changed
+        @param cache_dir: where the compiled table is kept (None to skip the cache)
+        """
+        cache = ArtifactCache(cache_dir)
+        name = f"ucum-units-{file_digest(path)}"
+        units = cache.get(name, UNIT_TABLE_VERSION)
+        if units is not None:
+            return cls(units)
+        table = cls.from_workbook(path)
+        cache.put(name, UNIT_TABLE_VERSION, table.units)
+        return table
+
+    def _scales(self, units) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The scales and dimensions (as codes, -1 where unknown) for a column of units
+        """
+        codes, uniques = pd.factorize(pd.Series(units, dtype=object))
+        scales = [self.scale(x) for x in uniques]
+        # the missing units (code -1) pick the trailing NaN
+        scale = np.array([x for x, _ in scales] + [np.nan])[codes]
+        dimension = np.array([x if x is not None else np.nan for _, x in scales] + [np.nan], dtype=object)[codes]
+        return scale, dimension
+
+    def factors(self, from_units, to_units) -> np.ndarray:
+        """
+        The factors converting values in one column of units to another (or to a single unit);
+        NaN where the units aren't commensurable
+        """
+        from_scale, from_dimension = self._scales(from_units)
+        if isinstance(to_units, str):
+            to_scale, to_dimension = self.scale(to_units)
+            to_dimension = np.nan if to_dimension is None else to_dimension
+        else:
+            to_scale, to_dimension = self._scales(to_units)
+        commensurable = pd.Series(from_dimension == to_dimension).to_numpy(dtype=bool)
+        return np.where(commensurable, from_scale / to_scale, np.nan)
+
+    def convert(self, values, from_units, to_units) -> np.ndarray:
+        """
+        Convert a column of values (eg --ORRES with --ORRESU) to other units
+        """
+        return pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(dtype=float) * \
+            self.factors(from_units, to_units)
+
+    def conversion_factors(self, frame: pd.DataFrame, prefix: str = "LB") -> pd.Series:
+        """
+        The factors from the original (--ORRESU) to the standard (--STRESU) units for each row
+        of a domain; where UCUM can't convert the units (eg mg/dL to mmol/L needs the molar
+        mass) the median --STRESN/--ORRES ratio of the test in the domain is used
+        """
+        factors = pd.Series(self.factors(frame[f"{prefix}ORRESU"], frame[f"{prefix}STRESU"]), index=frame.index)
+        missing = factors.isna()
+        if missing.any():
+            key = [f"{prefix}TESTCD", f"{prefix}ORRESU", f"{prefix}STRESU"]
+            observed = frame.loc[missing, key].assign(
+                _ratio=pd.to_numeric(frame.loc[missing, f"{prefix}STRESN"], errors="coerce") /
+                pd.to_numeric(frame.loc[missing, f"{prefix}ORRES"], errors="coerce"))
+            observed["_ratio"] = observed._ratio.replace([np.inf, -np.inf], np.nan)
+            ratios = observed.groupby(key, sort=False, dropna=False)._ratio.transform("median")
+            factors[missing] = ratios
+        return factors
+
+
+_table = None
+
+
+def get_unit_table(cache_dir: Optional[str] = ARTIFACT_DIR) -> UnitTable:
+    """
+    The unit table, loaded on first use
+    """
+    global _table
+    if _table is None:
+        _table = UnitTable.load(cache_dir=cache_dir)
+    return _table
+
+
+def ucum_quantity(unit: Union[str, None]) -> Optional[dict]:
+    """
+    The Quantity unit, system and code elements for an SDTM unit
+    """
+    if not isinstance(unit, str) or not unit.strip():
+        return None
+    code = get_unit_table().ucum(unit)
+    if code is None:
+        return dict(unit=unit.strip())
+    return dict(unit=unit.strip(), system=UCUM, code=code)
+
+
+if __name__ == "__main__":
+    # compile the code table ahead of a run
+    print(f"Compiled {len(UnitTable.load())} units from {UCUM_CODETABLE}")
@@ -0,0 +1,185 @@
+import io
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+from soa_bridge_match import connector
+
+# the example client modules are imported from their directory, as main.py does
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "doc", "example")
+if EXAMPLE_DIR not in sys.path:
+    sys.path.append(EXAMPLE_DIR)
+
+
+def _entry(resource: dict) -> dict:
+    return dict(resource=resource,
+                request=dict(method="PUT", url=f"{resource['resourceType']}/{resource['id']}"))
+
+
+def subject_bundle(subject_id: str = "01-701-1015", patient_id: str = "p1") -> dict:
+    """
+    A small subject bundle: the design resources, the subject and the SV visit cascade
+    """
+    subject = {"reference": f"Patient/{patient_id}", "display": subject_id}
+    resources = [
+        {"resourceType": "ResearchStudy", "id": "CDISCPILOT01", "status": "active"},
+        {"resourceType": "PlanDefinition", "id": "pd1", "status": "active"},
+        {"resourceType": "Patient", "id": patient_id, "gender": "female", "birthDate": "1950-03-01"},
+        {"resourceType": "ResearchSubject", "id": subject_id, "status": "on-study",
+         "study": {"reference": "ResearchStudy/CDISCPILOT01"},
+         "individual": {"reference": f"Patient/{patient_id}"}},
+        {"resourceType": "CarePlan", "id": f"cp1-{patient_id}", "status": "active", "intent": "plan",
+         "title": f"Visit 1 for {subject_id}", "subject": dict(subject),
+         "instantiatesCanonical": ["PlanDefinition/pd1"]},
+        {"resourceType": "ServiceRequest", "id": f"sr1-{patient_id}", "status": "completed", "intent": "order",
+         "subject": dict(subject), "basedOn": [{"reference": f"CarePlan/cp1-{patient_id}"}]},
+        {"resourceType": "Encounter", "id": f"e1-{patient_id}", "status": "finished",
+         "class": {"system": "http://terminology.hl7.org/CodeSystem/v3-ActCode", "code": "AMB"},
+         "subject": dict(subject), "basedOn": [{"reference": f"ServiceRequest/sr1-{patient_id}"}],
+         "period": {"start": "2014-01-02T10:00:00Z", "end": "2014-01-02T11:00:00Z"}},
+        {"resourceType": "Observation", "id": f"o1-{patient_id}", "status": "final",
+         "code": {"coding": [{"system": "http://loinc.org", "code": "8867-4"}]},
+         "subject": dict(subject), "encounter": {"reference": f"Encounter/e1-{patient_id}"},
+         "effectiveDateTime": "2014-01-02T10:30:00Z",
+         "valueQuantity": {"value": 72, "unit": "beats/min", "system": "http://unitsofmeasure.org",
+                           "code": "/min"}},
+        {"resourceType": "AdverseEvent", "id": f"ae1-{patient_id}", "actuality": "actual",
+         "subject": dict(subject), "date": "2014-01-05",
+         "contained": [{"resourceType": "Condition", "id": "c1", "subject": dict(subject)}]},
+    ]
+    return {"resourceType": "Bundle", "id": f"bundle-{subject_id}", "type": "transaction",
+            "entry": [_entry(x) for x in resources]}
+
+
+def _observation(idx: int, category: str, code: str) -> dict:
+    return {"fullUrl": f"urn:uuid:{idx}",
+            "resource": {"resourceType": "Observation", "id": f"obs-{idx}", "status": "final",
+                         "category": [{"coding": [{"code": category}]}],
+                         "code": {"coding": [{"system": "http://loinc.org", "code": code}]},
+                         "valueQuantity": {"value": idx}}}
+
+
+def synthea_dir(tmp_path):
+    """
+    A Synthea output directory with one patient bundle
+    """
+    data = tmp_path / "synthea"
+    data.mkdir()
+    entries = [{"resource": {"resourceType": "Patient", "id": "p1"}},
+               _observation(1, "laboratory", "2160-0"),
+               _observation(2, "vital-signs", "8867-4"),
+               _observation(3, "laboratory", "2345-7")]
+    with open(data / "patient.json", "w") as f:
+        json.dump({"resourceType": "Bundle", "type": "collection", "entry": entries}, f, indent=2)
+    return data
+
+
+@pytest.fixture
+def bundle_dict() -> dict:
+    return subject_bundle()
+
+
+def vs_frame() -> pd.DataFrame:
+    """
+    A small VS domain, grouped by subject as the SDTM datasets are
+    """
+    rows = []
+    for subject in ("01-701-1015", "01-701-1023", "01-701-1028"):
+        for visitnum, visit in ((1.0, "SCREENING 1"), (3.0, "BASELINE")):
+            for testcd, unit, value in (("PULSE", "BEATS/MIN", 72.0), ("SYSBP", "mmHg", 120.0)):
+                rows.append(dict(STUDYID="CDISCPILOT01", DOMAIN="VS", USUBJID=subject, VSSEQ=len(rows) + 1,
+                                 VSTESTCD=testcd, VSORRES=str(value), VSORRESU=unit, VSSTRESN=value,
+                                 VSSTRESU=unit, VISITNUM=visitnum, VISIT=visit, VSDTC="2014-01-02T10:00"))
+    return pd.DataFrame(rows)
+
+
+def unit_codetable() -> pd.DataFrame:
+    """
+    A few rows of the CDISC unit code table
+    """
+    return pd.DataFrame({"Codelist Code": ["C71620", "C71620", "C71620", "C71620", None],
+                         "CDISC Submission Value": ["mg/dL", "g/L", "mmol/L", "beats/min", "header"],
+                         "CDISC Synonym(s)": ["Milligram per Deciliter", "Gram per Liter; g/l", None, "BPM", None],
+                         "UCUM Expression": ["mg/dL", "g/L", "mmol/L", "/min", None],
+                         "UCUM Expression 2": [None, None, None, "{beats}/min", None]})
+
+
+@pytest.fixture
+def local_domains(tmp_path, monkeypatch):
+    """
+    A local prefix holding the domains; the xport writer is not a dependency, so the
+    datasets are written as CSV and decoded as such
+    """
+    prefix = tmp_path / "sdtm"
+    prefix.mkdir()
+
+    def _read(content: bytes) -> pd.DataFrame:
+        return connector.parse_dates(pd.read_csv(io.BytesIO(content)))
+
+    def _iter(source, chunksize, columns=None):
+        for chunk in pd.read_csv(source, chunksize=chunksize):
+            yield connector.parse_dates(connector._project(chunk, columns))
+
+    monkeypatch.setattr(connector, "read_xpt", _read)
+    monkeypatch.setattr(connector, "iter_xpt", _iter)
+    vs_frame().to_csv(prefix / "vs.xpt", index=False)
+    return prefix
+
+
+class StubServer:
+    """
+    A FHIR server stub; the responses are queued by path (and query), the last one is repeated
+    """
+
+    def __init__(self) -> None:
+        self.responses = {}
+        self.requests = []
+        self.delay = None
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.lstrip("/")
+                stub.requests.append((path, dict(self.headers)))
+                if stub.delay is not None:
+                    stub.delay.wait(5)
+                queued = stub.responses.get(path) or [(404, None, {})]
+                status, body, headers = queued.pop(0) if len(queued) > 1 else queued[0]
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                content = json.dumps(body).encode("utf-8") if body is not None else b""
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.baseurl = f"http://127.0.0.1:{self._server.server_port}/"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def respond(self, path: str, *responses) -> None:
+        """
+        Queue the (status, body, headers) responses for a path
+        """
+        self.responses[path] = list(responses)
+
+    def close(self) -> None:
+        if self.delay is not None:
+            self.delay.set()
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    yield server
+    server.close()
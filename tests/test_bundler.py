@@ -0,0 +1,96 @@
+import json
+
+import pytest
+from fhir.resources.bundle import Bundle
+from pydantic.datetime_parse import parse_datetime
+
+from soa_bridge_match import synthea
+from soa_bridge_match.bundler import AddedResources, SourcedBundle
+
+from conftest import synthea_dir
+
+
+@pytest.fixture(params=["typed", "raw"])
+def bundle(request, bundle_dict):
+    if request.param == "raw":
+        return SourcedBundle.from_bundle(bundle_dict)
+    return SourcedBundle.from_bundle(Bundle.parse_obj(bundle_dict))
+
+
+def test_resources_are_indexed(bundle):
+    assert bundle.subjects == ["01-701-1015"]
+    assert bundle.patients == ["p1"]
+    assert bundle.plan_definitions == ["pd1"]
+    assert bundle.get_resource("CarePlan", "cp1-p1").title == "Visit 1 for 01-701-1015"
+    assert bundle.get_resource_dict("Encounter", "e1-p1")["basedOn"] == [{"reference": "ServiceRequest/sr1-p1"}]
+    assert bundle.get_resource("Encounter", "missing") is None
+    assert sorted(x.resource_type for x in bundle.subject_resources("p1")) == [
+        "AdverseEvent", "CarePlan", "Encounter", "Observation", "ServiceRequest"]
+    assert [x.id for x in bundle.visit_resources("cp1-p1")] == ["sr1-p1", "e1-p1"]
+
+
+def test_add_resources_skips_the_known_resources(bundle):
+    procedure = {"resourceType": "Procedure", "id": "pr1", "status": "completed",
+                 "subject": {"reference": "Patient/p1"}}
+    counts = bundle.add_resources([procedure, bundle.get_resource_dict("Observation", "o1-p1")])
+    assert counts == AddedResources(added=1, skipped=1)
+    assert counts + AddedResources(2, 0) == AddedResources(3, 1)
+    assert bundle.has_resource("Procedure", "pr1")
+    assert ("Procedure", "pr1") in bundle.referencing_keys("Patient/p1", element="subject")
+    assert bundle.add_resources([procedure]) == AddedResources(0, 1)
+
+
+def test_remove_resource(bundle):
+    removed = bundle.remove_resource("Encounter", "e1-p1")
+    assert removed.id == "e1-p1"
+    assert not bundle.has_resource("Encounter", "e1-p1")
+    assert [x.id for x in bundle.visit_resources("cp1-p1")] == ["sr1-p1"]
+    assert "e1-p1" not in [x.resource.id for x in bundle.bundle.entry]
+    assert bundle.remove_resource("Encounter", "e1-p1") is None
+
+
+def test_raw_mode(bundle_dict, tmp_path):
+    source = tmp_path / "subject.json"
+    source.write_text(json.dumps(bundle_dict))
+    bundle = SourcedBundle.from_bundle_file(str(source), raw=True)
+    assert bundle.raw
+    # the models are only built when accessed, and changes are written back on dump
+    encounter = bundle.get_resource("Encounter", "e1-p1")
+    assert bundle.get_resource("Encounter", "e1-p1") is encounter
+    encounter.status = "cancelled"
+    assert bundle.get_resource_dict("Encounter", "e1-p1")["status"] == "cancelled"
+    fname = bundle.dump(str(tmp_path / "out"))
+    dumped = json.loads(open(fname).read())
+    assert [x["resource"]["status"] for x in dumped["entry"] if x["resource"]["id"] == "e1-p1"] == ["cancelled"]
+    assert dumped["entry"][0] == bundle_dict["entry"][0]
+    # typed access to the whole bundle leaves the raw mode
+    assert isinstance(bundle.bundle, Bundle)
+    assert not bundle.raw
+    assert bundle.get_resource("Encounter", "e1-p1").status == "cancelled"
+
+
+@pytest.fixture
+def picker(tmp_path, monkeypatch):
+    data = str(synthea_dir(tmp_path))
+    monkeypatch.setitem(synthea._catalogues, data,
+                        synthea.ObservationCatalogue(data, index_dir=str(tmp_path / "index")))
+    return synthea.SyntheaPicker(data)
+
+
+def test_add_observations(bundle, picker):
+    bundle._synthea = picker
+    counts = bundle.add_observations(n=3, category="laboratory", bind_encounter=True, seed=1)
+    assert counts == AddedResources(added=3, skipped=0)
+    added = [x for x in bundle.subject_resources("p1")
+             if x.resource_type == "Observation" and x.id != "o1-p1"]
+    assert len(added) == 3
+    for observation in added:
+        assert observation.subject.reference == "Patient/p1"
+        assert observation.encounter.reference == "Encounter/e1-p1"
+        assert parse_datetime(observation.effectiveDateTime) == parse_datetime("2014-01-02T10:00:00Z")
+        assert observation.code.coding[0].code in ("2160-0", "2345-7")
+    # the same seed picks the same observations
+    assert bundle.add_observations(n=3, category="laboratory", bind_encounter=True, seed=1) == \
+        AddedResources(added=0, skipped=3)
+    with pytest.raises(ValueError):
+        bundle.add_observations(["01-701-9999"])
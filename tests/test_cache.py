@@ -0,0 +1,45 @@
+from cache import ResponseCache, normalise_url, url_resource_type
+from query import QueryEngine
+
+
+def test_normalise_url():
+    assert normalise_url("HTTP://Example.org/fhir/Encounter?subject=Patient/p1&_format=json&date=ge2014") == \
+        "http://example.org/fhir/Encounter?date=ge2014&subject=Patient/p1"
+    assert url_resource_type("http://example.org/fhir/Patient/p1") == "Patient"
+    assert url_resource_type("http://example.org/fhir/metadata") == "metadata"
+
+
+def test_responses_are_kept_between_runs(tmp_path):
+    path = str(tmp_path / "responses.sqlite")
+    cache = ResponseCache(path)
+    cache.store("http://example.org/fhir/Patient/p1", b'{"id": "p1"}', etag='W/"1"')
+    cache.close()
+    cache = ResponseCache(path)
+    try:
+        entry = cache.lookup("http://EXAMPLE.org/fhir/Patient/p1")
+        assert entry.body == b'{"id": "p1"}'
+        assert entry.validators() == {"If-None-Match": 'W/"1"'}
+        assert cache.is_fresh(entry)
+        assert cache.lookup("http://example.org/fhir/Patient/p2") is None
+        assert cache.stats()["disk_hits"] == 1
+    finally:
+        cache.close()
+
+
+def test_stale_responses_are_revalidated(stub_server, tmp_path):
+    stub_server.respond("Patient/p1", (200, {"id": "p1"}, {"ETag": 'W/"1"'}), (304, None, {}))
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"), ttls={"Patient": 0})
+    engine = QueryEngine(stub_server.baseurl, cache=cache)
+    try:
+        assert engine.get("Patient/p1") == {"id": "p1"}
+        # stale at once, so checked with the server
+        assert engine.get("Patient/p1") == {"id": "p1"}
+        assert stub_server.requests[1][1].get("If-None-Match") == 'W/"1"'
+        assert engine.stats()["not_modified"] == 1
+        assert cache.stats()["revalidated"] == 1
+        # fresh responses aren't fetched again
+        cache.ttls["Patient"] = 3600
+        assert engine.get("Patient/p1") == {"id": "p1"}
+        assert len(stub_server.requests) == 2
+    finally:
+        engine.close()
@@ -0,0 +1,71 @@
+import json
+import os
+
+from fhir.resources.bundle import Bundle
+
+from soa_bridge_match.bundler import SourcedBundle
+from soa_bridge_match.cloner import ClonePlan, hh
+
+
+def _references(resource: dict) -> list:
+    return [value["reference"] for element in ("subject", "basedOn", "encounter")
+            for value in (resource.get(element) if isinstance(resource.get(element), list)
+                          else [resource.get(element)]) if value]
+
+
+def test_clone_rebinds_the_references(bundle_dict):
+    bundle = SourcedBundle.from_bundle(bundle_dict)
+    clone = ClonePlan(bundle).clone("01-999-0001")
+    # a valid bundle
+    Bundle.parse_obj(clone)
+    resources = {(x["resource"]["resourceType"], x["resource"]["id"]): x["resource"] for x in clone["entry"]}
+    patient_id = hh("01-999-0001")
+    assert resources[("ResearchSubject", "01-999-0001")]["individual"]["reference"] == f"Patient/{patient_id}"
+    assert resources[("Patient", patient_id)]["link"][0]["other"]["reference"] == "Patient/p1"
+    # every reference resolves inside the clone
+    for resource in resources.values():
+        for reference in _references(resource):
+            assert tuple(reference.split("/")) in resources
+    care_plan = resources[("CarePlan", hh(f"{patient_id}-CarePlan-cp1-p1"))]
+    assert care_plan["title"] == "Visit 1 for 01-999-0001"
+    adverse_event = resources[("AdverseEvent", hh(f"{patient_id}-AdverseEvent-ae1-p1"))]
+    assert adverse_event["contained"][0]["subject"]["reference"] == f"Patient/{patient_id}"
+    # the design resources are shared
+    assert ("PlanDefinition", "pd1") in resources
+
+
+def test_clone_ids_differ_between_clones(bundle_dict):
+    plan = ClonePlan(SourcedBundle.from_bundle(bundle_dict))
+    first = {x["resource"]["id"] for x in plan.clone("01-999-0001")["entry"]}
+    second = {x["resource"]["id"] for x in plan.clone("01-999-0002")["entry"]}
+    assert first & second == {"CDISCPILOT01", "pd1"}
+
+
+def test_clone_with_contained_only_subject_reference(bundle_dict):
+    listing = {"resourceType": "List", "id": "l1", "status": "current", "mode": "working",
+               "contained": [{"resourceType": "Condition", "id": "c2", "subject": {"reference": "Patient/p1"}}]}
+    bundle_dict["entry"].append(dict(resource=listing, request=dict(method="PUT", url="List/l1")))
+    plan = ClonePlan(SourcedBundle.from_bundle(bundle_dict))
+    clone = plan.clone("01-999-0001")
+    Bundle.parse_obj(clone)
+    # not owned by the subject, so it isn't cloned
+    assert "List" not in {x["resource"]["resourceType"] for x in clone["entry"]}
+    entry = plan.template_entry(dict(listing, contained=[dict(listing["contained"][0])]), {"List/l1": "List/l2"})
+    assert "subject" not in entry["resource"]
+    assert entry["resource"]["contained"][0]["subject"]["reference"] != "Patient/p1"
+
+
+def test_clone_many_is_reproducible(bundle_dict, tmp_path):
+    bundle = SourcedBundle.from_bundle(bundle_dict)
+    for target_dir in ("a", "b"):
+        results = bundle.clone_many(["01-999-0001", "01-999-0002"], target_dir=str(tmp_path / target_dir),
+                                    seed=1, jobs=2)
+        assert not [x for x in results if x.error]
+    names = sorted(os.listdir(tmp_path / "a"))
+    assert names == ["bundle-01-999-0001.json", "bundle-01-999-0002.json"]
+    assert names == sorted(os.listdir(tmp_path / "b"))
+    for name in names:
+        with open(tmp_path / "a" / name, "rb") as f, open(tmp_path / "b" / name, "rb") as g:
+            content = f.read()
+            assert content == g.read()
+        Bundle.parse_obj(json.loads(content))
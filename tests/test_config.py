@@ -0,0 +1,31 @@
+import pandas as pd
+
+from soa_bridge_match import config
+from soa_bridge_match.config import LoincIndex
+
+
+def test_loinc_index_prefers_spot_samples():
+    index = LoincIndex.from_mapping()
+    # the 24 hour collections share the key with the spot samples
+    assert index.get("PH", "Urine")[0] == "2756-5"
+    assert index.get("CREAT", "Urine", "mg/dL")[0] == "2161-8"
+
+
+def test_loinc_index_is_kept_in_the_cache(tmp_path):
+    index = LoincIndex.load(cache_dir=str(tmp_path))
+    assert [x.name for x in tmp_path.iterdir() if x.name.startswith("loinc-index-")]
+    cached = LoincIndex.load(cache_dir=str(tmp_path))
+    assert len(cached) == len(index)
+    assert cached.get("PH", "Urine") == index.get("PH", "Urine")
+
+
+def test_map_many_codes_the_domain():
+    mapper = config.TestCodeMapper(index=LoincIndex.from_mapping())
+    frame = pd.DataFrame(dict(LBTESTCD=["CREAT", "PH", "CREAT", "XXX"],
+                              LBCAT=["CHEMISTRY", "URINALYSIS", "CHEMISTRY", "CHEMISTRY"],
+                              LBORRESU=["mg/dL", None, "mg/dL", "U"],
+                              LBSPEC=["", "", "", ""]), index=[10, 11, 12, 13])
+    match = mapper.map_many(frame)
+    assert list(match.codes.index) == [10, 11, 12, 13]
+    assert list(match.codes.LOINC) == ["2160-0", "2756-5", "2160-0", None]
+    assert list(match.unmapped.LBTESTCD) == ["XXX"]
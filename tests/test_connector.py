@@ -0,0 +1,150 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from soa_bridge_match import connector
+from soa_bridge_match.connector import ArtifactCache, Connector, DatasetRegistry
+
+from conftest import vs_frame
+
+
+def test_artifact_cache(tmp_path):
+    cache = ArtifactCache(str(tmp_path / "artifacts"))
+    assert cache.get("index", 1) is None
+    cache.put("index", 1, dict(codes=[1, 2]))
+    assert cache.get("index", 1) == dict(codes=[1, 2])
+    # a new layout ignores the stored artifact
+    assert cache.get("index", 2) is None
+    json_cache = ArtifactCache(str(tmp_path / "artifacts"), fmt="json")
+    json_cache.put("schedule", 1, dict(key="pd|1"))
+    assert (tmp_path / "artifacts" / "schedule.json").exists()
+    assert json_cache.get("schedule", 1) == dict(key="pd|1")
+
+
+def test_artifact_cache_without_a_directory():
+    cache = ArtifactCache(None)
+    cache.put("index", 1, [1])
+    assert cache.path("index") is None
+    assert cache.get("index", 1) is None
+
+
+def _connector(prefix, tmp_path, **kwargs):
+    kwargs.setdefault("registry", DatasetRegistry())
+    return Connector(prefix=str(prefix), cache_dir=str(tmp_path / "cache"), project=False, **kwargs)
+
+
+def test_decoded_datasets_are_cached_on_disk(local_domains, tmp_path, monkeypatch):
+    decoded = []
+    read_xpt = connector.read_xpt
+    monkeypatch.setattr(connector, "read_xpt", lambda content: decoded.append(1) or read_xpt(content))
+    dataset = _connector(local_domains, tmp_path).load_cdiscpilot_dataset("VS")
+    assert len(dataset) == 12 and len(decoded) == 1
+    # a new process (registry) reads the cached frame while the source is unchanged
+    cached = _connector(local_domains, tmp_path).load_cdiscpilot_dataset("vs")
+    assert len(decoded) == 1
+    assert cached.equals(dataset)
+    vs_frame().head(4).to_csv(local_domains / "vs.xpt", index=False)
+    assert len(_connector(local_domains, tmp_path).load_cdiscpilot_dataset("VS")) == 4
+    assert len(decoded) == 2
+    # without the source the cached copy is used
+    os.remove(local_domains / "vs.xpt")
+    assert len(_connector(local_domains, tmp_path).load_cdiscpilot_dataset("VS")) == 4
+    assert _connector(local_domains, tmp_path).load_cdiscpilot_dataset("DM") is None
+
+
+def test_offline_without_a_cached_copy(tmp_path):
+    remote = _connector("https://example.invalid/sdtm/", tmp_path, offline=True)
+    assert not remote.exists("VS")
+    assert remote.load_cdiscpilot_dataset("VS") is None
+
+
+def test_connectors_share_the_registry(local_domains, tmp_path):
+    registry = DatasetRegistry()
+    first = _connector(local_domains, tmp_path, registry=registry, use_cache=False)
+    second = _connector(local_domains, tmp_path, registry=registry, use_cache=False)
+    assert first.load_cdiscpilot_dataset("VS") is second.load_cdiscpilot_dataset("VS")
+    assert second.exists("VS")
+    stats = registry.stats()
+    assert (stats["hits"], stats["misses"], stats["datasets"]) == (2, 1, 1)
+    assert stats["bytes"] == registry.total_bytes > 0
+
+
+def test_registry_evicts_the_least_recently_used():
+    frames = {x: pd.DataFrame(dict(a=range(100))) for x in "abc"}
+    registry = DatasetRegistry(max_bytes=2 * connector.frame_size(frames["a"]))
+    for key in "ab":
+        registry.get(key, lambda: frames[key])
+    registry.get("a", lambda: None)
+    registry.get("c", lambda: frames["c"])
+    assert "a" in registry and "c" in registry and "b" not in registry
+    assert registry.stats()["evictions"] == 1
+    # the most recent dataset is kept over the budget
+    registry.max_bytes = 1
+    registry.put("d", frames["a"])
+    assert "d" in registry and registry.stats()["datasets"] == 1
+
+
+def test_subject_index(local_domains, tmp_path):
+    conn = _connector(local_domains, tmp_path, use_cache=False)
+    index = conn.subject_index("VS")
+    assert sorted(index) == ["01-701-1015", "01-701-1023", "01-701-1028"]
+    assert list(index["01-701-1023"]) == [4, 5, 6, 7]
+    # built once for the dataset
+    assert conn.subject_index("VS") is index
+    assert conn.subject_index("DM") == {}
+
+
+def test_subject_chunks():
+    frame = vs_frame()
+    chunks = list(connector.subject_chunks(frame.iloc[x:x + 5] for x in range(0, len(frame), 5)))
+    assert [x.USUBJID.unique().tolist() for x in chunks] == [["01-701-1015"], ["01-701-1023"], ["01-701-1028"]]
+    assert pd.concat(chunks).equals(frame)
+    shuffled = frame.iloc[[0, 1, 4, 5, 2, 3, 6, 7]]
+    with pytest.raises(ValueError):
+        list(connector.subject_chunks(shuffled.iloc[x:x + 3] for x in range(0, 8, 3)))
+
+
+def test_iter_domain(local_domains, tmp_path):
+    conn = _connector(local_domains, tmp_path, use_cache=False)
+    # streamed from the file, with the projection
+    chunks = list(conn.iter_domain("VS", chunksize=3, columns=["VSTESTCD"]))
+    assert [len(x) for x in chunks] == [4, 4, 4]
+    assert list(chunks[0].columns) == ["USUBJID", "VSTESTCD"]
+    # sliced from the loaded dataset
+    conn.load_cdiscpilot_dataset("VS")
+    sliced = list(conn.iter_domain("VS", chunksize=6))
+    # the last subject of a slice is held back for the next
+    assert [x.USUBJID.unique().tolist() for x in sliced] == [["01-701-1015"], ["01-701-1023"], ["01-701-1028"]]
+    assert pd.concat(sliced).equals(conn.load_cdiscpilot_dataset("VS"))
+    assert list(conn.iter_domain("DM")) == []
+
+
+def test_compact_frame():
+    frame = vs_frame().assign(VSSEQ=lambda x: x.VSSEQ.astype("int64"), VSNOTE=[f"note {x}" for x in range(12)])
+    compact = connector.compact_frame(frame)
+    assert compact.USUBJID.dtype == "category"
+    # mostly distinct strings are kept
+    assert compact.VSNOTE.dtype == object
+    assert compact.VSSEQ.dtype == np.int8
+    # the floats SAS stores stay floats
+    assert compact.VISITNUM.dtype == np.float32 and compact.VISITNUM.iloc[0] == 1.0
+    assert compact.equals(connector.compact_frame(compact))
+    assert connector.frame_size(compact) < connector.frame_size(frame)
+    assert (compact.astype(frame.dtypes.to_dict()) == frame).all().all()
+
+
+def test_projected_domains(local_domains, tmp_path):
+    conn = _connector(local_domains, tmp_path, use_cache=False,
+                      columns={"vs": ["USUBJID", "VSTESTCD", "VSSTRESN"]}, compact=True)
+    projected = conn.load_cdiscpilot_dataset("VS", project=True)
+    assert list(projected.columns) == ["USUBJID", "VSTESTCD", "VSSTRESN"]
+    assert projected.VSTESTCD.dtype == "category"
+    # the whole dataset is held separately
+    assert len(conn.load_cdiscpilot_dataset("VS").columns) == len(vs_frame().columns)
+    assert conn.load_cdiscpilot_dataset("VS", project=True) is projected
+    report = conn.memory_report()
+    assert report.loc["VS", "columns"] == 3 and report.loc["VS", "source_columns"] == len(vs_frame().columns)
+    assert report.loc["VS", "ratio"] > 1
+    assert list(conn.subject_index("VS", project=True)["01-701-1028"]) == [8, 9, 10, 11]
@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+
+from soa_bridge_match.bundler import AddedResources, SourcedBundle
+from soa_bridge_match.connector import Connector, DatasetRegistry
+from soa_bridge_match.dataset import Naptha, hh
+
+from conftest import subject_bundle, vs_frame
+
+
+@pytest.fixture
+def naptha(local_domains):
+    dm = vs_frame().drop_duplicates("USUBJID")[["STUDYID", "USUBJID"]].assign(DOMAIN="DM")
+    dm.to_csv(local_domains / "dm.xpt", index=False)
+    sv = pd.DataFrame(dict(USUBJID=["01-701-1015"] * 3 + ["01-701-1023"],
+                           VISITNUM=[1.0, 3.0, 3.5, 1.0],
+                           VISIT=["SCREENING 1", "BASELINE", "UNSCHEDULED 3.1", "SCREENING 1"],
+                           SVSTDTC=["2014-01-02", "2014-01-16", "2014-01-20", "2012-08-05"],
+                           SVENDTC=["2014-01-02", None, "2014-01-20", "2012-08-05"]))
+    sv.to_csv(local_domains / "sv.xpt", index=False)
+    conn = Connector(prefix=str(local_domains), use_cache=False, registry=DatasetRegistry(), project=False)
+    return Naptha(None, templatecontent=SourcedBundle.from_bundle(subject_bundle()), connector=conn)
+
+
+def test_subject_data(naptha):
+    assert naptha.has_subject("01-701-1023")
+    assert not naptha.has_subject("01-701-9999")
+    rows = naptha.get_subject_data("01-701-1028", "VS")
+    assert set(rows.USUBJID) == {"01-701-1028"} and len(rows) == 4
+    assert rows.VSSEQ.tolist() == [9, 10, 11, 12]
+    with pytest.raises(ValueError):
+        naptha.get_subject_data("01-701-9999", "VS")
+
+
+def test_sv_resources(naptha):
+    resources = naptha.sv_resources(validate_sample=6)
+    # the unplanned visit is dropped, and only the subject in the bundle is generated
+    assert [x["resourceType"] for x in resources] == ["CarePlan", "ServiceRequest", "Encounter"] * 2
+    care_plan, service_request, encounter = resources[3:]
+    patient_id = hh("01-701-1015")
+    assert care_plan["id"] == hh(f"{patient_id}-3.0-CarePlan")
+    assert care_plan["instantiatesCanonical"] == ["PlanDefinition/H2Q-MC-LZZT-Study-Visit-3"]
+    assert service_request["basedOn"] == [{"reference": f"CarePlan/{care_plan['id']}"}]
+    assert encounter["subject"] == {"reference": f"Patient/{patient_id}"}
+    # the missing end is left out of the period
+    assert encounter["period"] == {"start": "2014-01-16T00:00:00"}
+    assert resources[2]["period"] == {"start": "2014-01-02T00:00:00", "end": "2014-01-02T00:00:00"}
+    assert len(naptha.sv_resources(["01-701-1015", "01-701-1023"])) == 9
+
+
+def test_merge_sv(naptha):
+    assert naptha.merge_sv() == AddedResources(added=6, skipped=0)
+    assert naptha.merge_sv("01-701-1015", validate=False) == AddedResources(added=0, skipped=6)
+    # not in the bundle
+    assert naptha.merge_sv("01-701-1023") == AddedResources()
+    assert len(naptha.content.resource_ids("Encounter")) == 3
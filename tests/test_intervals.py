@@ -0,0 +1,56 @@
+import random
+
+from soa_bridge_match.intervals import (GREEN, ORANGE, RED, IntervalIndex, SubjectTimeline, VisitWindow,
+                                        classify_window, day_ordinal)
+
+from conftest import subject_bundle
+
+
+def test_interval_index_matches_a_scan():
+    rng = random.Random(3)
+    intervals = []
+    for idx in range(200):
+        low = rng.randint(0, 1000)
+        intervals.append((low, low + rng.randint(0, 50), idx))
+    index = IntervalIndex(intervals)
+    assert len(index) == 200
+    for _ in range(50):
+        low = rng.randint(0, 1000)
+        high = low + rng.randint(0, 100)
+        expected = {x[2] for x in intervals if x[0] <= high and x[1] >= low}
+        assert set(index.overlapping(low, high)) == expected
+    assert len(index.overlapping()) == 200
+    assert set(index.overlapping(low=1040)) == {x[2] for x in intervals if x[1] >= 1040}
+    assert IntervalIndex([]).overlapping(1, 2) == []
+
+
+def test_day_ordinal():
+    assert day_ordinal("2014-01") == day_ordinal("2014-01-01")
+    assert day_ordinal("2014-01-99") == day_ordinal("2014-01-01")
+    assert day_ordinal("2014-01-03") - day_ordinal("2013-12-31") == 3
+
+
+def test_classify_window():
+    assert classify_window(VisitWindow("V1", "2014-01-01", "2014-01-05", "2014-01-03", "2014-01-03")) == GREEN
+    assert classify_window(VisitWindow("V1", "2014-01-01", "2014-01-05", "2014-01-03", "2014-01-04")) == ORANGE
+    assert classify_window(VisitWindow("V1", "2014-01-01", "2014-01-05", "2014-01-03", "2014-01-09")) == RED
+    assert classify_window(VisitWindow("V1", "2014-01-01", "2014-01-05", "2014-01-03")) == RED
+    # an unplanned visit
+    assert classify_window(VisitWindow("V1", encounter_start="2014-01-09")) == GREEN
+
+
+def test_subject_timeline():
+    resources = [x["resource"] for x in subject_bundle()["entry"]]
+    timeline = SubjectTimeline(resources)
+    # the Encounter, Observation and AdverseEvent have dates
+    assert len(timeline) == 3
+    assert sorted(timeline.in_window("2014-01-02", "2014-01-02")) == [("Encounter", "e1-p1"), ("Observation", "o1-p1")]
+    assert timeline.in_window("2014-01-03", resource_type="AdverseEvent") == [("AdverseEvent", "ae1-p1")]
+    windows = [VisitWindow("Screening", "2013-12-30", "2014-01-03", "2014-01-01", "2014-01-02"),
+               VisitWindow("Week 1", "2014-01-01", "2014-01-09", "2014-01-06")]
+    matches = timeline.assign(windows)
+    # the resources go to the visit with the nearest target
+    assert matches["Screening"].counts == {"Encounter": 1, "Observation": 1}
+    assert matches["Screening"].status == ORANGE
+    assert matches["Week 1"].resources == [("AdverseEvent", "ae1-p1")]
+    assert matches["Week 1"].status == RED
@@ -0,0 +1,74 @@
+import importlib.util
+import json
+import os
+
+import pytest
+
+UPSTREAM = os.path.join(os.path.dirname(__file__), "..", "upstream")
+SOURCE = "LZZT_FHIR_Bundle_10_Patients_All_Resources.json"
+
+
+@pytest.fixture(scope="module")
+def patch_json():
+    spec = importlib.util.spec_from_file_location("patch_json", os.path.join(UPSTREAM, "patch_json.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _source_bundle() -> dict:
+    entries = [{"resource": {"resourceType": "ResearchStudy", "id": "H2Q-MC-LZZT-ResearchStudy", "status": "active",
+                             "title": "Études"}}]
+    for subject_id in ("01-701-1015", "01-701-1023"):
+        patient = f"Patient/{subject_id}"
+        entries.extend([
+            {"resource": {"resourceType": "ResearchSubject", "id": f"rs-{subject_id}", "status": "on-study",
+                          "study": {"reference": "ResearchStudy/H2Q-MC-LZZT-ResearchStudy"},
+                          "individual": {"reference": patient}}},
+            {"resource": {"resourceType": "Patient", "id": subject_id, "gender": "female"}},
+            {"resource": {"resourceType": "Observation", "id": "obs-1",
+                          "code": {"text": "OTHER LOINC LONG NAME", "coding": [{"code": "X"}]},
+                          "subject": {"reference": patient}, "valueQuantity": {"value": 36.6}}},
+            {"resource": {"resourceType": "AdverseEvent", "id": f"ae-{subject_id}",
+                          "subject": {"reference": patient},
+                          "contained": [{"resourceType": "Condition", "id": "c1"}]}},
+        ])
+    return {"resourceType": "Bundle", "id": "source", "entry": entries}
+
+
+def _patch(dirname, function):
+    os.makedirs(os.path.join(dirname, "subjects"))
+    with open(os.path.join(dirname, SOURCE), "w", encoding="utf-8") as f:
+        json.dump(_source_bundle(), f, ensure_ascii=False, indent=2)
+    cwd = os.getcwd()
+    os.chdir(dirname)
+    try:
+        function(SOURCE)
+    finally:
+        os.chdir(cwd)
+    contents = {}
+    for root, _, files in os.walk(dirname):
+        for fname in files:
+            with open(os.path.join(root, fname), "rb") as f:
+                contents[os.path.relpath(os.path.join(root, fname), dirname)] = f.read()
+    return contents
+
+
+def test_streaming_matches_in_memory(patch_json, tmp_path):
+    stamp = "2022-09-07T12:00:00Z"
+    in_memory = _patch(tmp_path / "memory", lambda x: patch_json.patch_file(x, last_updated=stamp))
+    streamed = _patch(tmp_path / "stream",
+                      lambda x: patch_json.patch_file_streaming(x, chunk_size=64, last_updated=stamp))
+    assert sorted(in_memory) == sorted(streamed)
+    assert in_memory == streamed
+    subject = json.loads(in_memory[os.path.join("subjects", "LZZT_FHIR_Bundle_01-701-1015_All_Resources.json")])
+    resources = [x["resource"] for x in subject["entry"]]
+    patient_id = resources[1]["id"]
+    # in the source order
+    assert [x["resourceType"] for x in resources] == ["ResearchSubject", "Patient", "Observation", "AdverseEvent",
+                                                      "ResearchStudy", "Organization", "Medication"]
+    assert resources[0]["id"] == "01-701-1015"
+    assert resources[3]["contained"][0]["subject"]["reference"] == f"Patient/{patient_id}"
+    assert resources[4]["title"] == "Études"
+    dupes = json.loads(in_memory[SOURCE.replace(".json", "_dupes.json")])
+    assert [x["id"] for x in dupes["Observation"]] == ["obs-1"]
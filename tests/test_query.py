@@ -0,0 +1,44 @@
+import threading
+
+from query import QueryEngine
+
+
+def test_retries_the_transient_failures(stub_server):
+    stub_server.respond("Patient/p1", (503, None, {"Retry-After": "0"}), (200, {"id": "p1"}, {}))
+    engine = QueryEngine(stub_server.baseurl, backoff=0)
+    try:
+        assert engine.get("Patient/p1") == {"id": "p1"}
+        assert engine.get("Patient/p2") is None
+        stats = engine.stats()
+        assert (stats["requests"], stats["retries"], stats["errors"]) == (3, 1, 1)
+    finally:
+        engine.close()
+
+
+def test_gives_up_after_the_retries(stub_server):
+    stub_server.respond("Patient/p1", (503, None, {}))
+    engine = QueryEngine(stub_server.baseurl, retries=2, backoff=0)
+    try:
+        assert engine.get("Patient/p1") is None
+        assert len(stub_server.requests) == 3
+    finally:
+        engine.close()
+
+
+def test_coalesces_the_queries_in_flight(stub_server):
+    stub_server.delay = threading.Event()
+    for idx in range(3):
+        stub_server.respond(f"Patient/p{idx}", (200, {"id": f"p{idx}"}, {}))
+    engine = QueryEngine(stub_server.baseurl, max_workers=4)
+    try:
+        first = engine.submit("Patient/p0")
+        assert engine.submit("Patient/p0") is first
+        stub_server.delay.set()
+        results = engine.get_many(["Patient/p0", "Patient/p1", "Patient/p2"])
+        assert {x: y["id"] for x, y in results.items()} == {
+            "Patient/p0": "p0", "Patient/p1": "p1", "Patient/p2": "p2"}
+        assert engine.stats()["coalesced"] >= 1
+        # paging links are absolute
+        assert engine.get(stub_server.baseurl + "Patient/p1") == {"id": "p1"}
+    finally:
+        engine.close()
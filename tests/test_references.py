@@ -0,0 +1,33 @@
+from soa_bridge_match.references import ReferenceGraph, normalise_reference
+
+
+def _adverse_event():
+    return {
+        "resourceType": "AdverseEvent",
+        "id": "ae-1",
+        "subject": {"reference": "Patient/p1"},
+        "contained": [{"resourceType": "Condition", "id": "c1", "subject": {"reference": "Patient/p2"}}],
+    }
+
+
+def test_normalise_reference():
+    assert normalise_reference("http://example.org/fhir/Patient/p1/_history/2") == "Patient/p1"
+    assert normalise_reference("PlanDefinition/pd1|1.0") == "PlanDefinition/pd1"
+
+
+def test_referencing_ignores_contained_by_default():
+    graph = ReferenceGraph()
+    graph.add(_adverse_event())
+    assert graph.referencing("Patient/p1", element="subject") == [("AdverseEvent", "ae-1")]
+    assert graph.referencing("Patient/p2", element="subject") == []
+    assert graph.referencing("Patient/p2") == []
+    assert graph.referencing("Patient/p2", element="subject", include_contained=True) == [("AdverseEvent", "ae-1")]
+
+
+def test_cascade_and_remove():
+    graph = ReferenceGraph()
+    graph.add({"resourceType": "ServiceRequest", "id": "sr1", "basedOn": [{"reference": "CarePlan/cp1"}]})
+    graph.add({"resourceType": "Encounter", "id": "e1", "basedOn": [{"reference": "ServiceRequest/sr1"}]})
+    assert graph.cascade("CarePlan/cp1") == [("ServiceRequest", "sr1"), ("Encounter", "e1")]
+    graph.remove("Encounter", "e1")
+    assert graph.cascade("CarePlan/cp1") == [("ServiceRequest", "sr1")]
@@ -0,0 +1,52 @@
+import io
+
+import pandas as pd
+
+from soa_bridge_match import connector as _connector
+from soa_bridge_match import runner
+from soa_bridge_match.connector import Connector, DatasetRegistry
+
+
+def _record(item, target_dir):
+    # the connector shared with the worker
+    with open(f"{target_dir}/{item}", "w") as f:
+        f.write(str(runner.worker_connector().stats()["datasets"]))
+
+
+def _touch(item, target_dir):
+    if item == "bad":
+        raise ValueError("bad item")
+    with open(f"{target_dir}/{item}", "w") as f:
+        f.write(item)
+
+
+def test_run_parallel_reports_the_errors(tmp_path, monkeypatch):
+    monkeypatch.setattr(runner, "_connector", None)
+    results = runner.run_parallel(_touch, ["a", "bad", "b"], jobs=2, args=(str(tmp_path),))
+    assert [x.item for x in results] == ["a", "bad", "b"]
+    assert [x.error for x in results] == [None, "ValueError: bad item", None]
+    assert sorted(x.name for x in tmp_path.iterdir()) == ["a", "b"]
+
+
+def test_run_parallel_only_creates_a_connector_to_preload(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(runner, "_connector", None)
+    runner.run_parallel(_touch, ["a", "b"], jobs=2, args=(str(tmp_path),))
+    assert runner._connector is None
+    assert "Dataset registry" not in capsys.readouterr().out
+
+
+def test_run_parallel_shares_the_preloaded_domains(tmp_path, monkeypatch, capsys):
+    # the datasets are CSV here, rather than XPT
+    monkeypatch.setattr(_connector, "read_xpt", lambda content: pd.read_csv(io.BytesIO(content)))
+    monkeypatch.setattr(runner, "_connector", None)
+    (tmp_path / "data").mkdir()
+    (tmp_path / "out").mkdir()
+    pd.DataFrame(dict(USUBJID=["01-701-1015", "01-701-1023"], SEX=["F", "M"])).to_csv(tmp_path / "data" / "dm.xpt",
+                                                                                      index=False)
+    connector = Connector(prefix=str(tmp_path / "data"), use_cache=False, registry=DatasetRegistry())
+    runner.run_parallel(_record, ["a", "b"], jobs=2, preload=("DM",), args=(str(tmp_path / "out"),),
+                        connector=connector)
+    assert (tmp_path / "out" / "a").read_text() == "1"
+    out = capsys.readouterr().out
+    assert "DM: 2 rows" in out
+    assert "Dataset registry: hits=0, misses=1" in out
@@ -0,0 +1,56 @@
+import pytest
+
+from soa_bridge_match.schedule import ProtocolSchedule, offset_minutes
+
+
+def _plan_definition(version="1.0") -> dict:
+    def related(action_id, low, high=None):
+        offset = {"low": {"value": low, "code": "d"}}
+        if high is not None:
+            offset["high"] = {"value": high, "code": "d"}
+        return [{"actionId": action_id, "relationship": "after-start", "offsetRange": offset}]
+
+    return {"resourceType": "PlanDefinition", "id": "pd1", "url": "http://example.org/pd1", "version": version,
+            "status": "active",
+            "action": [{"id": "screening", "definitionUri": "ActivityDefinition/screening"},
+                       {"id": "week2", "definitionUri": "ActivityDefinition/week2",
+                        "relatedAction": related("screening", 13, 15)},
+                       {"id": "week4", "definitionUri": "ActivityDefinition/week4",
+                        "relatedAction": related("week2", 13)}]}
+
+
+def test_offset_minutes():
+    assert offset_minutes({"value": 2, "code": "h"}) == 120
+    assert offset_minutes({"value": 1, "unit": "weeks"}) == 7 * 24 * 60
+    assert offset_minutes(None) is None
+    with pytest.raises(ValueError):
+        offset_minutes({"value": 1, "code": "fortnight"})
+
+
+def test_windows_follow_the_related_actions():
+    schedule = ProtocolSchedule.from_plan_definition(_plan_definition())
+    assert schedule.roots == ["ActivityDefinition/screening"]
+    windows = schedule.windows("2014-01-01")
+    assert windows["ActivityDefinition/week2"] == dict(low="2014-01-14", high="2014-01-16", expected="2014-01-14")
+    # the high end is open without an upper offset
+    assert windows["ActivityDefinition/week4"] == dict(low="2014-01-27", high=None, expected="2014-01-27")
+    many = schedule.windows_many(["2014-01-01", "2014-02-01"])
+    assert many[1]["ActivityDefinition/week2"]["low"] == "2014-02-14"
+
+
+def test_circular_actions_are_rejected():
+    plan_definition = _plan_definition()
+    plan_definition["action"][0]["relatedAction"] = [{"actionId": "week4", "relationship": "after"}]
+    with pytest.raises(ValueError):
+        ProtocolSchedule.from_plan_definition(plan_definition)
+
+
+def test_compiled_schedules_are_cached(tmp_path):
+    schedule = ProtocolSchedule.compile(_plan_definition(), cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+    cached = ProtocolSchedule.compile(_plan_definition(), cache_dir=str(tmp_path))
+    assert cached.key == schedule.key == "http://example.org/pd1|1.0"
+    assert cached.windows("2014-01-01") == schedule.windows("2014-01-01")
+    # a new version of the PlanDefinition is compiled again
+    ProtocolSchedule.compile(_plan_definition("2.0"), cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 2
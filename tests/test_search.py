@@ -0,0 +1,45 @@
+from soa_bridge_match.bundler import SourcedBundle
+from soa_bridge_match.search import BundleSearch, date_matches
+
+from conftest import subject_bundle
+
+
+def _search() -> BundleSearch:
+    return BundleSearch([SourcedBundle.from_bundle(subject_bundle()),
+                         SourcedBundle.from_bundle(subject_bundle("01-701-1023", "p2"))])
+
+
+def test_date_matches():
+    assert date_matches(("2014-01-02", "2014-01-02"), "2014-01")
+    assert date_matches(("2014-01-02", "2014-01-02"), "ge2014-01-02")
+    assert not date_matches(("2014-01-02", "2014-01-02"), "gt2014-01-02")
+    assert not date_matches(None, "2014")
+
+
+def test_shared_resources_are_indexed_once():
+    search = _search()
+    result = search.get("ResearchStudy?_summary=count")
+    assert result["total"] == 1
+
+
+def test_subject_search():
+    search = _search()
+    result = search.get("Encounter?subject=Patient/p1&date=ge2014-01-01")
+    assert [x["resource"]["id"] for x in result["entry"]] == ["e1-p1"]
+    assert search.get("Encounter?subject=Patient/p1&date=lt2014-01-01")["total"] == 0
+    assert [x["resource"]["id"] for x in search.get("Encounter?patient=p2")["entry"]] == ["e1-p2"]
+    assert search.get("ResearchSubject?patient=p1")["entry"][0]["resource"]["id"] == "01-701-1015"
+    assert search.get("ResearchSubject?study=CDISCPILOT01")["total"] == 2
+    assert search.get("Patient/p1")["id"] == "p1"
+
+
+def test_careplan_cascade_in_one_search():
+    search = _search()
+    result = search.get("CarePlan?subject=Patient/p1&_revinclude=ServiceRequest:based-on"
+                        "&_revinclude:iterate=Encounter:based-on")
+    assert [(x["resource"]["resourceType"], x["search"]["mode"]) for x in result["entry"]] == [
+        ("CarePlan", "match"), ("ServiceRequest", "include"), ("Encounter", "include")]
+
+
+def test_unsupported_parameters():
+    assert _search().get("Encounter?status=finished") is None
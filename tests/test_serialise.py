@@ -0,0 +1,75 @@
+import datetime
+import decimal
+import gzip
+import json
+
+import pytest
+
+from soa_bridge_match.bundler import SourcedBundle
+from soa_bridge_match.serialise import TemporalStrings, dumps, loads, write_json, write_ndjson
+
+from conftest import subject_bundle
+
+
+@pytest.fixture
+def source_file(tmp_path):
+    content = subject_bundle()
+    # the forms the parsed values lose
+    content["meta"] = {"lastUpdated": "2022-09-07T17:50:53Z"}
+    observation = next(x["resource"] for x in content["entry"]
+                       if x["resource"]["resourceType"] == "Observation")
+    observation["meta"] = {"lastUpdated": "2021-12-13T11:10:04.025+00:00"}
+    observation["effectiveDateTime"] = "2014-01-02T10:00:00"
+    observation["valueQuantity"] = {"value": 58.0, "unit": "kg"}
+    filename = tmp_path / "subject.json"
+    filename.write_text(json.dumps(content, indent=2))
+    return filename
+
+
+def test_typed_round_trip_reproduces_the_source(source_file, tmp_path):
+    bundle = SourcedBundle.from_bundle_file(str(source_file))
+    for compact in (True, False):
+        fname = bundle.dump(str(tmp_path / "out"), compact=compact)
+        assert json.loads(open(fname).read()) == json.loads(source_file.read_text())
+
+
+def test_materialised_models_keep_the_source_form(source_file, tmp_path):
+    bundle = SourcedBundle.from_bundle_file(str(source_file), raw=True)
+    observation = bundle.get_resource("Observation", "o1-p1")
+    observation.status = "amended"
+    fname = bundle.dump(str(tmp_path / "out"), fmt="ndjson")
+    with open(fname) as f:
+        resource = [loads(line) for line in f if '"Observation"' in line][0]
+    assert resource["status"] == "amended"
+    assert resource["meta"]["lastUpdated"] == "2021-12-13T11:10:04.025+00:00"
+    assert resource["valueQuantity"]["value"] == 58.0
+
+
+def test_changed_values_are_written_as_isoformat():
+    strings = TemporalStrings()
+    strings.collect({"a": ["2022-09-07T17:50:53Z", "2014-01-02", "10:00:00", "not a date"]})
+    assert len(strings) == 3
+    known = datetime.datetime(2022, 9, 7, 17, 50, 53, tzinfo=datetime.timezone.utc)
+    changed = known + datetime.timedelta(seconds=1)
+    content = dict(known=known, changed=changed, date=datetime.date(2014, 1, 2))
+    assert loads(dumps(content, default=strings.default)) == dict(
+        known="2022-09-07T17:50:53Z", changed="2022-09-07T17:50:54+00:00", date="2014-01-02")
+    # the same instant in another timezone is another string
+    other = known.astimezone(datetime.timezone(datetime.timedelta(hours=1)))
+    assert loads(dumps(other, default=strings.default)) == "2022-09-07T18:50:53+01:00"
+
+
+def test_decimals():
+    assert dumps([decimal.Decimal("58.0"), decimal.Decimal("58"), decimal.Decimal("1.25")]) == b"[58.0,58,1.25]"
+
+
+def test_write_json_and_ndjson(tmp_path):
+    entries = [dict(resource=dict(resourceType="Patient", id=f"p{idx}")) for idx in range(3)]
+    with gzip.open(tmp_path / "bundle.json.gz", "wb") as f:
+        write_json(f, dict(resourceType="Bundle", type="transaction", entry=None), entries[:2] + [dumps(entries[2])])
+    with gzip.open(tmp_path / "bundle.json.gz", "rb") as f:
+        assert loads(f.read()) == dict(resourceType="Bundle", type="transaction", entry=entries)
+    with open(tmp_path / "bundle.ndjson", "wb") as f:
+        write_ndjson(f, (entry["resource"] for entry in entries))
+    assert [loads(line) for line in (tmp_path / "bundle.ndjson").read_bytes().splitlines()] == [
+        entry["resource"] for entry in entries]
@@ -0,0 +1,26 @@
+import random
+
+from soa_bridge_match.synthea import ObservationCatalogue
+
+from conftest import synthea_dir
+
+
+def test_catalogue_reads_the_observations(tmp_path):
+    catalogue = ObservationCatalogue(str(synthea_dir(tmp_path)), index_dir=str(tmp_path / "index"))
+    assert catalogue.refresh() == 1
+    assert catalogue.count("laboratory") == 2
+    assert catalogue.codes("laboratory") == {"2160-0": 1, "2345-7": 1}
+    assert catalogue.read(catalogue.locations("laboratory", "2345-7")[0])["id"] == "obs-3"
+    assert catalogue.pick("vital-signs")["id"] == "obs-2"
+    sample = catalogue.sample("laboratory", 4, distribution="by-code", rng=random.Random(1))
+    assert {x["id"] for x in catalogue.read_many(sample)} <= {"obs-1", "obs-3"}
+
+
+def test_catalogue_is_kept_between_runs(tmp_path):
+    data = synthea_dir(tmp_path)
+    ObservationCatalogue(str(data), index_dir=str(tmp_path / "index")).refresh()
+    assert len(list((tmp_path / "index").iterdir())) == 1
+    catalogue = ObservationCatalogue(str(data), index_dir=str(tmp_path / "index"))
+    # the unchanged file isn't indexed again
+    assert catalogue.refresh() == 0
+    assert catalogue.count("laboratory", "2160-0") == 1
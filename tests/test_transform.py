@@ -0,0 +1,72 @@
+import pytest
+
+from soa_bridge_match import units
+from soa_bridge_match.config import Configuration
+from soa_bridge_match.dataset import hh
+from soa_bridge_match.transform import DomainTransform
+from soa_bridge_match.units import UnitTable
+
+from conftest import unit_codetable, vs_frame
+
+
+@pytest.fixture
+def unit_table(monkeypatch):
+    monkeypatch.setattr(units, "_table", UnitTable.from_frame(unit_codetable()))
+
+
+def _configuration(columns: dict) -> Configuration:
+    return Configuration(dict(key="USUBJID", columns=columns))
+
+
+def test_compiled_mappings():
+    config = _configuration({
+        "STUDYID": {"ResearchSubject": {"study": {"identifier": "value"}}},
+        "USUBJID": {"Observation": {"subject": "Patient"}},
+        "DOMAIN": {"Observation": {"status": "final"}},
+        "VSTESTCD": {"Observation": {"code": {"text": {"maps": {"PULSE": "Pulse Rate"}}}}},
+        "VSSTRESN": {"Observation": {"valueQuantity": "value"}},
+        "VSDTC": {"Observation": "effectiveDateTime"},
+        "VSSEQ": None})
+    transform = DomainTransform.compile(config, "VS")
+    assert transform.resource_types == ["ResearchSubject", "Observation"]
+    assert transform.columns == ["USUBJID", "VSSEQ", "STUDYID", "DOMAIN", "VSTESTCD", "VSSTRESN", "VSDTC"]
+    resources = transform.apply(vs_frame())
+    assert list(resources) == ["01-701-1015", "01-701-1023", "01-701-1028"]
+    subject, pulse, sysbp = resources["01-701-1015"][:3]
+    assert subject == {"resourceType": "ResearchSubject", "id": "01-701-1015", "status": "on-study",
+                       "study": {"identifier": {"value": "CDISCPILOT01"}},
+                       "individual": {"reference": f"Patient/{hh('01-701-1015')}"}}
+    assert pulse["subject"] == {"reference": f"Patient/{hh('01-701-1015')}"}
+    assert pulse["status"] == "final"
+    assert pulse["code"] == {"text": "Pulse Rate"}
+    assert "code" not in sysbp
+    assert pulse["valueQuantity"] == {"value": 72}
+    assert pulse["effectiveDateTime"].startswith("2014-01-02T10:00")
+    # the records have their own ids, the same on each run
+    assert len({x["id"] for x in resources["01-701-1015"]}) == 5
+    assert transform.apply(vs_frame())["01-701-1015"][1]["id"] == pulse["id"]
+    assert [x["resourceType"] for x in transform.apply(vs_frame(), ["Observation"])["01-701-1015"]] == \
+        ["Observation"] * 4
+
+
+def test_unknown_elements_and_hooks():
+    with pytest.raises(ValueError):
+        DomainTransform.compile(_configuration({"VSORRES": {"Observation": {"valu": None}}}), "VS")
+    with pytest.raises(ValueError):
+        DomainTransform.compile(_configuration({"VSORRES": {"Observation": {"code": "_lookup_nothing"}}}), "VS")
+
+
+def test_vs_configuration(unit_table):
+    transform = DomainTransform.for_domain("VS")
+    frame = vs_frame().assign(VSPOS="SITTING", VSORRESU=lambda x: x.VSORRESU.str.lower())
+    observations = [x for x in transform.apply(frame)["01-701-1023"] if x["resourceType"] == "Observation"]
+    assert len(observations) == 4
+    pulse = observations[0]
+    assert pulse["valueQuantity"] == {"value": 72, "unit": "beats/min", "system": "http://unitsofmeasure.org",
+                                      "code": "/min"}
+    assert pulse["category"][0]["coding"][0]["code"] == "vital-signs"
+    assert pulse["extension"][0]["valueCodeableConcept"]["coding"][0]["display"]
+    # the elements set from the hooks are shared, so they are not changed in place
+    assert observations[2]["valueQuantity"] is not pulse["valueQuantity"]
+    with pytest.raises(ValueError):
+        DomainTransform.for_domain("XX")
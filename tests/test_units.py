@@ -0,0 +1,51 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+from soa_bridge_match.units import UnitTable, ucum_scale
+
+from conftest import unit_codetable
+
+
+def test_ucum_scale():
+    assert ucum_scale("mg/dL")[1] == ucum_scale("g/L")[1] == "g1.m-3"
+    assert math.isclose(ucum_scale("mg/dL")[0] / ucum_scale("g/L")[0], 0.01)
+    assert ucum_scale("mm[Hg]")[1] == "g1.m-1.s-2"
+    assert math.isnan(ucum_scale("furlong")[0])
+
+
+def test_unit_table_from_frame():
+    table = UnitTable.from_frame(unit_codetable())
+    assert table.ucum("mg/dL") == "mg/dL"
+    assert table.ucum("BPM") == "/min"
+    assert table.ucum("g/l") == "g/L"
+    assert table.ucum("header") is None
+    factors = table.factors(pd.Series(["mg/dL", "g/L", "mmol/L", None]), "g/L")
+    np.testing.assert_allclose(factors[:2], [0.01, 1.0])
+    # mass can't be converted to molar
+    assert np.isnan(factors[2:]).all()
+    np.testing.assert_allclose(table.convert(["100", "x"], ["mg/dL", "mg/dL"], "g/L"), [1.0, np.nan])
+
+
+def test_conversion_factors_fall_back_to_the_data():
+    table = UnitTable.from_frame(unit_codetable())
+    frame = pd.DataFrame({"LBTESTCD": ["GLUC", "GLUC", "ALB"],
+                          "LBORRESU": ["mg/dL", "mg/dL", "g/L"],
+                          "LBSTRESU": ["mmol/L", "mmol/L", "g/L"],
+                          "LBORRES": ["90", "180", "40"],
+                          "LBSTRESN": [5.0, 10.0, 40.0]})
+    factors = table.conversion_factors(frame)
+    np.testing.assert_allclose(factors, [5 / 90, 5 / 90, 1.0])
+
+
+def test_unit_table_is_kept_in_the_cache(tmp_path, monkeypatch):
+    codetable = tmp_path / "codetable.xlsx"
+    codetable.write_bytes(b"codetable")
+    monkeypatch.setattr(UnitTable, "from_workbook", classmethod(lambda cls, path: cls.from_frame(unit_codetable())))
+    table = UnitTable.load(str(codetable), cache_dir=str(tmp_path / "cache"))
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+    monkeypatch.setattr(UnitTable, "from_workbook", classmethod(lambda cls, path: None))
+    cached = UnitTable.load(str(codetable), cache_dir=str(tmp_path / "cache"))
+    assert len(cached) == len(table)
+    assert cached.ucum("BPM") == "/min"
@@ -0,0 +1,57 @@
+import pytest
+
+from soa_bridge_match.bundler import SourcedBundle
+from soa_bridge_match.search import BundleSearch
+
+from windows import StudyWindow
+
+from conftest import subject_bundle
+
+
+class RecordingSearch(BundleSearch):
+    """
+    Records the queries run, and optionally ignores the _revinclude (as some servers do)
+    """
+
+    def __init__(self, bundles, revinclude: bool = True) -> None:
+        super().__init__(bundles)
+        self.urls = []
+        self._supports = revinclude
+
+    def get(self, url):
+        self.urls.append(url)
+        if url == "metadata" and not self._supports:
+            return None
+        if not self._supports and "_revinclude" in url:
+            url = url.split("&_revinclude")[0]
+        return super().get(url)
+
+
+def _bundles():
+    bundles = []
+    for subject_id, patient_id in (("01-701-1015", "p1"), ("01-701-1023", "p2")):
+        content = subject_bundle(subject_id, patient_id)
+        content["entry"][0]["resource"]["identifier"] = [{"value": "H2Q-MC-LZZT"}]
+        bundles.append(SourcedBundle.from_bundle(content))
+    return bundles
+
+
+@pytest.mark.parametrize("revinclude", [True, False])
+def test_encounters_for_subject(revinclude):
+    search = RecordingSearch(_bundles(), revinclude)
+    window = StudyWindow(None, "H2Q-MC-LZZT", engine=search)
+    encounters = window.get_encounters_for_subject("01-701-1023", ["PlanDefinition/pd1", "PlanDefinition/pd2"])
+    assert encounters["PlanDefinition/pd1"].id == "e1-p2"
+    assert encounters["PlanDefinition/pd2"] is None
+    cascade = [x for x in search.urls if x.startswith(("CarePlan", "ServiceRequest", "Encounter"))]
+    if revinclude:
+        # one search for the whole cascade, kept for the subject
+        assert len(cascade) == 1
+        assert window.get_visit_map("01-701-1023") is window.get_visit_map("01-701-1023")
+    else:
+        # the single search is tried once, then the stepwise queries run a wave per resource type
+        assert "_revinclude" in cascade[0]
+        assert [x.split("?")[0] for x in cascade[1:]] == ["CarePlan", "CarePlan", "ServiceRequest", "Encounter"]
+    assert window.get_encounter_for_subject("01-701-1023", "PlanDefinition/pd1").id == "e1-p2"
+    with pytest.raises(Exception):
+        window.get_encounter_for_subject("01-701-1023", "PlanDefinition/pd2")
@@ -5,37 +5,47 @@ import sys
 sys.path.append('../src')
 
 from soa_bridge_match import dataset
+from soa_bridge_match.runner import json_files, run_parallel, worker_connector
 
 
-def process_file(opts):
+def process_file(filename, opts):
     # getting the bundle
-    print("Processing file: {}".format(opts.filename))
-    ds = dataset.Naptha(opts.filename)
-    if opts.subject_id:
-        dd = ds.clone_subject(opts.subject_id)
-    else:
-        dd = ds
-    # type: dd: dataset.Naptha
-    for i in range(opts.num_obs):
-        if opts.obs_type == "laboratory":
-            dd.content.add_lab_value()
-        else:
-            dd.content.add_vitals_value()
+    print("Processing file: {}".format(filename))
+    ds = dataset.Naptha(filename, connector=worker_connector())
+    # type: ds: dataset.Naptha
+    added = ds.content.add_observations([opts.subject_id] if opts.subject_id else None,
+                                        opts.num_obs,
+                                        opts.obs_type,
+                                        distribution=opts.distribution,
+                                        bind_encounter=opts.bind_encounter,
+                                        seed=opts.seed)
+    print(f"Added {added.added} observations to {filename}")
     ds.content.dump()
 
 
-def process_dir(dirname):
-    for fname in os.listdir(dirname):
-        if fname.endswith('.json'):
-            process_file(os.path.join(dirname, fname))
+def process_dir(dirname, opts):
+    return run_parallel(process_file, json_files(dirname), jobs=opts.jobs, args=(opts,))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Add random observations to a dataset')
     parser.add_argument('-f', '--file', dest='filename', help='The file to process')
+    parser.add_argument('-d', '--dir', dest='dirname', help='The directory of files to process')
     parser.add_argument('-n', '--count', dest='num_obs', help='How many random observations to add', type=int, default=1)
     parser.add_argument('-t', '--type', dest='obs_type', help='The type of random observations to add',
                         default='laboratory', choices=['laboratory', 'vital-signs'])
     parser.add_argument('-s', '--subject-id', dest='subject_id', help='The subject id for the random observations',)
+    parser.add_argument('--distribution', dest='distribution', default='uniform', choices=['uniform', 'by-code'],
+                        help='Sample uniformly over the observations, or over the LOINC codes')
+    parser.add_argument('--bind-encounter', dest='bind_encounter', action='store_true',
+                        help='Attach the observations to the subject Encounters')
+    parser.add_argument('--seed', dest='seed', default=None, help='Seed for reproducible observations')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1, help='How many files to process at once')
     opts = parser.parse_args()
-
+    if opts.dirname and os.path.isdir(opts.dirname):
+        process_dir(opts.dirname, opts)
+    elif opts.filename and os.path.exists(opts.filename):
+        process_file(opts.filename, opts)
+    else:
+        parser.print_help()
+        sys.exit(1)
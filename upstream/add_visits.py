@@ -1,21 +1,27 @@
-import os
-import sys
+import argparse
 
 from soa_bridge_match.dataset import Naptha
+from soa_bridge_match.runner import json_files, run_parallel, worker_connector
+
 
 def process_file(filename):
     # getting the bundle
     print("Processing file: {}".format(filename))
-    ds = Naptha(filename)
-    ds.merge_sv()
+    # only ids and references are added, so the resources don't need to be parsed
+    ds = Naptha(filename, connector=worker_connector(), raw=True)
+    # the generated resources share a shape, so a sample is validated
+    added = ds.merge_sv(validate=False)
+    print(f"Added {added.added} resources to {filename} ({added.skipped} already present)")
     ds.content.dump()
 
 
-def process_dir(dirname):
-    for fname in os.listdir(dirname):
-        if fname.endswith('.json'):
-            process_file(os.path.join(dirname, fname))
+def process_dir(dirname, jobs: int = 1):
+    return run_parallel(process_file, json_files(dirname), jobs=jobs, preload=("DM", "SV"))
 
 
 if __name__ == "__main__":
-    process_dir(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Merge the SV visits into the subject bundles")
+    parser.add_argument("dirname", help="The directory of subject bundles")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1, help="How many files to process at once")
+    opts = parser.parse_args()
+    process_dir(opts.dirname, opts.jobs)
@@ -6,37 +6,48 @@ import os
 import sys
 
 
-from soa_bridge_match import dataset
 from soa_bridge_match import bundler
 
 
-def process_file(filename):
-    # getting the bundle
-    print("Processing file: {}".format(filename))
-    ds = dataset.Naptha(filename)
-    ds.merge_sv()
-    ds.content.dump()
-
-
-def clone_subject(old_subject_bundle: str, new_subject_id: str):
-    # getting the bundle
+def clone_subjects(old_subject_bundle: str, new_subject_ids: list[str],
+                   jobs: int = 1,
+                   seed=None,
+                   target_dir: str = None,
+                   fmt: str = "json",
+                   compact: bool = False,
+                   compress: bool = False):
+    # parse the template once, the workers share the clone plan
     bundle = bundler.SourcedBundle.from_bundle_file(old_subject_bundle)
     assert len(bundle.subjects) == 1, "Only one subject is allowed"
-    old_subject_id = bundle.subjects[0]
-    print("Cloning subject: {}".format(old_subject_id))
-    clone = bundle.clone_subject(new_subject_id)
-    fname = os.path.splitext(os.path.basename(old_subject_bundle))[0]
-    ofname = fname.replace(old_subject_id, new_subject_id)
-    dirname = os.path.dirname(old_subject_bundle)
-    clone.dump(target_dir=dirname, name=ofname)
+    print("Cloning subject {} {} times".format(bundle.subjects[0], len(new_subject_ids)))
+    return bundle.clone_many(new_subject_ids, target_dir=target_dir, seed=seed, jobs=jobs,
+                             fmt=fmt, compact=compact, compress=compress)
+
+
+def generate_subject_ids(prefix: str, count: int, start: int = 1) -> list[str]:
+    return [f"{prefix}{idx:04d}" for idx in range(start, start + count)]
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Clones an existing subject.")
     parser.add_argument("old_subject_bundle", help="The subject to clone.")
-    parser.add_argument("--subject-id", dest="new_subject_id", help="The new subject ID.")
+    parser.add_argument("--subject-id", dest="new_subject_id", action="append", default=[],
+                        help="The new subject ID (repeat to create several clones).")
+    parser.add_argument("-n", "--count", dest="count", type=int, default=0,
+                        help="Generate this many subject IDs (using the --id-prefix)")
+    parser.add_argument("--id-prefix", dest="id_prefix", default="01-999-",
+                        help="The prefix for the generated subject IDs")
+    parser.add_argument("--seed", dest="seed", default=None, help="Seed for reproducible clones")
+    parser.add_argument("-o", "--target-dir", dest="target_dir", default=None,
+                        help="Where to write the clones (defaults to the template directory)")
+    parser.add_argument("--format", dest="fmt", choices=["json", "ndjson"], default="json",
+                        help="Output format")
+    parser.add_argument("--compact", dest="compact", action="store_true", help="Don't indent the output")
+    parser.add_argument("--compress", dest="compress", action="store_true", help="gzip the output")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1, help="How many clones to create at once")
     opts = parser.parse_args()
-    if not opts.new_subject_id:
+    subject_ids = opts.new_subject_id + generate_subject_ids(opts.id_prefix, opts.count)
+    if not subject_ids:
         parser.print_help()
         sys.exit(1)
     if not opts.old_subject_bundle:
@@ -46,4 +57,10 @@ if __name__ == "__main__":
         parser.print_help()
         sys.exit(1)
 
-    clone_subject(opts.old_subject_bundle, opts.new_subject_id)
\ No newline at end of file
+    clone_subjects(opts.old_subject_bundle, subject_ids,
+                   jobs=opts.jobs,
+                   seed=opts.seed,
+                   target_dir=opts.target_dir,
+                   fmt=opts.fmt,
+                   compact=opts.compact,
+                   compress=opts.compress)
@@ -1,11 +1,20 @@
+import argparse
 import hashlib
 import json
 import os.path
 import sys
+import tempfile
 import uuid
+from collections import OrderedDict
 from datetime import datetime
+from itertools import chain
+from typing import Iterable, Iterator, Optional
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from soa_bridge_match.references import ReferenceGraph, extract_references, is_common_resource
+from soa_bridge_match.serialise import dumps, loads, write_json
 
-sys.path.append('../src')
 """
 This script does some elementary patching of the JSON files from the upstream
 - adds a transaction type to the Bundle
@@ -19,6 +28,8 @@ This script does some elementary patching of the JSON files from the upstream
 - adds request metadata for the entries to try and use UPSERT semantics for the resources
 - replaces OTHER LONG LOINC name with Temp measurement 
 - add status to observations (wierdly it thinks some are missing)   
+
+Use --stream to patch and split large bundles without loading them into memory
 """
 
 STATUS = dict(Observation=dict(status="final"),
@@ -125,141 +136,391 @@ def split_bundle(bundle: dict, expected: list[str]) -> dict:
     cache = {}
     common = []
     patients = []
+    graph = ReferenceGraph()
+    entries = {}
+    position = {}
     for entry in bundle['entry']:
-        rtype = entry['resource']['resourceType']
-        # maybe this should check for 'subject' or 'individual'
-        if rtype in ("ResearchStudy", "Group", "Organization", "Practitioner", "Medication") or rtype.endswith(
-                "Definition"):
+        resource = entry['resource']
+        rtype = resource['resourceType']
+        if is_common_resource(rtype):
             # design elements
             common.append(entry)
         else:
             if rtype == "Patient":
-                _id = entry['resource']['id']
-                patients.append(_id)
-            elif rtype == "ResearchSubject":
-                _id = entry['resource']['individual']['reference'].split("/")[-1]
-            else:
-                try:
-                    subject = entry['resource']['subject']
-                except KeyError as exc:
-                    print("Subject missing on {} {}".format(rtype, entry['resource']['id']))
-                    raise exc
-                _id = subject['reference'].split("/")[-1]
-            if _id not in cache:
-                if _id not in expected:
-                    # this might not be a problem
-                    # print("Unknown patient {} on {} {}".format(_id, rtype, entry['resource']['id']))
-                    continue
-            cache.setdefault(_id, []).append(entry)
-    for _id, entries in cache.items():
-        cache[_id] = entries + common
-    if cache.keys() != patients:
-        print("Extra patients: {}".format(set(cache.keys()) - set(patients)))
+                patients.append(resource['id'])
+            entries[(rtype, resource['id'])] = entry
+            position[(rtype, resource['id'])] = len(position)
+            graph.add(resource)
+    for _id in expected:
+        if ("Patient", _id) not in entries:
+            continue
+        # the patient and everything bound to the patient
+        owned = [("Patient", _id)]
+        owned.extend(graph.referencing(f"Patient/{_id}", element="individual"))
+        owned.extend(graph.referencing(f"Patient/{_id}", element="subject"))
+        # keep the bundle order (as the streaming split does)
+        cache[_id] = [entries[key] for key in sorted(set(owned), key=position.get)]
+    assigned = {id(entry) for _entries in cache.values() for entry in _entries}
+    for (rtype, _id), entry in entries.items():
+        if id(entry) not in assigned:
+            # this might not be a problem
+            print("Unassigned resource {} {}".format(rtype, _id))
+    for _id, _entries in cache.items():
+        cache[_id] = _entries + common
+    if set(cache.keys()) != set(patients):
+        print("Extra patients: {}".format(set(patients) - set(cache.keys())))
     return cache
 
 
-def patch_file(filename):
+def patch_entry(idx: int, entry: dict, id_cache: dict, dupes: dict, patient_ids: dict):
+    """
+    Apply the patches to a single bundle entry
+    """
+    resource = entry['resource']
+    resource_type = resource['resourceType']
+    _identifier = resource['id']
+    if _identifier in id_cache.get(resource_type, set()):
+        print(f"{idx}: Updating duplicate identifier", _identifier, "for resource", resource_type)
+        # derived from the position, so the patched files are reproducible
+        _id = str(uuid.uuid3(uuid.NAMESPACE_OID, f"{resource_type}/{_identifier}/{idx}"))
+        # add a reference to the duplicate
+        dupes.setdefault(resource_type, []).append(dict(id=_identifier, new_id=_id, idx=idx))
+        resource['id'] = _id
+    else:
+        id_cache.setdefault(resource_type, set()).add(_identifier)
+    if resource['resourceType'] == 'AdverseEvent':
+        patch_adverse_event(resource)
+    elif resource['resourceType'] == 'ResearchSubject':
+        # update the identifier
+        _identifier = patch_research_subject(resource)
+    elif resource['resourceType'] == 'Patient':
+        original_id = resource['id']
+        # update the identifier
+        _identifier = patch_patient(resource)
+        # track the patient ids
+        patient_ids[_identifier] = original_id
+    elif resource['resourceType'] == 'Observation':
+        patch_observation(resource)
+    elif resource['resourceType'] in STATUS:
+        _sets = STATUS[resource['resourceType']]
+        for key, value in _sets.items():
+            if isinstance(value, dict):
+                element = resource[key]
+                if isinstance(element, list):
+                    for item in element:
+                        for k, v in value.items():
+                            item[k] = v
+                else:
+                    for k, v in value.items():
+                        element[k] = v
+            elif key not in entry['resource']:
+                entry['resource'][key] = value
+    update_references(resource)
+    # if 'fullUrl' not in entry:
+    #     # ADD THE FULL URL
+    #     entry['fullUrl'] = _identifier
+    if 'request' not in entry:
+        # ADD THE REQUEST (to create the resource)
+        entry['request'] = dict(method='PUT',
+                                url=f"{resource_type}/{_identifier}",
+                                ifNoneExist=f"identifier={_identifier}")
+
+
+def design_entries() -> list[dict]:
+    """
+    The site and study medication entries added to the bundle
+    """
+    # add the site
+    _site_id = hashlib.md5("701".encode('utf-8')).hexdigest()
+    site_entry = dict(resource=dict(
+        resourceType='Organization',
+        id=_site_id,
+        name="H2Q-MC-LZZT Site 701"),
+        request=dict(method='PUT',
+                     url=f'Organization/{_site_id}',
+                     ifNoneExist=f"id={_site_id}")
+    )
+    # add a record for the medication
+    medication_entry = dict(resource=dict(
+        resourceType='Medication',
+        id="LY246708"),
+        request=dict(method='PUT',
+                     url=f'Medication/LY246708',
+                     ifNoneExist=f"id=LY246708")
+    )
+    return [site_entry, medication_entry]
+
+
+def subject_bundle_header(filename: str, last_updated: str) -> dict:
+    return dict(resourceType="Bundle",
+                id=str(uuid.uuid3(uuid.NAMESPACE_URL, filename)),
+                type="transaction",
+                meta=dict(lastUpdated=last_updated))
+
+
+def timestamp() -> str:
+    return datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def write_bundle(filename: str, header: dict, entries: Iterable[dict]):
+    """
+    Write a bundle (the patched bundles are written the same way in both modes)
+    """
+    with open(filename, 'wb') as f:
+        write_json(f, header, entries, indent=True)
+
+
+def subject_filename(prefix: str, ext: str, original_id: str) -> str:
+    return f"subjects/{prefix.replace('10_Patients', original_id)}{ext}"
+
+
+def patch_file(filename, last_updated: Optional[str] = None):
     if os.path.exists(filename):
         id_cache = {}
         dupes = {}
+        last_updated = last_updated if last_updated else timestamp()
         prefix, ext = os.path.splitext(filename)
-        with open(filename, 'r') as f:
+        with open(filename, 'r', encoding='utf-8') as f:
             data = json.load(f)
         if "type" not in data:
             data["type"] = "transaction"
-        subjects = []
-        patients = []
+        subjects = 0
         patient_ids = {}
         for idx, entry in enumerate(data['entry']):
-            resource = entry['resource']
-            resource_type = resource['resourceType']
-            _identifier = resource['id']
-            if _identifier in id_cache.get(resource_type, []):
-                print(f"{idx}: Updating duplicate identifier", _identifier, "for resource", resource_type)
-                _id = str(uuid.uuid4())
-                # add a reference to the duplicate
-                dupes.setdefault(resource_type, []).append(dict(id=_identifier, new_id=_id, idx=idx))
-                resource['id'] = _id
-            else:
-                id_cache.setdefault(resource_type, []).append(_identifier)
-            if resource['resourceType'] == 'AdverseEvent':
-                patch_adverse_event(resource)
-            elif resource['resourceType'] == 'ResearchSubject':
-                subjects.append(resource)
-                # update the identifier
-                _identifier = patch_research_subject(resource)
-            elif resource['resourceType'] == 'Patient':
-                original_id = resource['id']
-                patients.append(resource)
-                # update the identifier
-                _identifier = patch_patient(resource)
-                # track the patient ids
-                patient_ids[_identifier] = original_id
-            elif resource['resourceType'] == 'Observation':
-                patch_observation(resource)
-            elif resource['resourceType'] in STATUS:
-                _sets = STATUS[resource['resourceType']]
-                for key, value in _sets.items():
-                    if isinstance(value, dict):
-                        element = resource[key]
-                        if isinstance(element, list):
-                            for item in element:
-                                for k, v in value.items():
-                                    item[k] = v
-                        else:
-                            for k, v in value.items():
-                                element[k] = v
-                    elif key not in entry['resource']:
-                        entry['resource'][key] = value
-            update_references(resource)
-            # if 'fullUrl' not in entry:
-            #     # ADD THE FULL URL
-            #     entry['fullUrl'] = _identifier
-            if 'request' not in entry:
-                # ADD THE REQUEST (to create the resource)
-                entry['request'] = dict(method='PUT',
-                                        url=f"{resource_type}/{_identifier}",
-                                        ifNoneExist=f"identifier={_identifier}")
-        # add the site
-        _site_id = hashlib.md5("701".encode('utf-8')).hexdigest()
-        site_entry = dict(resource=dict(
-            resourceType='Organization',
-            id=_site_id,
-            name="H2Q-MC-LZZT Site 701"),
-            request=dict(method='PUT',
-                         url=f'Organization/{_site_id}',
-                         ifNoneExist=f"id={_site_id}")
-        )
-        data['entry'].append(site_entry)
-        # add a record for the medication
-        medication_entry = dict(resource=dict(
-            resourceType='Medication',
-            id="LY246708"),
-            request=dict(method='PUT',
-                         url=f'Medication/LY246708',
-                         ifNoneExist=f"id=LY246708")
-        )
-        data['entry'].append(medication_entry)
+            patch_entry(idx, entry, id_cache, dupes, patient_ids)
+            if entry['resource']['resourceType'] == 'ResearchSubject':
+                subjects += 1
+        data['entry'].extend(design_entries())
         # check we haven't made a new subject or two
-        assert len(patients) == len(subjects)
-        with open(f"{prefix}_patched{ext}", 'w') as f:
-            json.dump(data, f, indent=2)
-        with open(f"{prefix}_dupes{ext}", 'w') as f:
+        assert len(patient_ids) == subjects
+        write_bundle(f"{prefix}_patched{ext}", data, data['entry'])
+        with open(f"{prefix}_dupes{ext}", 'w', encoding='utf-8') as f:
             json.dump(dupes, f, indent=2)
         split_entries = split_bundle(data, patient_ids.keys())
         for patient_id, entries in split_entries.items():
-            content = dict(resourceType="Bundle",
-                           id=str(uuid.uuid4()),
-                           type="transaction",
-                           meta=dict(lastUpdated=datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')),
-                           entry=entries)
-
-            with open(f"subjects/{prefix.replace('10_Patients', patient_ids.get(patient_id))}{ext}", 'w') as f:
-                json.dump(content, f, indent=2)
+            fname = subject_filename(prefix, ext, patient_ids.get(patient_id))
+            write_bundle(fname, subject_bundle_header(fname, last_updated), entries)
 
     else:
         raise FileNotFoundError(filename)
 
 
+# size of the reads when streaming a bundle
+CHUNK_SIZE = 1 << 16
+
+
+class EntryStream:
+    """
+    Incrementally decodes a Bundle, yielding the entries one at a time; the
+    other top-level elements are collected in the header
+    """
+
+    def __init__(self, f, chunk_size: int = CHUNK_SIZE):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+        self.header = {}
+
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        chunk = self._f.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        # drop the consumed content
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in " \t\r\n":
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of Bundle content")
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f"Expected {char!r}, got {self._buffer[self._pos]!r}")
+        self._pos += 1
+
+    def _decode(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            if end == len(self._buffer) and self._fill():
+                # a scalar may carry on into the next chunk
+                continue
+            self._pos = end
+            return value
+
+    def __iter__(self) -> Iterator[dict]:
+        self._expect("{")
+        if self._peek() == "}":
+            return
+        while True:
+            key = self._decode()
+            self._expect(":")
+            if key == "entry":
+                self._expect("[")
+                if self._peek() == "]":
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._decode()
+                        if self._peek() == ",":
+                            self._pos += 1
+                            continue
+                        self._expect("]")
+                        break
+            else:
+                self.header[key] = self._decode()
+            if self._peek() == ",":
+                self._pos += 1
+                continue
+            self._expect("}")
+            return
+
+
+class EntrySpool:
+    """
+    Spills entries to per-key files on disk (one JSON entry per line), keeping
+    a bounded number of files open
+    """
+
+    def __init__(self, dirname: str, max_open: int = 64):
+        self._dirname = dirname
+        self._max_open = max_open
+        self._handles = OrderedDict()
+        self._keys = set()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._dirname, hashlib.md5(key.encode('utf-8')).hexdigest() + ".ndjson")
+
+    def _handle(self, key: str):
+        if key in self._handles:
+            self._handles.move_to_end(key)
+            return self._handles[key]
+        if len(self._handles) >= self._max_open:
+            _, handle = self._handles.popitem(last=False)
+            handle.close()
+        handle = open(self._path(key), 'ab')
+        self._handles[key] = handle
+        self._keys.add(key)
+        return handle
+
+    def append(self, key: str, entry: dict):
+        handle = self._handle(key)
+        handle.write(dumps(entry))
+        handle.write(b"\n")
+
+    def entries(self, key: str) -> Iterator[dict]:
+        """
+        Read back the entries for a key
+        """
+        if key in self._handles:
+            self._handles.pop(key).close()
+        if key not in self._keys:
+            return
+        with open(self._path(key), 'rb') as f:
+            for line in f:
+                yield loads(line)
+
+    def close(self):
+        while self._handles:
+            _, handle = self._handles.popitem()
+            handle.close()
+
+
+def entry_owner(resource: dict) -> Optional[str]:
+    """
+    Get the (hashed) Patient id that owns a resource
+    """
+    if resource['resourceType'] == 'Patient':
+        return resource['id']
+    for element, reference in extract_references(resource):
+        if element in ('individual', 'subject') and reference.startswith('Patient/'):
+            return reference.split('/')[-1]
+    return None
+
+
+# spool keys (not valid patient ids)
+PATCHED = "_patched"
+COMMON = "_common"
+
+
+def patch_file_streaming(filename: str, spool_dir: Optional[str] = None, chunk_size: int = CHUNK_SIZE,
+                         last_updated: Optional[str] = None):
+    """
+    Patch and split a bundle one entry at a time; the patched entries are spooled
+    to disk per patient (the common design resources in their own spool) and the
+    output bundles are assembled from the spools (the files match patch_file)
+    """
+    if not os.path.exists(filename):
+        raise FileNotFoundError(filename)
+    last_updated = last_updated if last_updated else timestamp()
+    id_cache = {}
+    dupes = {}
+    patient_ids = {}
+    subjects = 0
+    prefix, ext = os.path.splitext(filename)
+    with tempfile.TemporaryDirectory(dir=spool_dir) as dirname:
+        spool = EntrySpool(dirname)
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                stream = EntryStream(f, chunk_size)
+                for idx, entry in enumerate(stream):
+                    patch_entry(idx, entry, id_cache, dupes, patient_ids)
+                    rtype = entry['resource']['resourceType']
+                    if rtype == 'ResearchSubject':
+                        subjects += 1
+                    spool.append(PATCHED, entry)
+                    if is_common_resource(rtype):
+                        spool.append(COMMON, entry)
+                        continue
+                    owner = entry_owner(entry['resource'])
+                    if owner is None:
+                        print("Unassigned resource {} {}".format(rtype, entry['resource']['id']))
+                        continue
+                    spool.append(owner, entry)
+            for entry in design_entries():
+                spool.append(PATCHED, entry)
+                spool.append(COMMON, entry)
+            # check we haven't made a new subject or two
+            assert len(patient_ids) == subjects
+            header = dict(stream.header)
+            if "type" not in header:
+                header["type"] = "transaction"
+            write_bundle(f"{prefix}_patched{ext}", header, spool.entries(PATCHED))
+            with open(f"{prefix}_dupes{ext}", 'w', encoding='utf-8') as f:
+                json.dump(dupes, f, indent=2)
+            for patient_id, original_id in patient_ids.items():
+                fname = subject_filename(prefix, ext, original_id)
+                write_bundle(fname, subject_bundle_header(fname, last_updated),
+                             chain(spool.entries(patient_id), spool.entries(COMMON)))
+        finally:
+            spool.close()
+
+
 if __name__ == "__main__":
-    patch_file(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Patch a bundle and split it by patient")
+    parser.add_argument("filename", help="The bundle to patch")
+    parser.add_argument("--stream", action="store_true",
+                        help="Process the bundle one entry at a time rather than loading it")
+    parser.add_argument("--spool-dir", dest="spool_dir", help="Where to spool the entries when streaming")
+    opts = parser.parse_args()
+    if opts.stream:
+        patch_file_streaming(opts.filename, opts.spool_dir)
+    else:
+        patch_file(opts.filename)